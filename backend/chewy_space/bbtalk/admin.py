@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import BBTalk, Tag, User, Identity
+from .models import BBTalk, Tag, User, Identity, StorageUsage
 
 
 @admin.register(User)
@@ -82,3 +82,12 @@ class BBTalkAdmin(BaseAdmin):
         """在列表视图中显示标签"""
         return ', '.join([tag.name for tag in obj.tags.all()])
     formated_tags.short_description = '标签'
+
+
+@admin.register(StorageUsage)
+class StorageUsageAdmin(admin.ModelAdmin):
+    """存储用量由上传、删除和迁移自动维护，后台只用于设置配额"""
+    list_display = ('id', 'user', 'storage_config_id', 'file_count', 'bytes_used', 'quota_bytes', 'updated_at')
+    search_fields = ('user__username', 'storage_config_id')
+    readonly_fields = ('user', 'storage_config_id', 'file_count', 'bytes_used', 'updated_at')
+    fields = ('user', 'storage_config_id', 'file_count', 'bytes_used', 'quota_bytes', 'updated_at')
@@ -0,0 +1,308 @@
+"""
+批量删除附件
+
+注销账号、批量删除 BBTalk 时要删除大量附件。逐个 release_attachment_files 每个对象一次 HTTP 请求，
+大账号会让请求超时。这里分成两步：
+
+1. 请求内（数据库事务中）：释放去重引用计数、删除附件记录、一次更新用量，
+   收集不再被任何附件或 blob 引用的存储路径（原文件、缩略图、公开副本），按存储分组
+2. 事务提交后在后台线程中删除存储对象：S3 每 1000 个对象一次 DeleteObjects，
+   本地存储用线程池并行删除；失败的对象按指数退避重试
+
+存储引擎在第 1 步构建，注销账号时存储配置随用户一起删除也不影响后台删除。
+进程在后台删除完成前退出时，剩余对象由附件回收（collect_attachment_garbage）清理。
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from chewy_attachment.core.storage import BaseStorageEngine
+
+from .blob_storage import BlobStorageService
+from .models import Attachment, BBTalk, StorageBlob, User
+from .public_attachments import local_public_file, public_storage_path
+from .storage_gc import ATTACHMENT_URL_RE, comment_attachment_ids
+from .storage_io import s3_backend, s3_key
+from .storage_migration import StorageMigrationService
+from .storage_usage import adjust_usage
+
+logger = logging.getLogger(__name__)
+
+# S3 DeleteObjects 单次最多 1000 个对象
+DELETE_BATCH_SIZE = 1000
+
+# 首次重试前等待的秒数，之后每次翻倍
+RETRY_BACKOFF = 2
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _deletion_settings() -> Dict[str, Any]:
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    return {
+        'workers': chewy_settings.get('DELETION_WORKERS', 4),
+        'max_attempts': chewy_settings.get('DELETION_MAX_ATTEMPTS', 3),
+    }
+
+
+def _chunked(items: Iterable, size: int) -> Iterable[list]:
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # 删除任务依次执行，任务内部再并行删除本地文件
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bbtalk-deletion')
+    return _executor
+
+
+@dataclass
+class _StorageTargets:
+    """一个存储中待删除的对象"""
+    engine: BaseStorageEngine
+    paths: Set[str] = field(default_factory=set)
+    # 本地公开副本（不在附件存储目录下）的绝对路径
+    local_files: Set[str] = field(default_factory=set)
+
+
+class AttachmentDeletionService:
+    """批量删除某个用户的附件"""
+
+    def __init__(self, user: User):
+        self.user = user
+        self._engines = StorageMigrationService(user)
+        # 存储配置 ID → 待删除对象；存储不可用时为 None
+        self.targets: Dict[str, Optional[_StorageTargets]] = {}
+
+    def delete_attachments(self, attachments: Iterable[Attachment]) -> int:
+        """
+        删除附件记录，并在事务提交后于后台删除不再被引用的存储对象
+
+        Returns:
+            删除的附件数
+        """
+        attachments = list(attachments)
+        if not attachments:
+            return 0
+
+        with transaction.atomic():
+            for attachment in attachments:
+                if attachment.content_hash:
+                    BlobStorageService(None, attachment.storage_config_id).release(attachment.content_hash)
+            for batch in _chunked([attachment.id for attachment in attachments], DELETE_BATCH_SIZE):
+                Attachment.objects.filter(id__in=batch).delete()
+            self._record_usage(attachments)
+            self._collect_targets(attachments)
+            targets = [target for target in self.targets.values() if target and (target.paths or target.local_files)]
+            if targets:
+                transaction.on_commit(lambda: _get_executor().submit(delete_storage_objects, targets))
+
+        object_count = sum(len(target.paths) + len(target.local_files) for target in targets)
+        logger.info(f"删除用户 {self.user.id} 的 {len(attachments)} 个附件，后台删除存储对象 {object_count} 个")
+        return len(attachments)
+
+    def _record_usage(self, attachments: List[Attachment]) -> None:
+        totals: Dict[str, Tuple[int, int]] = {}
+        for attachment in attachments:
+            count, size = totals.get(attachment.storage_config_id or '', (0, 0))
+            totals[attachment.storage_config_id or ''] = (count + 1, size + attachment.size)
+        for config_id, (count, size) in totals.items():
+            adjust_usage(self.user.id, config_id or None, -count, -size)
+
+    def _targets_for(self, config_id: str) -> Optional[_StorageTargets]:
+        if config_id not in self.targets:
+            try:
+                self.targets[config_id] = _StorageTargets(self._engines.get_engine(config_id or None))
+            except ValueError as e:
+                logger.warning(f"附件所在存储不可用，跳过删除存储对象: {e}")
+                self.targets[config_id] = None
+        return self.targets[config_id]
+
+    def _collect_targets(self, attachments: List[Attachment]) -> None:
+        """收集已删除附件中不再被其他附件或 blob 引用的存储路径"""
+        by_config: Dict[str, Dict[str, Attachment]] = {}
+        for attachment in attachments:
+            by_config.setdefault(attachment.storage_config_id or '', {})[attachment.storage_path] = attachment
+
+        for config_id, by_path in by_config.items():
+            config_filter = Q(storage_config_id=config_id) if config_id else (
+                Q(storage_config_id__isnull=True) | Q(storage_config_id='')
+            )
+            still_used: Set[str] = set()
+            still_public: Set[str] = set()
+            for batch in _chunked(by_path, DELETE_BATCH_SIZE):
+                rows = Attachment.objects.filter(config_filter, storage_path__in=batch).values_list('storage_path', 'public_url')
+                for storage_path, public_url in rows:
+                    still_used.add(storage_path)
+                    if public_url:
+                        still_public.add(storage_path)
+                still_used.update(StorageBlob.objects.filter(
+                    storage_config_id=config_id, storage_path__in=batch,
+                ).values_list('storage_path', flat=True))
+
+            target = self._targets_for(config_id)
+            if target is None:
+                continue
+            is_s3 = s3_backend(target.engine) is not None
+            for storage_path, attachment in by_path.items():
+                if storage_path not in still_used:
+                    target.paths.add(storage_path)
+                    for derivative in ((attachment.media_info or {}).get('derivatives') or {}).values():
+                        if derivative.get('path'):
+                            target.paths.add(derivative['path'])
+                if attachment.public_url and storage_path not in still_public:
+                    public_path = public_storage_path(target.engine, storage_path)
+                    if public_path is None:
+                        continue
+                    if is_s3:
+                        target.paths.add(public_path)
+                    else:
+                        target.local_files.add(str(local_public_file(public_path)))
+
+
+def delete_storage_objects(targets: List[_StorageTargets]) -> int:
+    """
+    后台任务：删除各存储中的对象，失败的对象按指数退避重试
+
+    Returns:
+        最终仍未删除的对象数
+    """
+    max_attempts = max(1, _deletion_settings()['max_attempts'])
+    remaining = 0
+    try:
+        for target in targets:
+            paths, local_files = sorted(target.paths), sorted(target.local_files)
+            for attempt in range(max_attempts):
+                paths = _delete_paths(target.engine, paths)
+                local_files = _unlink_files(local_files)
+                if not paths and not local_files:
+                    break
+                if attempt + 1 < max_attempts:
+                    time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            if paths or local_files:
+                logger.error(f"删除存储对象失败 {len(paths) + len(local_files)} 个，留给附件回收处理: {(paths + local_files)[:5]}")
+            remaining += len(paths) + len(local_files)
+    except Exception as e:
+        logger.error(f"后台删除存储对象失败: {e}", exc_info=True)
+    finally:
+        close_old_connections()
+    return remaining
+
+
+def _delete_paths(engine: BaseStorageEngine, paths: List[str]) -> List[str]:
+    """删除存储中的对象，返回删除失败的路径"""
+    if not paths:
+        return []
+    backend = s3_backend(engine)
+    if backend is None:
+        return _parallel(lambda path: engine.delete_file(path), paths)
+
+    failed = []
+    client = backend.connection.meta.client
+    for batch in _chunked(paths, DELETE_BATCH_SIZE):
+        keys = {s3_key(backend, path): path for path in batch}
+        try:
+            response = client.delete_objects(
+                Bucket=backend.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+            )
+        except Exception as e:
+            logger.warning(f"DeleteObjects 失败 ({len(batch)} 个对象): {e}")
+            failed.extend(batch)
+            continue
+        for error in response.get('Errors', []):
+            logger.warning(f"删除 {error.get('Key')} 失败: {error.get('Message')}")
+            failed.append(keys.get(error.get('Key'), error.get('Key')))
+    return failed
+
+
+def _unlink_files(files: List[str]) -> List[str]:
+    """删除本地文件（已不存在视为成功），返回删除失败的路径"""
+    def unlink(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return _parallel(unlink, files)
+
+
+def _parallel(func, items: List[str]) -> List[str]:
+    """用线程池并行执行，返回执行失败的项"""
+    if not items:
+        return []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, _deletion_settings()['workers'])) as pool:
+        for item, future in [(item, pool.submit(func, item)) for item in items]:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"删除 {item} 失败: {e}")
+                failed.append(item)
+    return failed
+
+
+def attachment_ids_in(bbtalks: Iterable[BBTalk]) -> Set[str]:
+    """BBTalk 附件列表和正文中引用的附件 ID（小写）"""
+    ids: Set[str] = set()
+    for bbtalk in bbtalks:
+        for item in bbtalk.attachments or []:
+            if not isinstance(item, dict):
+                continue
+            for key in ('uid', 'id'):
+                if item.get(key):
+                    ids.add(str(item[key]).lower())
+            ids.update(match.lower() for match in ATTACHMENT_URL_RE.findall(str(item.get('url') or '')))
+        ids.update(match.lower() for match in ATTACHMENT_URL_RE.findall(bbtalk.content or ''))
+    return ids
+
+
+def delete_bbtalks(user: User, bbtalks) -> Tuple[int, int]:
+    """
+    删除用户的一批 BBTalk，以及只被这些 BBTalk 引用的附件
+
+    仍被该用户其他 BBTalk、任何评论或头像引用的附件保留
+
+    Returns:
+        (删除的 BBTalk 数, 删除的附件数)
+    """
+    with transaction.atomic():
+        bbtalks = list(bbtalks.only('id', 'attachments', 'content'))
+        candidate_ids = attachment_ids_in(bbtalks)
+        BBTalk.objects.filter(id__in=[bbtalk.id for bbtalk in bbtalks]).delete()
+        if not candidate_ids:
+            return len(bbtalks), 0
+
+        remaining = BBTalk.objects.filter(user=user).only('attachments', 'content').iterator(chunk_size=2000)
+        candidate_ids -= attachment_ids_in(remaining)
+        # 被删除 BBTalk 的评论已级联删除，剩下的评论仍可能引用这些附件
+        candidate_ids -= comment_attachment_ids()
+        candidate_ids -= {match.lower() for match in ATTACHMENT_URL_RE.findall(user.avatar or '')}
+        valid_ids = []
+        for attachment_id in candidate_ids:
+            try:
+                valid_ids.append(uuid.UUID(attachment_id))
+            except ValueError:
+                continue
+        attachments = []
+        for batch in _chunked(valid_ids, DELETE_BATCH_SIZE):
+            attachments.extend(Attachment.objects.filter(id__in=batch, owner_id=str(user.id)))
+        deleted_attachments = AttachmentDeletionService(user).delete_attachments(attachments)
+    return len(bbtalks), deleted_attachments
@@ -3,79 +3,314 @@
 """
 import logging
 import os
-from typing import Optional, Tuple
-from chewy_attachment.django_app.views import AttachmentViewSet as BaseAttachmentViewSet
+import secrets
+import uuid
+from typing import Callable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+from chewy_attachment.django_app.views import (
+    AttachmentViewSet as BaseAttachmentViewSet,
+    get_attachment_model,
+)
 from chewy_attachment.django_app.serializers import AttachmentUploadSerializer
+from chewy_attachment.core.permissions import PermissionChecker
 from chewy_attachment.core.storage import DjangoStorageEngine, BaseStorageEngine
-from django.http import HttpResponse, Http404, HttpResponseRedirect
+from chewy_attachment.core.utils import detect_mime_type, safe_filename
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.http import (
+    FileResponse, HttpResponse, Http404, HttpResponseNotModified, HttpResponseRedirect, StreamingHttpResponse,
+)
+from django.utils.http import http_date, parse_http_date_safe
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
+
+from .blob_storage import (
+    BlobStorageService, compute_content_hash, release_attachment_files, shared_media_info, write_blob,
+)
+from .disk_cache import get_disk_cache
+from .media_processing import (
+    derivative_widths,
+    get_image_derivative,
+    is_processable_image,
+    optimize_uploaded_image,
+    schedule_media_processing,
+)
+from .models import Attachment
+from .public_attachments import try_publish_attachment
+from .s3_proxy import S3ObjectNotFound, iter_s3_range, open_s3_object, proxy_downloads_enabled
+from .serializers import AttachmentSerializer
+from .signed_urls import get_cached_file_url
+from .storage import is_cloud_storage_engine
+from .storage_health import find_storage_unavailable
+from .storage_usage import QuotaExceeded, check_quota, record_attachment_added, record_attachment_removed
 
 logger = logging.getLogger(__name__)
 
 
-def parse_range_header(range_header: str, file_size: int):
+def _attachment_settings() -> dict:
+    return getattr(settings, 'CHEWY_ATTACHMENT', {})
+
+
+class RangeFileWrapper:
+    """
+    将已定位到起始位置的文件限定为只读 length 字节
+
+    保留 fileno()，gunicorn 的 wsgi.file_wrapper 会从当前位置按 Content-Length
+    调用 os.sendfile；不支持 sendfile 的服务器则按块 read()，不会越过范围末尾。
+    不提供 tell/seek，避免 FileResponse 按整个文件推算 Content-Length。
+    """
+
+    def __init__(self, filelike, length: int):
+        self.filelike = filelike
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.filelike.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def close(self):
+        self.filelike.close()
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
     """
-    解析 HTTP Range 请求头
+    解析 HTTP Range 请求头（RFC 7233，支持多段）
+
+    各段按起始位置排序，重叠或相邻的段会被合并；超出文件大小的段被丢弃。
 
     Args:
-        range_header: 例如 "bytes=0-1023"、"bytes=1000-"、"bytes=-500"
+        range_header: 例如 "bytes=0-1023"、"bytes=1000-"、"bytes=-500"、"bytes=0-99,200-299"
         file_size: 文件总大小（字节）
 
     Returns:
-        (start, end) 元组表示合法范围，None 表示格式不合法
+        [(start, end), ...] 合并后的范围列表，None 表示格式不合法
 
     Raises:
-        ValueError: Range 范围超出文件大小
+        ValueError: 所有范围都超出文件大小
     """
     if not range_header or not range_header.startswith('bytes='):
         return None
 
-    range_spec = range_header[6:]  # 去掉 "bytes="
-
-    # 不支持多段 Range
-    if ',' in range_spec:
-        return None
+    ranges = []
+    for range_spec in range_header[6:].split(','):  # 去掉 "bytes="
+        range_spec = range_spec.strip()
+        if not range_spec:
+            # 允许 "bytes=0-1, 5-6" 这类写法中的空白，但不允许空段
+            return None
 
-    parts = range_spec.split('-', 1)
-    if len(parts) != 2:
-        return None
+        parts = range_spec.split('-', 1)
+        if len(parts) != 2:
+            return None
 
-    start_str, end_str = parts
+        start_str, end_str = parts[0].strip(), parts[1].strip()
 
-    try:
-        if start_str == '' and end_str:
-            # bytes=-500（最后 500 字节）
-            suffix = int(end_str)
-            if suffix <= 0:
+        try:
+            if start_str == '' and end_str:
+                # bytes=-500（最后 500 字节）
+                suffix = int(end_str)
+                if suffix <= 0:
+                    return None
+                start = max(0, file_size - suffix)
+                end = file_size - 1
+            elif end_str == '' and start_str:
+                # bytes=1000-（从 1000 到末尾）
+                start = int(start_str)
+                end = file_size - 1
+            elif start_str and end_str:
+                # bytes=0-1023
+                start = int(start_str)
+                end = int(end_str)
+                if start > end:
+                    return None
+            else:
                 return None
-            start = max(0, file_size - suffix)
-            end = file_size - 1
-        elif end_str == '' and start_str:
-            # bytes=1000-（从 1000 到末尾）
-            start = int(start_str)
-            end = file_size - 1
-        elif start_str and end_str:
-            # bytes=0-1023
-            start = int(start_str)
-            end = int(end_str)
-        else:
+        except ValueError:
             return None
-    except ValueError:
-        return None
 
-    # 验证范围
-    if start < 0 or end < 0 or start > end:
-        return None
+        # 验证范围
+        if start < 0:
+            return None
+
+        if start >= file_size:
+            # 不可满足的段直接丢弃，只要还有其他可满足的段就继续
+            continue
+
+        # 将 end 限制在 file_size - 1
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise ValueError(f"Range {range_header} not satisfiable for file size {file_size}")
+
+    # 合并重叠或相邻的范围，防止客户端用大量重叠小段放大输出
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+# 多段响应每次读取的块大小
+MULTIPART_CHUNK_SIZE = 64 * 1024
+
+
+def attachment_etag(instance, variant: Optional[dict] = None) -> str:
+    """附件内容不可变，用 ID 和大小构造强校验 ETag；缩略图额外带上宽度"""
+    if variant:
+        return f'"{instance.id}-w{variant["width"]}-{variant["size"]}"'
+    return f'"{instance.id}-{instance.size}"'
+
+
+def attachment_last_modified(instance) -> Optional[int]:
+    """附件上传后内容不再变化，以创建时间作为 Last-Modified（Unix 时间戳）"""
+    return int(instance.created_at.timestamp()) if instance.created_at else None
+
+
+def is_not_modified(request, etag: str, last_modified: Optional[int] = None) -> bool:
+    """
+    校验 If-None-Match / If-Modified-Since（RFC 7232），客户端缓存仍然有效时返回 True
+
+    If-None-Match 使用弱比较，存在时忽略 If-Modified-Since
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            return True
+        opaque = etag[2:] if etag.startswith('W/') else etag
+        return any(
+            (tag[2:] if tag.startswith('W/') else tag) == opaque
+            for tag in (item.strip() for item in if_none_match.split(','))
+        )
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date_safe(if_modified_since)
+        return since is not None and last_modified <= since
+    return False
 
-    if start >= file_size:
-        raise ValueError(f"Range start {start} exceeds file size {file_size}")
 
-    # 将 end 限制在 file_size - 1
-    end = min(end, file_size - 1)
+def immutable_cache_control() -> str:
+    return f"private, max-age={_attachment_settings().get('BROWSER_CACHE_MAX_AGE', 31536000)}, immutable"
+
+
+def set_cache_headers(resp, etag: str, last_modified: Optional[int], max_age: Optional[int] = None) -> None:
+    """
+    写入校验头和缓存策略
+
+    附件内容不可变，默认长期缓存并标记 immutable；附件可能是私有的，只允许浏览器缓存。
+    max_age 用于 S3 重定向：签名 URL 会过期，重定向只能缓存到 URL 失效前
+    """
+    resp['ETag'] = etag
+    if last_modified is not None:
+        resp['Last-Modified'] = http_date(last_modified)
+    if max_age is None:
+        resp['Cache-Control'] = immutable_cache_control()
+    else:
+        resp['Cache-Control'] = f'private, max-age={max_age}' if max_age else 'no-store'
+
+
+def if_range_matches(request, etag: str, last_modified: Optional[int] = None) -> bool:
+    """
+    校验 If-Range 请求头（RFC 7233 3.2）
+
+    If-Range 可以是 ETag 或 HTTP 日期；与当前资源不匹配时应忽略 Range，返回完整文件。
+    ETag 必须强匹配，弱 ETag（W/ 开头）一律视为不匹配。
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    if last_modified is None:
+        return False
+    return parse_http_date_safe(if_range) == last_modified
+
+
+class MultipartByteRanges:
+    """
+    流式输出 multipart/byteranges 响应体
+
+    每段依次 seek 后按块读取，不会把整段内容读入内存；迭代结束或响应关闭时关闭文件。
+    read_range(start, end) 用于从其他来源（如 S3 转发）按块读取一段，传入时不打开 file_path。
+    """
 
-    return (start, end)
+    def __init__(
+        self, file_path: Optional[str], ranges: List[Tuple[int, int]], file_size: int, content_type: str,
+        read_range: Optional[Callable[[int, int], Iterator[bytes]]] = None,
+    ):
+        self.file_path = file_path
+        self.ranges = ranges
+        self.read_range = read_range or self._read_file_range
+        self.boundary = secrets.token_hex(16)
+        self.headers = [
+            (
+                f'\r\n--{self.boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n'
+            ).encode('latin-1')
+            for start, end in ranges
+        ]
+        self.trailer = f'\r\n--{self.boundary}--\r\n'.encode('latin-1')
+        self._file = None
+        self._part = None
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/byteranges; boundary={self.boundary}'
+
+    @property
+    def content_length(self) -> int:
+        body = sum(end - start + 1 for start, end in self.ranges)
+        return body + sum(len(h) for h in self.headers) + len(self.trailer)
+
+    def _read_file_range(self, start: int, end: int) -> Iterator[bytes]:
+        if self._file is None:
+            self._file = open(self.file_path, 'rb')
+        self._file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = self._file.read(min(MULTIPART_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        try:
+            for (start, end), header in zip(self.ranges, self.headers):
+                yield header
+                self._part = iter(self.read_range(start, end))
+                yield from self._part
+                self._part = None
+            yield self.trailer
+        finally:
+            self.close()
+
+    def close(self):
+        if self._part is not None:
+            close = getattr(self._part, 'close', None)
+            if close is not None:
+                close()
+            self._part = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 
 class AttachmentViewSet(BaseAttachmentViewSet):
@@ -84,7 +319,25 @@ class AttachmentViewSet(BaseAttachmentViewSet):
     
     重写存储引擎方法，在上传和读取/预览时自动使用用户的 S3 配置
     """
-    
+
+    serializer_class = AttachmentSerializer
+
+    # 需要登录才能调用的自定义 action（父类只对 create 要求登录）
+    authenticated_actions = {'presign', 'confirm', 'preflight', 'batch'}
+
+    def get_permissions(self):
+        permissions = super().get_permissions()
+        if self.action in self.authenticated_actions:
+            permissions.append(IsAuthenticated())
+        return permissions
+
+    def handle_exception(self, exc):
+        # 用户存储熔断时快速返回 503，而不是等待连接超时
+        unavailable = find_storage_unavailable(exc)
+        if unavailable is not None:
+            return Response({'detail': str(unavailable)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return super().handle_exception(exc)
+
     def get_storage_engine(self, storage_config_id=None):
         """根据 config_id 获取存储引擎（用于读取/预览/下载）"""
         if storage_config_id:
@@ -96,52 +349,40 @@ class AttachmentViewSet(BaseAttachmentViewSet):
         return super().get_storage_engine(storage_config_id)
     
     def get_storage_engine_for_upload(self, storage_config_id: Optional[str] = None) -> Tuple[BaseStorageEngine, Optional[str]]:
-        """根据 config_id 创建存储引擎（用于上传）"""
+        """根据 config_id 创建存储引擎（用于上传），只能写入当前用户自己的存储配置"""
         if storage_config_id:
             # 创建用户特定的 S3 Storage Backend
-            engine = self._create_user_storage_engine(storage_config_id)
+            engine = self._create_user_storage_engine(storage_config_id, user=self.request.user)
             if engine:
                 return engine, storage_config_id
         
-        # 退回到默认存储
-        return super().get_storage_engine_for_upload(storage_config_id)
+        # 退回到默认存储（不把其他用户的 config_id 交给默认的配置提供者）
+        return super().get_storage_engine_for_upload(None)
     
-    def _create_user_storage_engine(self, config_id: str) -> Optional[DjangoStorageEngine]:
-        """根据用户配置创建 Storage Engine"""
+    def _create_user_storage_engine(self, config_id: str, user=None) -> Optional[DjangoStorageEngine]:
+        """
+        根据用户配置创建 Storage Engine
+
+        传入 user 时只使用该用户自己的配置（上传），读取已有附件时按附件记录的配置创建
+        """
         try:
             from .models import UserStorageSettings
-            from storages.backends.s3boto3 import S3Boto3Storage
+            from .storage import UserS3Storage
             
-            settings_obj = UserStorageSettings.objects.filter(
+            queryset = UserStorageSettings.objects.filter(
                 id=config_id,
                 is_active=True
-            ).first()
+            )
+            if user is not None:
+                queryset = queryset.filter(user=user)
+            settings_obj = queryset.first()
             
             if not settings_obj or not settings_obj.is_s3_configured():
                 logger.warning(f"配置 ID {config_id} 不存在或未配置完整")
                 return None
             
-            config = settings_obj.get_s3_config()
-            
-            # 创建 S3 Storage Backend
-            storage_kwargs = {
-                'access_key': config['access_key_id'],
-                'secret_key': config['secret_access_key'],
-                'bucket_name': config['bucket_name'],
-                'region_name': config.get('region_name', 'us-east-1'),
-                'default_acl': 'private',
-                'file_overwrite': False,
-                'querystring_auth': True,
-                'querystring_expire': 3600,
-            }
-            
-            if config.get('endpoint_url'):
-                storage_kwargs['endpoint_url'] = config['endpoint_url']
-            
-            if config.get('custom_domain'):
-                storage_kwargs['custom_domain'] = config['custom_domain']
-            
-            s3_storage = S3Boto3Storage(**storage_kwargs)
+            # 创建 S3 Storage Backend（带超时与熔断）
+            s3_storage = UserS3Storage(user_settings=settings_obj)
             logger.info(f"为配置 ID {config_id} 创建 S3 Storage Engine")
             
             return DjangoStorageEngine(s3_storage)
@@ -164,30 +405,188 @@ class AttachmentViewSet(BaseAttachmentViewSet):
             storage_config_id = self._get_user_storage_config_id(request.user)
             logger.info(f"自动为用户 {request.user.username} 使用配置 ID: {storage_config_id}")
         
-        content = uploaded_file.read()
         original_name = uploaded_file.name
+        uploaded_file.seek(0)
+        mime_type = detect_mime_type(uploaded_file.read(8192), original_name)
+
+        # 开启上传压缩时先缩小并重新编码图片，之后的哈希、配额和存储都按压缩后的内容计算
+        original_size = None
+        optimized_file = optimize_uploaded_image(uploaded_file, mime_type)
+        if optimized_file is not None:
+            original_size = uploaded_file.size
+            uploaded_file = optimized_file
+
+        # 流式计算内容哈希，同一存储中已有相同内容时直接复用，不再写入
+        content_hash = compute_content_hash(uploaded_file.chunks())
+
+        def save_content(storage_path):
+            return write_blob(storage, storage_path, uploaded_file, mime_type)
 
         # 使用获取到的 config_id 调用父类方法
         storage, actual_config_id = self.get_storage_engine_for_upload(storage_config_id)
-        result = storage.save_file(content, original_name)
+        try:
+            check_quota(request.user.id, actual_config_id, uploaded_file.size)
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        # 引用计数和附件记录在同一事务中提交，登记失败时引用一起回滚
+        with transaction.atomic():
+            blob, created = BlobStorageService(storage, actual_config_id).acquire(
+                content_hash, original_name, save_content,
+            )
+            attachment = self._register_attachment(
+                request, storage, actual_config_id, blob, created,
+                original_name=original_name,
+                mime_type=mime_type,
+                is_public=is_public,
+                content_hash=content_hash,
+                original_size=original_size,
+            )
+        output_serializer = AttachmentSerializer(attachment, context={'request': request})
+        return Response(output_serializer.data, status=status.HTTP_201_CREATED)
 
-        from .models import Attachment
+    def _register_attachment(
+        self, request, storage, storage_config_id, blob, created: bool, **fields,
+    ) -> Attachment:
+        """
+        为已写入（或命中）的 blob 创建附件记录，并记录用量、发布公开副本、安排媒体处理
+
+        需要和 blob 的 acquire 放在同一个 transaction.atomic() 中调用；
+        created=False 表示复用了已有内容，直接沿用共享文件已生成的媒体信息
+        """
         from chewy_attachment.core.utils import generate_uuid
-        
+
         attachment = Attachment.objects.create(
             id=generate_uuid(),
-            original_name=original_name,
-            storage_path=result.storage_path,
-            mime_type=result.mime_type,
-            size=result.size,
+            storage_path=blob.storage_path,
+            size=blob.size,
             owner_id=str(request.user.id),
-            is_public=is_public,
-            storage_config_id=actual_config_id,
+            storage_config_id=storage_config_id,
+            **fields,
         )
+        record_attachment_added(attachment)
+        try_publish_attachment(attachment, storage)
+        if created:
+            schedule_media_processing(attachment)
+        else:
+            logger.info(f"命中已有内容，跳过写入: {blob.storage_path}")
+            # 共享文件的缩略图等媒体信息直接复用，没有时再排队处理
+            attachment.media_info = shared_media_info(attachment)
+            if attachment.media_info:
+                attachment.save(update_fields=['media_info'])
+            else:
+                schedule_media_processing(attachment)
+        return attachment
+
+    @action(detail=False, methods=["post"], url_path="batch")
+    def batch(self, request):
+        """
+        多文件批量上传
 
-        from chewy_attachment.django_app.serializers import AttachmentSerializer
+        请求体（multipart）: 多个 files 字段, is_public, storage_config_id（可选）
+        文件在线程池中并发写入存储，附件记录一次批量插入。
+        返回 {results: [...]}，顺序与上传的文件一致，每项为 {status: 201, attachment} 或 {status, name, detail}；
+        全部成功时为 201，部分失败时为 207
+        """
+        from .batch_upload import BatchUploadService, batch_max_files
+
+        files = request.FILES.getlist('files')
+        if not files:
+            return Response({'detail': '没有上传文件'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(files) > batch_max_files():
+            return Response(
+                {'detail': f'一次最多上传 {batch_max_files()} 个文件'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        is_public = str(request.data.get('is_public', 'false')).lower() in ('true', '1')
+        storage_config_id = request.data.get('storage_config_id') or self._get_user_storage_config_id(request.user)
+        storage, actual_config_id = self.get_storage_engine_for_upload(storage_config_id)
+
+        results = BatchUploadService(request.user, storage, actual_config_id).upload(files, is_public=is_public)
+        for item in results:
+            if 'attachment' in item:
+                item['attachment'] = AttachmentSerializer(item['attachment'], context={'request': request}).data
+        all_created = all(item['status'] == status.HTTP_201_CREATED for item in results)
+        return Response(
+            {'results': results},
+            status=status.HTTP_201_CREATED if all_created else status.HTTP_207_MULTI_STATUS,
+        )
+
+    @action(detail=False, methods=["post"], url_path="preflight")
+    def preflight(self, request):
+        """
+        上传前的哈希预检
+
+        请求体: content_hash（SHA-256 十六进制）, size, original_name, is_public, storage_config_id（可选）
+        当前用户在同一存储中已有相同内容的附件时，直接登记新附件并返回 201 {exists: true, attachment}，
+        客户端不需要再传输文件；否则返回 200 {exists: false}，客户端继续普通上传。
+
+        只匹配当前用户自己上传过的内容，知道哈希不能取得其他用户的文件；
+        开启上传压缩时图片按压缩后的内容记录哈希，原图哈希不会命中
+        """
+        content_hash = str(request.data.get('content_hash') or '').lower()
+        if len(content_hash) != 64 or any(c not in '0123456789abcdef' for c in content_hash):
+            return Response({'detail': '内容哈希无效'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            size = int(request.data.get('size') or 0)
+        except (TypeError, ValueError):
+            size = 0
+        if size <= 0:
+            return Response({'detail': '文件大小无效'}, status=status.HTTP_400_BAD_REQUEST)
+        original_name = safe_filename(request.data.get('original_name') or 'upload')
+        allowed_extensions = _attachment_settings().get('ALLOWED_EXTENSIONS')
+        file_ext = os.path.splitext(original_name)[1].lower()
+        if allowed_extensions and file_ext not in allowed_extensions:
+            return Response({'detail': f"File extension '{file_ext}' is not allowed"}, status=status.HTTP_400_BAD_REQUEST)
+        is_public = str(request.data.get('is_public', 'false')).lower() in ('true', '1')
+
+        storage_config_id = request.data.get('storage_config_id') or self._get_user_storage_config_id(request.user)
+        storage, actual_config_id = self.get_storage_engine_for_upload(storage_config_id)
+
+        owned = Attachment.objects.filter(
+            owner_id=str(request.user.id), content_hash=content_hash, size=size,
+        )
+        owned = owned.filter(storage_config_id=actual_config_id) if actual_config_id else owned.filter(
+            Q(storage_config_id__isnull=True) | Q(storage_config_id=''),
+        )
+        existing = owned.only('mime_type').first()
+        if existing is None:
+            return Response({'exists': False})
+
+        try:
+            check_quota(request.user.id, actual_config_id, size)
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        with transaction.atomic():
+            blob = BlobStorageService(storage, actual_config_id).acquire_existing(content_hash, size)
+            if blob is None:
+                # 文件已丢失，需要客户端重新上传
+                return Response({'exists': False})
+
+            attachment = self._register_attachment(
+                request, storage, actual_config_id, blob, False,
+                original_name=original_name,
+                mime_type=existing.mime_type,
+                is_public=is_public,
+                content_hash=content_hash,
+            )
         output_serializer = AttachmentSerializer(attachment, context={'request': request})
-        return Response(output_serializer.data, status=status.HTTP_201_CREATED)
+        return Response({'exists': True, 'attachment': output_serializer.data}, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, *args, **kwargs):
+        """
+        删除附件，同时删除生成的缩略图
+
+        去重存储的附件只减少引用计数，最后一个引用删除时才删除文件
+        """
+        instance = self.get_object()
+
+        storage = self.get_storage_engine(instance.storage_config_id)
+        with transaction.atomic():
+            # 引用计数和附件记录一起提交，文件在提交后删除
+            release_attachment_files(instance, storage)
+            instance.delete()
+            record_attachment_removed(instance)
+        return Response(status=status.HTTP_204_NO_CONTENT)
     
     def _get_user_storage_config_id(self, user):
         """获取用户的存储配置 ID"""
@@ -205,86 +604,407 @@ class AttachmentViewSet(BaseAttachmentViewSet):
         
         except Exception as e:
             logger.warning(f"获取用户存储配置失败: {e}")
-        
+
         return None
 
-    @action(detail=True, methods=["get"], url_path="preview")
-    def preview(self, request, pk=None):
+    def _get_direct_upload_service(self, request, storage_config_id=None):
+        """获取当前用户可用于直传的 S3 配置对应的直传服务"""
+        from .models import UserStorageSettings
+        from .direct_upload import DirectUploadService
+
+        queryset = UserStorageSettings.objects.filter(user=request.user, storage_type='s3')
+        if storage_config_id:
+            settings_obj = queryset.filter(id=storage_config_id).first()
+        else:
+            settings_obj = queryset.filter(is_active=True).first()
+
+        if not settings_obj or not settings_obj.is_s3_configured():
+            return None
+        return DirectUploadService(request.user, settings_obj)
+
+    @action(detail=False, methods=["post"], url_path="presign")
+    def presign(self, request):
         """
-        预览文件，支持 HTTP Range 请求
+        签发 S3 直传地址
 
-        - 无 Range 头: 返回 200 + 完整文件（原有行为）+ Accept-Ranges: bytes
-        - 有 Range 头 (本地存储): 返回 206 + 部分内容
-        - 有 Range 头 (S3 存储): 302 重定向到签名 URL（S3 原生支持 Range）
-        - Range 格式错误或超出范围: 返回 416 Range Not Satisfiable
+        请求体: original_name, size, content_type, is_public, storage_config_id（可选）
+        - 小文件返回预签名 POST（url + fields）
+        - 大文件返回分片上传地址列表
+        未启用 S3 存储时返回 400，客户端应退回普通上传
         """
-        range_header = request.META.get('HTTP_RANGE')
+        from .direct_upload import DirectUploadError
 
-        if not range_header:
-            # 无 Range 头：使用原有行为，添加 Accept-Ranges 头
-            response = super().preview(request, pk)
-            response['Accept-Ranges'] = 'bytes'
-            return response
+        try:
+            size = int(request.data.get('size') or 0)
+        except (TypeError, ValueError):
+            return Response({'detail': '文件大小无效'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # 有 Range 头 — 需要处理
-        instance = self.get_object()
+        try:
+            service = self._get_direct_upload_service(request, request.data.get('storage_config_id'))
+            if service is None:
+                return Response(
+                    {'detail': '当前未启用 S3 存储，请使用普通上传'},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            result = service.create_upload(
+                original_name=request.data.get('original_name', ''),
+                size=size,
+                content_type=request.data.get('content_type'),
+                is_public=str(request.data.get('is_public', 'false')).lower() in ('true', '1'),
+            )
+        except QuotaExceeded as e:
+            return Response({'detail': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except DirectUploadError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            logger.error(f"签发直传地址失败: {e}", exc_info=True)
+            return Response({'detail': f'签发直传地址失败: {e}'}, status=status.HTTP_502_BAD_GATEWAY)
 
-        # 权限检查（与父类一致）
-        from chewy_attachment.django_app.views import get_attachment_model
-        from chewy_attachment.core.permissions import PermissionChecker
+        return Response(result)
 
-        user_context = get_attachment_model().get_user_context(request)
-        file_metadata = instance.to_file_metadata()
-        if not PermissionChecker.can_download(file_metadata, user_context):
-            return Response(
-                {"detail": "You do not have permission to preview this file"},
-                status=status.HTTP_403_FORBIDDEN,
+    @action(detail=False, methods=["post"], url_path="confirm")
+    def confirm(self, request):
+        """
+        确认直传完成，HEAD 校验对象后创建附件记录
+
+        请求体: upload_token，分片上传时还需 parts: [{part_number, etag}]
+        """
+        from .direct_upload import DirectUploadService, DirectUploadError
+
+        upload_token = request.data.get('upload_token')
+        if not upload_token:
+            return Response({'detail': '缺少上传凭证'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            payload = DirectUploadService.load_token(upload_token, request.user)
+            service = self._get_direct_upload_service(request, payload['config_id'])
+            if service is None:
+                return Response({'detail': '存储配置不存在'}, status=status.HTTP_400_BAD_REQUEST)
+            attachment = service.confirm_upload(payload, parts=request.data.get('parts'))
+        except DirectUploadError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        schedule_media_processing(attachment)
+
+        output_serializer = AttachmentSerializer(attachment, context={'request': request})
+        return Response(output_serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=["post"], url_path="resolve")
+    def resolve(self, request):
+        """
+        批量解析附件访问地址（时间线一页的附件一次请求拿到）
+
+        请求体: ids: [附件 ID, ...]（最多 RESOLVE_MAX_IDS 个）
+        返回: results: {id: {url, mime_type, size, media_info, derivatives: {宽度: url}, expires_in}}，
+        missing: 不存在或无权访问的 ID
+        - 云存储: url 和缩略图地址为签名 URL（按时间桶缓存），expires_in 为建议的缓存秒数
+        - 本地存储: url 为 preview 地址，缩略图为 preview?size=<宽度>
+        """
+        ids = request.data.get('ids')
+        if not isinstance(ids, list):
+            return Response({'detail': 'ids 必须是列表'}, status=status.HTTP_400_BAD_REQUEST)
+        max_ids = _attachment_settings().get('RESOLVE_MAX_IDS', 200)
+        if len(ids) > max_ids:
+            return Response({'detail': f'一次最多解析 {max_ids} 个附件'}, status=status.HTTP_400_BAD_REQUEST)
+
+        valid_ids = set()
+        for attachment_id in ids:
+            try:
+                valid_ids.add(uuid.UUID(str(attachment_id)))
+            except ValueError:
+                continue
+
+        # 一次查询，权限范围与 get_queryset 一致（自己的 + 公开的）
+        attachments = self.get_queryset().filter(id__in=valid_ids)
+        engines = {}
+        results = {}
+        for instance in attachments:
+            config_key = instance.storage_config_id or None
+            if config_key not in engines:
+                try:
+                    engines[config_key] = self.get_storage_engine(config_key)
+                except Exception as e:
+                    logger.warning(f"获取存储引擎失败 (config_id={config_key}): {e}")
+                    engines[config_key] = None
+            storage = engines[config_key]
+            if storage is None:
+                continue
+            try:
+                results[str(instance.id)] = self._resolve_attachment(request, instance, storage)
+            except Exception as e:
+                logger.warning(f"解析附件地址失败 ({instance.id}): {e}")
+
+        missing = [str(attachment_id) for attachment_id in ids if str(attachment_id) not in results]
+        return Response({'results': results, 'missing': missing})
+
+    def _resolve_attachment(self, request, instance, storage) -> dict:
+        """生成单个附件的访问地址和缩略图地址"""
+        media_info = {k: v for k, v in (instance.media_info or {}).items() if k != 'derivatives'}
+        derivatives = (instance.media_info or {}).get('derivatives') or {}
+        item = {
+            'mime_type': instance.mime_type,
+            'size': instance.size,
+            'media_info': media_info,
+            'derivatives': {},
+        }
+
+        if is_cloud_storage_engine(storage) and not proxy_downloads_enabled(storage):
+            item['url'], item['expires_in'] = get_cached_file_url(
+                storage, instance.storage_config_id, instance.storage_path,
             )
+            for width, variant in derivatives.items():
+                item['derivatives'][width] = get_cached_file_url(
+                    storage, instance.storage_config_id, variant['path'],
+                )[0]
+            return item
+
+        preview_url = reverse('attachment-preview', kwargs={'pk': instance.id}, request=request)
+        item['url'] = preview_url
+        if is_processable_image(instance):
+            # 本地存储的缩略图按需生成，直接给出所有档位
+            image = media_info.get('image') or {}
+            for width in derivative_widths():
+                if image and width >= image.get('width', 0):
+                    break
+                item['derivatives'][str(width)] = f"{preview_url}?size={width}"
+        return item
+
+    def _serve_file(self, instance, disposition: str, variant: Optional[dict] = None, storage=None):
+        """
+        输出文件内容（download 与 preview 共用）
 
-        storage = self.get_storage_engine(instance.storage_config_id)
+        云存储重定向到签名 URL（按时间桶缓存，桶内 URL 完全相同）；开启磁盘缓存时先从本地缓存输出，
+        开启服务器转发时由 _serve_proxied_file 从 S3 读取后流式输出。
+        本地存储走 _serve_local_file，由 WSGI 服务器 sendfile 或 nginx X-Accel-Redirect 完成字节传输。
+        variant 为 media_info 中的缩略图信息，传入时输出缩略图而不是原文件
 
-        # S3/云存储：重定向（S3 原生支持 Range）
-        if hasattr(storage, 'get_file_url') and hasattr(storage, 'storage') and hasattr(storage.storage, 'url'):
-            file_url = storage.get_file_url(instance.storage_path)
-            return HttpResponseRedirect(file_url)
-        elif hasattr(storage, 's3_client'):
-            file_url = storage.get_file_url(instance.storage_path)
-            return HttpResponseRedirect(file_url)
+        客户端携带的 If-None-Match / If-Modified-Since 仍然有效时直接返回 304，不访问存储
+        """
+        etag = attachment_etag(instance, variant)
+        last_modified = attachment_last_modified(instance)
+        if is_not_modified(self.request, etag, last_modified):
+            resp = HttpResponseNotModified()
+            set_cache_headers(resp, etag, last_modified)
+            return resp
+
+        storage = storage or self.get_storage_engine(instance.storage_config_id)
+        storage_path = variant['path'] if variant else instance.storage_path
+
+        if is_cloud_storage_engine(storage):
+            cached = self._serve_cached_file(instance, storage, storage_path, disposition, variant)
+            if cached is not None:
+                return cached
+            if proxy_downloads_enabled(storage):
+                return self._serve_proxied_file(instance, storage, storage_path, disposition, variant)
+            try:
+                url, ttl = get_cached_file_url(storage, instance.storage_config_id, storage_path)
+                resp = HttpResponseRedirect(url)
+                # 桶内 URL 不变，允许浏览器缓存这次重定向
+                set_cache_headers(resp, etag, last_modified, max_age=ttl)
+                return resp
+            except Exception:
+                logger.exception("生成文件 URL 失败: %s", storage_path)
+                raise Http404("File not found on storage")
 
-        # 本地存储：处理 Range 请求
         try:
-            file_path = storage.get_file_path(instance.storage_path)
+            file_path = storage.get_file_path(storage_path)
         except Exception:
             raise Http404("File not found on storage")
 
-        file_size = os.path.getsize(file_path)
+        return self._serve_local_file(self.request, instance, file_path, disposition, variant)
 
+    def _serve_cached_file(self, instance, storage, storage_path: str, disposition: str, variant: Optional[dict] = None):
+        """从本地磁盘缓存输出 S3 对象；未开启缓存、对象过大或回源失败时返回 None"""
+        disk_cache = get_disk_cache()
+        if disk_cache is None:
+            return None
+        size = variant.get('size') if variant else instance.size
+        file_path = disk_cache.fetch(instance.storage_config_id, storage, storage_path, size)
+        if file_path is None:
+            return None
+        accel_prefix = _attachment_settings().get('S3_DISK_CACHE_X_ACCEL_PREFIX')
+        accel_uri = ''
+        if accel_prefix:
+            relative = disk_cache.relative_path(instance.storage_config_id, storage, storage_path)
+            accel_uri = accel_prefix.rstrip('/') + '/' + quote(relative)
         try:
-            parsed = parse_range_header(range_header, file_size)
+            return self._serve_local_file(self.request, instance, file_path, disposition, variant, accel_uri=accel_uri)
+        except FileNotFoundError:
+            # fetch 返回后缓存文件被其他线程或 worker 淘汰，退回转发或重定向
+            logger.info(f"附件缓存文件已被淘汰: {storage_path}")
+            return None
+
+    def _serve_proxied_file(self, instance, storage, storage_path: str, disposition: str, variant: Optional[dict] = None):
+        """
+        服务器转发 S3 对象，Range 转成 GetObject 的 Range
+
+        - 单段: 一次 GetObject 请求对应的字节范围，返回 206
+        - 多段: 逐段请求，拼成 multipart/byteranges
+        响应体都按块流式输出，响应关闭时关闭上游连接
+        """
+        _, mime_type, content_disposition = self._file_headers(instance, variant, disposition)
+        file_size = variant['size'] if variant else instance.size
+        etag = attachment_etag(instance, variant)
+        last_modified = attachment_last_modified(instance)
+
+        ranges, error = self._requested_ranges(self.request, instance, file_size, etag, last_modified)
+        if error is not None:
+            return error
+
+        try:
+            if not ranges:
+                body = open_s3_object(storage, storage_path)
+                resp = StreamingHttpResponse(body, content_type=mime_type)
+                resp['Content-Length'] = body.content_length
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                body = open_s3_object(storage, storage_path, start, end)
+                resp = StreamingHttpResponse(body, status=206, content_type=mime_type)
+                resp['Content-Range'] = body.content_range or f'bytes {start}-{end}/{file_size}'
+                resp['Content-Length'] = body.content_length
+            else:
+                body = MultipartByteRanges(
+                    None, ranges, file_size, mime_type,
+                    read_range=lambda start, end: iter_s3_range(storage, storage_path, start, end),
+                )
+                resp = StreamingHttpResponse(body, status=206, content_type=body.content_type)
+                resp['Content-Length'] = body.content_length
+        except S3ObjectNotFound:
+            raise Http404("File not found on storage")
+
+        resp['Accept-Ranges'] = 'bytes'
+        set_cache_headers(resp, etag, last_modified)
+        resp['Content-Disposition'] = content_disposition
+        return resp
+
+    @staticmethod
+    def _file_headers(instance, variant: Optional[dict], disposition: str) -> Tuple[str, str, str]:
+        """返回 (存储路径, MIME 类型, Content-Disposition)，variant 为缩略图时使用缩略图的路径和类型"""
+        if variant:
+            storage_path, mime_type = variant['path'], variant['mime_type']
+            filename = os.path.splitext(instance.original_name)[0] + os.path.splitext(storage_path)[1]
+        else:
+            storage_path, mime_type, filename = instance.storage_path, instance.mime_type, instance.original_name
+        return storage_path, mime_type, f'{disposition}; filename="{filename}"'
+
+    @staticmethod
+    def _requested_ranges(
+        request, instance, file_size: int, etag: str, last_modified: Optional[int],
+    ) -> Tuple[Optional[List[Tuple[int, int]]], Optional[HttpResponse]]:
+        """
+        解析请求的 Range
+
+        Returns:
+            (ranges, error)：ranges 为 None 表示返回完整文件；Range 不可满足时 error 为 416 响应
+        """
+        range_header = request.META.get('HTTP_RANGE')
+
+        # If-Range 不匹配说明客户端缓存的是旧版本，忽略 Range 返回完整文件
+        if not range_header or not if_range_matches(request, etag, last_modified):
+            return None, None
+
+        try:
+            ranges = parse_range_header(range_header, file_size)
         except ValueError:
             # Range 超出文件大小
+            ranges = None
+        if ranges is None:
             resp = HttpResponse(status=416)
             resp['Content-Range'] = f'bytes */{file_size}'
             resp['Accept-Ranges'] = 'bytes'
-            return resp
+            return None, resp
+        max_parts = _attachment_settings().get('MAX_RANGE_PARTS', 16)
+        if len(ranges) > max_parts:
+            logger.info(f"Range 段数过多 ({len(ranges)} > {max_parts})，返回完整文件: {instance.id}")
+            return None, None
+        return ranges, None
+
+    def _serve_local_file(
+        self, request, instance, file_path, disposition: str, variant: Optional[dict] = None,
+        accel_uri: Optional[str] = None,
+    ):
+        """
+        零拷贝输出本地文件，支持 Range 请求
 
-        if parsed is None:
-            # 格式不合法
-            resp = HttpResponse(status=416)
-            resp['Content-Range'] = f'bytes */{file_size}'
-            resp['Accept-Ranges'] = 'bytes'
-            return resp
+        - 配置了 X_ACCEL_REDIRECT_PREFIX: 只返回 X-Accel-Redirect 头，
+          由 nginx 直接读取文件并处理 Range，Python worker 立即释放
+        - 否则: 返回 FileResponse，gunicorn 通过 wsgi.file_wrapper 调用 os.sendfile；
+          Range 请求把文件定位到起始位置并用 RangeFileWrapper 限定长度
 
-        start, end = parsed
-        content_length = end - start + 1
+        accel_uri 为 None 时按 X_ACCEL_REDIRECT_PREFIX 和存储路径生成，空字符串表示不使用 X-Accel-Redirect
+        """
+        storage_path, mime_type, content_disposition = self._file_headers(instance, variant, disposition)
+
+        if accel_uri is None:
+            accel_prefix = _attachment_settings().get('X_ACCEL_REDIRECT_PREFIX')
+            accel_uri = accel_prefix.rstrip('/') + '/' + quote(storage_path) if accel_prefix else ''
+        if accel_uri:
+            resp = HttpResponse(content_type=mime_type)
+            resp['X-Accel-Redirect'] = accel_uri
+            resp['Content-Disposition'] = content_disposition
+            # nginx 会保留上游的 Cache-Control，ETag 与 Last-Modified 由 nginx 按文件生成
+            resp['Cache-Control'] = immutable_cache_control()
+            return resp
 
-        with open(file_path, 'rb') as f:
+        file_size = os.path.getsize(file_path)
+        etag = attachment_etag(instance, variant)
+        last_modified = attachment_last_modified(instance)
+
+        ranges, error = self._requested_ranges(request, instance, file_size, etag, last_modified)
+        if error is not None:
+            return error
+
+        if not ranges:
+            resp = FileResponse(open(file_path, 'rb'), content_type=mime_type)
+            resp['Content-Length'] = file_size
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            content_length = end - start + 1
+            f = open(file_path, 'rb')
             f.seek(start)
-            data = f.read(content_length)
+            resp = FileResponse(
+                RangeFileWrapper(f, content_length),
+                status=206,
+                content_type=mime_type,
+            )
+            resp['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+            resp['Content-Length'] = content_length
+        else:
+            body = MultipartByteRanges(file_path, ranges, file_size, mime_type)
+            resp = StreamingHttpResponse(body, status=206, content_type=body.content_type)
+            resp['Content-Length'] = body.content_length
 
-        resp = HttpResponse(data, status=206, content_type=instance.mime_type)
-        resp['Content-Range'] = f'bytes {start}-{end}/{file_size}'
-        resp['Content-Length'] = content_length
         resp['Accept-Ranges'] = 'bytes'
-        resp['Content-Disposition'] = f'inline; filename="{instance.original_name}"'
+        set_cache_headers(resp, etag, last_modified)
+        resp['Content-Disposition'] = content_disposition
         return resp
+
+    @action(detail=True, methods=["get"], url_path="preview")
+    def preview(self, request, pk=None):
+        """
+        预览文件，支持 HTTP Range 请求
+
+        - 无 Range 头: 返回 200 + 完整文件 + Accept-Ranges: bytes
+        - 有 Range 头 (本地存储): 返回 206 + 部分内容，多段时为 multipart/byteranges
+        - S3 存储: 302 重定向到签名 URL（S3 原生支持 Range）；开启磁盘缓存时从本地缓存输出，
+          开启服务器转发时把 Range 转给 GetObject 并流式返回 206
+        - Range 格式错误或超出范围: 返回 416 Range Not Satisfiable
+        - ?size=<宽度>: 图片返回不小于该宽度的最小一档缩略图，没有合适档位时返回原图
+        """
+        instance = self.get_object()
+
+        # 权限检查（与父类一致）
+        user_context = get_attachment_model().get_user_context(request)
+        file_metadata = instance.to_file_metadata()
+        if not PermissionChecker.can_download(file_metadata, user_context):
+            return Response(
+                {"detail": "You do not have permission to preview this file"},
+                status=status.HTTP_403_FORBIDDEN,
+            )
+
+        size = request.query_params.get('size')
+        if size and size.isdigit() and is_processable_image(instance):
+            storage = self.get_storage_engine(instance.storage_config_id)
+            variant = get_image_derivative(instance, int(size), storage)
+            return self._serve_file(instance, disposition="inline", variant=variant, storage=storage)
+
+        return self._serve_file(instance, disposition="inline")
@@ -0,0 +1,238 @@
+"""
+多文件批量上传
+
+发布框一次选择多张照片时，逐个请求上传要为每个文件重复认证、创建存储引擎。
+批量上传在一个 multipart 请求中接收多个 files 字段：
+
+1. 校验、检测类型、上传压缩和计算哈希在线程池中并行执行
+2. 按顺序检查配额，同一批中相同内容只写一次，存储中已有的内容不再写入
+3. 需要写入的内容在线程池中并发写入存储（S3 共享客户端的连接池支持并发请求）
+4. 依次登记 blob 引用，附件记录一次 bulk_create 写入，用量一次更新（同一事务）
+
+每个文件单独返回结果，部分文件失败不影响其他文件。
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from chewy_attachment.core.storage import BaseStorageEngine
+from chewy_attachment.core.utils import detect_mime_type, generate_uuid
+from chewy_attachment.django_app.serializers import AttachmentUploadSerializer
+
+from .blob_storage import BlobStorageService, cas_storage_path, compute_content_hash, shared_media_info, write_blob
+from .media_processing import optimize_uploaded_image, schedule_media_processing
+from .models import Attachment
+from .public_attachments import try_publish_attachment
+from .storage_usage import QuotaExceeded, adjust_usage, check_quota
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _batch_settings() -> Dict[str, Any]:
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    return {
+        'workers': chewy_settings.get('UPLOAD_WORKERS', 4),
+        'max_files': chewy_settings.get('BATCH_UPLOAD_MAX_FILES', 20),
+    }
+
+
+def batch_max_files() -> int:
+    """一次批量上传最多接受的文件数"""
+    return _batch_settings()['max_files']
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=max(1, _batch_settings()['workers']),
+                    thread_name_prefix='bbtalk-upload',
+                )
+    return _executor
+
+
+@dataclass
+class _PreparedFile:
+    """校验通过并计算好哈希的文件"""
+    index: int
+    file: Any
+    original_name: str
+    mime_type: str
+    content_hash: str
+    original_size: Optional[int] = None
+    write_result: Any = None
+
+
+class BatchUploadService:
+    """把一批文件写入同一个存储"""
+
+    def __init__(self, user, engine: BaseStorageEngine, storage_config_id: Optional[str]):
+        self.user = user
+        self.engine = engine
+        self.storage_config_id = storage_config_id
+        self.blobs = BlobStorageService(engine, storage_config_id)
+
+    def upload(self, files: List[Any], is_public: bool = False) -> List[Dict[str, Any]]:
+        """
+        上传一批文件
+
+        Returns:
+            与 files 顺序一致的结果列表：成功为 {'status': 201, 'attachment': Attachment}，
+            失败为 {'status': 400/413/500, 'name': 文件名, 'detail': 原因}
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(files)
+        executor = _get_executor()
+
+        prepared: List[_PreparedFile] = []
+        for index, future in enumerate([executor.submit(self._prepare, i, f) for i, f in enumerate(files)]):
+            try:
+                prepared.append(future.result())
+            except ValidationError as e:
+                results[index] = self._error(files[index], 400, _validation_message(e))
+            except Exception as e:
+                logger.error(f"批量上传处理文件失败 ({files[index].name}): {e}", exc_info=True)
+                results[index] = self._error(files[index], 500, f'处理文件失败: {e}')
+
+        accepted = self._check_quota(prepared, results)
+        self._write_blobs(accepted, results)
+
+        # blob 引用和附件记录在同一事务中提交，插入失败时引用一起回滚
+        with transaction.atomic():
+            registered = []
+            for item in accepted:
+                if results[item.index] is not None:
+                    continue
+                try:
+                    with transaction.atomic():
+                        blob, created = self.blobs.acquire(
+                            item.content_hash, item.original_name,
+                            lambda storage_path, item=item: self._written(item),
+                        )
+                except Exception as e:
+                    logger.error(f"批量上传登记失败 ({item.original_name}): {e}", exc_info=True)
+                    results[item.index] = self._error(item.file, 500, f'保存文件失败: {e}')
+                    continue
+                registered.append((item, blob, created))
+            attachments = self._create_attachments(registered, is_public)
+
+        for (item, _, _), attachment in zip(registered, attachments):
+            results[item.index] = {'status': 201, 'attachment': attachment}
+        return results
+
+    def _prepare(self, index: int, uploaded_file) -> _PreparedFile:
+        serializer = AttachmentUploadSerializer(data={'file': uploaded_file})
+        serializer.is_valid(raise_exception=True)
+
+        uploaded_file.seek(0)
+        mime_type = detect_mime_type(uploaded_file.read(8192), uploaded_file.name)
+        item = _PreparedFile(index, uploaded_file, uploaded_file.name, mime_type, '')
+        optimized_file = optimize_uploaded_image(uploaded_file, mime_type)
+        if optimized_file is not None:
+            item.original_size = uploaded_file.size
+            item.file = optimized_file
+        item.content_hash = compute_content_hash(item.file.chunks())
+        return item
+
+    def _check_quota(self, prepared: List[_PreparedFile], results) -> List[_PreparedFile]:
+        """按顺序累计大小检查配额，超出后的文件返回 413"""
+        accepted, total = [], 0
+        for item in prepared:
+            try:
+                check_quota(self.user.id, self.storage_config_id, total + item.file.size)
+            except QuotaExceeded as e:
+                results[item.index] = self._error(item.file, 413, str(e))
+                continue
+            total += item.file.size
+            accepted.append(item)
+        return accepted
+
+    def _write_blobs(self, accepted: List[_PreparedFile], results) -> None:
+        """并发写入存储中还没有的内容，同一批中相同内容只写一次"""
+        pending: Dict[str, _PreparedFile] = {}
+        for item in accepted:
+            if item.content_hash not in pending and self.blobs.find(item.content_hash) is None:
+                pending[item.content_hash] = item
+
+        futures = {
+            content_hash: _get_executor().submit(self._save, item)
+            for content_hash, item in pending.items()
+        }
+        for content_hash, future in futures.items():
+            try:
+                pending[content_hash].write_result = future.result()
+            except Exception as e:
+                logger.error(f"批量上传写入存储失败 ({pending[content_hash].original_name}): {e}", exc_info=True)
+                for item in accepted:
+                    if item.content_hash == content_hash:
+                        results[item.index] = self._error(item.file, 500, f'保存文件失败: {e}')
+
+        # 同一批中内容相同的其他文件共用写入结果
+        for item in accepted:
+            if item.write_result is None and item.content_hash in pending:
+                item.write_result = pending[item.content_hash].write_result
+
+    def _save(self, item: _PreparedFile):
+        return write_blob(
+            self.engine, cas_storage_path(item.content_hash, item.original_name), item.file, item.mime_type,
+        )
+
+    def _written(self, item: _PreparedFile):
+        """acquire 需要写入时返回已经并发写好的结果；写入阶段之后才出现缺失时（文件被删）补写一次"""
+        return item.write_result if item.write_result is not None else self._save(item)
+
+    def _create_attachments(self, registered, is_public: bool) -> List[Attachment]:
+        """一次插入所有附件记录，再统一更新用量、发布公开副本和安排媒体处理"""
+        if not registered:
+            return []
+        attachments = [
+            Attachment(
+                id=generate_uuid(),
+                original_name=item.original_name,
+                storage_path=blob.storage_path,
+                mime_type=item.mime_type,
+                size=blob.size,
+                owner_id=str(self.user.id),
+                is_public=is_public,
+                storage_config_id=self.storage_config_id,
+                content_hash=item.content_hash,
+                original_size=item.original_size,
+            )
+            for item, blob, _ in registered
+        ]
+        with transaction.atomic():
+            Attachment.objects.bulk_create(attachments)
+            adjust_usage(self.user.id, self.storage_config_id, len(attachments), sum(a.size for a in attachments))
+
+        for attachment, (_, _, created) in zip(attachments, registered):
+            try_publish_attachment(attachment, self.engine)
+            media_info = {} if created else shared_media_info(attachment)
+            if media_info:
+                attachment.media_info = media_info
+                Attachment.objects.filter(id=attachment.id).update(media_info=media_info)
+            else:
+                schedule_media_processing(attachment)
+        logger.info(f"批量上传 {len(attachments)} 个文件: 用户 {self.user.id}")
+        return attachments
+
+    @staticmethod
+    def _error(uploaded_file, code: int, detail: str) -> Dict[str, Any]:
+        return {'status': code, 'name': getattr(uploaded_file, 'name', ''), 'detail': detail}
+
+
+def _validation_message(error: ValidationError) -> str:
+    detail = error.detail
+    if isinstance(detail, dict):
+        detail = next(iter(detail.values()), '')
+    if isinstance(detail, list):
+        detail = '; '.join(str(item) for item in detail)
+    return str(detail)
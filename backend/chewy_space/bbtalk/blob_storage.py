@@ -0,0 +1,214 @@
+"""
+内容寻址的附件去重存储
+
+上传时流式计算 SHA-256，同一存储配置下相同内容只保存一份（cas/<hash 前两级>/<hash>.<ext>），
+由 StorageBlob 记录引用计数。多个 Attachment 共享同一个存储路径，
+删除附件时引用计数减一，归零后才删除实际文件（以及共享的缩略图）。
+"""
+import hashlib
+import logging
+from typing import Iterable, Optional, Tuple
+
+from django.db import IntegrityError, transaction
+from chewy_attachment.core.schemas import FileUploadResult
+from chewy_attachment.core.storage import BaseStorageEngine
+from chewy_attachment.core.utils import get_file_extension, safe_filename
+
+from .models import Attachment, StorageBlob
+from .storage_io import write_stream
+
+logger = logging.getLogger(__name__)
+
+# 内容寻址文件的存储目录前缀
+CAS_PREFIX = 'cas'
+
+
+def compute_content_hash(chunks: Iterable[bytes]) -> str:
+    """流式计算 SHA-256，不需要一次性读入整个文件"""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cas_storage_path(content_hash: str, original_name: str) -> str:
+    """内容寻址路径：cas/ab/cd/<hash>.<ext>，保留扩展名以便存储端推断 Content-Type"""
+    ext = get_file_extension(safe_filename(original_name or ''))
+    return f"{CAS_PREFIX}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}{ext}"
+
+
+def write_blob(engine: BaseStorageEngine, storage_path: str, uploaded_file, mime_type: str) -> FileUploadResult:
+    """
+    把上传文件流式写入内容寻址路径，不把整个文件读入内存
+
+    本地存储先写临时文件再 os.replace，重复上传相同内容时读者不会读到写了一半的文件
+    """
+    uploaded_file.seek(0)
+    saved_path = write_stream(engine, storage_path, uploaded_file)
+    return FileUploadResult(storage_path=saved_path, size=uploaded_file.size, mime_type=mime_type)
+
+
+def _config_key(storage_config_id: Optional[str]) -> str:
+    """本地存储的 storage_config_id 可能是 None 或空字符串，统一为空字符串"""
+    return str(storage_config_id) if storage_config_id else ''
+
+
+class BlobStorageService:
+    """内容寻址存储服务：按 (存储配置, 内容哈希) 复用文件并维护引用计数"""
+
+    def __init__(self, engine: BaseStorageEngine, storage_config_id: Optional[str]):
+        self.engine = engine
+        self.storage_config_id = _config_key(storage_config_id)
+
+    def find(self, content_hash: str) -> Optional[StorageBlob]:
+        """查找当前配置下已存在且文件仍在的 blob"""
+        blob = StorageBlob.objects.filter(
+            storage_config_id=self.storage_config_id,
+            content_hash=content_hash,
+        ).first()
+        if blob and not self.engine.file_exists(blob.storage_path):
+            logger.warning(f"blob 文件已丢失，将重新写入: {blob.storage_path}")
+            return None
+        return blob
+
+    def acquire_existing(self, content_hash: str, size: int) -> Optional[StorageBlob]:
+        """
+        内容已存在（哈希和大小都一致、文件仍在）时增加一次引用并返回 blob，否则返回 None
+
+        用于哈希预检：客户端只提交哈希，命中时不需要传输文件
+        """
+        if self.find(content_hash) is None:
+            return None
+        with transaction.atomic():
+            blob = StorageBlob.objects.select_for_update().filter(
+                storage_config_id=self.storage_config_id,
+                content_hash=content_hash,
+                size=size,
+            ).first()
+            if blob is None:
+                return None
+            blob.ref_count += 1
+            blob.save(update_fields=['ref_count', 'updated_at'])
+            return blob
+
+    def acquire(self, content_hash: str, original_name: str, save) -> Tuple[StorageBlob, bool]:
+        """
+        获取内容对应的 blob 并增加一次引用
+
+        Args:
+            content_hash: 内容 SHA-256
+            original_name: 原始文件名（用于推断扩展名）
+            save: 把内容写入给定存储路径并返回 FileUploadResult 的回调，只有需要实际写入时才会调用
+
+        Returns:
+            (blob, created)，created=False 表示命中已有内容，没有写入存储
+        """
+        if self.find(content_hash) is not None:
+            with transaction.atomic():
+                blob = StorageBlob.objects.select_for_update().filter(
+                    storage_config_id=self.storage_config_id,
+                    content_hash=content_hash,
+                ).first()
+                if blob is not None:
+                    blob.ref_count += 1
+                    blob.save(update_fields=['ref_count', 'updated_at'])
+                    return blob, False
+
+        result = save(cas_storage_path(content_hash, original_name))
+
+        try:
+            with transaction.atomic():
+                blob, created = StorageBlob.objects.select_for_update().get_or_create(
+                    storage_config_id=self.storage_config_id,
+                    content_hash=content_hash,
+                    defaults={
+                        'storage_path': result.storage_path,
+                        'size': result.size,
+                        'ref_count': 1,
+                    },
+                )
+                if not created:
+                    # 文件丢失后重新写入，或并发上传了相同内容
+                    if not self.engine.file_exists(blob.storage_path):
+                        blob.storage_path = result.storage_path
+                        blob.size = result.size
+                    blob.ref_count += 1
+                    blob.save(update_fields=['storage_path', 'size', 'ref_count', 'updated_at'])
+        except IntegrityError:
+            # 并发创建同一 blob，改为引用对方创建的记录
+            with transaction.atomic():
+                blob = StorageBlob.objects.select_for_update().get(
+                    storage_config_id=self.storage_config_id,
+                    content_hash=content_hash,
+                )
+                blob.ref_count += 1
+                blob.save(update_fields=['ref_count', 'updated_at'])
+            created = False
+
+        if blob.storage_path != result.storage_path:
+            # 存储端生成了不同文件名（如 S3 不覆盖同名文件），删除多写的一份
+            self.engine.delete_file(result.storage_path)
+        return blob, created
+
+    def release(self, content_hash: str) -> Optional[StorageBlob]:
+        """
+        释放一次引用
+
+        Returns:
+            引用计数归零并已删除记录的 blob（调用方负责删除文件）；仍有引用或不存在时返回 None
+        """
+        with transaction.atomic():
+            blob = StorageBlob.objects.select_for_update().filter(
+                storage_config_id=self.storage_config_id,
+                content_hash=content_hash,
+            ).first()
+            if blob is None:
+                return None
+            if blob.ref_count > 1:
+                blob.ref_count -= 1
+                blob.save(update_fields=['ref_count', 'updated_at'])
+                return None
+            blob.delete()
+            return blob
+
+
+def release_attachment_files(attachment: Attachment, engine: BaseStorageEngine) -> bool:
+    """
+    释放附件占用的存储文件（不删除附件记录）
+
+    去重存储的附件只减少引用计数，release() 返回 blob（最后一个引用）时才删除原文件和缩略图；
+    没有内容哈希的旧附件在没有其他附件记录共享该路径时删除。
+    文件在事务提交后删除，和删除附件记录放在同一个 transaction.atomic() 中调用
+
+    Returns:
+        是否删除文件
+    """
+    from .media_processing import delete_image_derivatives
+    from .public_attachments import unpublish_attachment
+
+    if attachment.content_hash:
+        released = BlobStorageService(engine, attachment.storage_config_id).release(attachment.content_hash)
+        delete_files = released is not None
+    else:
+        delete_files = not Attachment.objects.filter(
+            storage_config_id=attachment.storage_config_id,
+            storage_path=attachment.storage_path,
+        ).exclude(id=attachment.id).exists()
+
+    def delete_storage_files():
+        unpublish_attachment(attachment, engine)
+        if delete_files:
+            delete_image_derivatives(attachment, engine)
+            engine.delete_file(attachment.storage_path)
+
+    transaction.on_commit(delete_storage_files)
+    return delete_files
+
+
+def shared_media_info(attachment: Attachment) -> dict:
+    """复用同一存储文件的其他附件已生成的媒体信息（缩略图、音频波形等）"""
+    sibling = Attachment.objects.filter(
+        storage_config_id=attachment.storage_config_id,
+        storage_path=attachment.storage_path,
+    ).exclude(id=attachment.id).exclude(media_info={}).only('media_info').first()
+    return dict(sibling.media_info) if sibling else {}
@@ -0,0 +1,258 @@
+"""
+S3 直传服务
+
+为启用了 S3 配置的用户签发预签名上传地址，客户端直接把文件传到用户自己的存储桶，
+上传完成后再调用确认接口，由后端 HEAD 校验对象后登记 Attachment 记录。
+文件字节不再经过 gunicorn worker。
+"""
+import logging
+import math
+import mimetypes
+import os
+from typing import Optional, Dict, Any, List
+
+from django.conf import settings
+from django.core import signing
+from chewy_attachment.core.storage import DjangoStorageEngine
+from chewy_attachment.core.utils import generate_uuid, safe_filename
+
+from .models import User, Attachment, UserStorageSettings
+from .public_attachments import try_publish_attachment
+from .storage_usage import check_quota, record_attachment_added
+from .storage import UserS3Storage
+
+logger = logging.getLogger(__name__)
+
+# 上传凭证的签名 salt，避免与其他 signing 用途混用
+UPLOAD_TOKEN_SALT = 'bbtalk.direct_upload'
+
+# S3 分片上传要求除最后一片外每片至少 5MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class DirectUploadError(Exception):
+    """直传流程中的业务错误（参数不合法、凭证过期、对象校验失败等）"""
+    pass
+
+
+def _direct_upload_settings() -> Dict[str, Any]:
+    """读取直传相关配置"""
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    return {
+        'max_file_size': chewy_settings.get('MAX_FILE_SIZE', 10 * 1024 * 1024),
+        'allowed_extensions': chewy_settings.get('ALLOWED_EXTENSIONS'),
+        'expires': chewy_settings.get('DIRECT_UPLOAD_EXPIRE', 3600),
+        'multipart_threshold': chewy_settings.get('DIRECT_UPLOAD_MULTIPART_THRESHOLD', 64 * 1024 * 1024),
+        'part_size': max(chewy_settings.get('DIRECT_UPLOAD_PART_SIZE', 8 * 1024 * 1024), MIN_PART_SIZE),
+    }
+
+
+class DirectUploadService:
+    """S3 预签名直传服务"""
+
+    def __init__(self, user: User, settings_obj: UserStorageSettings):
+        if not settings_obj.is_s3_configured():
+            raise DirectUploadError('存储配置不完整，无法直传')
+        self.user = user
+        self.settings_obj = settings_obj
+        self.config = settings_obj.get_s3_config()
+        self.options = _direct_upload_settings()
+        self._storage = UserS3Storage(user_settings=settings_obj)
+
+    @property
+    def client(self):
+        return self._storage.connection.meta.client
+
+    @property
+    def bucket(self) -> str:
+        return self.config['bucket_name']
+
+    def _validate_file(self, original_name: str, size: int):
+        """与普通上传保持一致的大小和扩展名校验"""
+        if size <= 0:
+            raise DirectUploadError('文件大小无效')
+        max_size = self.options['max_file_size']
+        if size > max_size:
+            raise DirectUploadError(
+                f'File size ({size} bytes) exceeds maximum allowed size ({max_size} bytes)'
+            )
+        allowed_extensions = self.options['allowed_extensions']
+        if allowed_extensions:
+            file_ext = os.path.splitext(original_name)[1].lower()
+            if file_ext not in allowed_extensions:
+                raise DirectUploadError(f"File extension '{file_ext}' is not allowed")
+
+    def create_upload(
+        self,
+        original_name: str,
+        size: int,
+        content_type: Optional[str] = None,
+        is_public: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        签发直传地址
+
+        小文件返回预签名 POST（带 content-length-range 限制），
+        超过分片阈值的文件返回分片上传 ID 和每个分片的预签名 PUT 地址。
+        超过存储配额时抛出 QuotaExceeded。
+        """
+        original_name = safe_filename(original_name or 'upload')
+        self._validate_file(original_name, size)
+        check_quota(self.user.id, self.settings_obj.id, size)
+        content_type = content_type or mimetypes.guess_type(original_name)[0] or 'application/octet-stream'
+
+        # 与 DjangoStorageEngine 保持相同的 YYYY/MM/DD/<uuid>.<ext> 路径规则
+        storage_path = DjangoStorageEngine(self._storage)._generate_storage_path(original_name)
+        expires = self.options['expires']
+
+        token_payload = {
+            'user_id': self.user.id,
+            'config_id': self.settings_obj.id,
+            'storage_path': storage_path,
+            'original_name': original_name,
+            'content_type': content_type,
+            'size': size,
+            'is_public': bool(is_public),
+        }
+
+        if size > self.options['multipart_threshold']:
+            part_size = self.options['part_size']
+            part_count = math.ceil(size / part_size)
+            upload = self.client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=storage_path,
+                ContentType=content_type,
+            )
+            upload_id = upload['UploadId']
+            parts = [
+                {
+                    'part_number': number,
+                    'url': self.client.generate_presigned_url(
+                        'upload_part',
+                        Params={
+                            'Bucket': self.bucket,
+                            'Key': storage_path,
+                            'UploadId': upload_id,
+                            'PartNumber': number,
+                        },
+                        ExpiresIn=expires,
+                    ),
+                }
+                for number in range(1, part_count + 1)
+            ]
+            token_payload['upload_id'] = upload_id
+            logger.info(f"签发分片直传: {storage_path} ({part_count} parts)")
+            return {
+                'method': 'multipart',
+                'upload_token': signing.dumps(token_payload, salt=UPLOAD_TOKEN_SALT),
+                'storage_path': storage_path,
+                'part_size': part_size,
+                'parts': parts,
+                'expires_in': expires,
+            }
+
+        presigned = self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=storage_path,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                # 只接受与声明大小一致的文件，配额按声明大小检查
+                ['content-length-range', size, size],
+            ],
+            ExpiresIn=expires,
+        )
+        logger.info(f"签发直传: {storage_path}")
+        return {
+            'method': 'post',
+            'upload_token': signing.dumps(token_payload, salt=UPLOAD_TOKEN_SALT),
+            'storage_path': storage_path,
+            'url': presigned['url'],
+            'fields': presigned['fields'],
+            'expires_in': expires,
+        }
+
+    @staticmethod
+    def load_token(upload_token: str, user: User) -> Dict[str, Any]:
+        """校验并解析上传凭证"""
+        try:
+            payload = signing.loads(
+                upload_token,
+                salt=UPLOAD_TOKEN_SALT,
+                max_age=_direct_upload_settings()['expires'],
+            )
+        except signing.SignatureExpired:
+            raise DirectUploadError('上传凭证已过期')
+        except signing.BadSignature:
+            raise DirectUploadError('上传凭证无效')
+        if payload.get('user_id') != user.id:
+            raise DirectUploadError('上传凭证无效')
+        return payload
+
+    def confirm_upload(self, payload: Dict[str, Any], parts: Optional[List[Dict[str, Any]]] = None) -> Attachment:
+        """
+        确认直传完成：合并分片（如有），HEAD 校验对象后登记附件记录
+        """
+        storage_path = payload['storage_path']
+
+        if payload.get('upload_id'):
+            if not parts:
+                raise DirectUploadError('缺少分片信息')
+            try:
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=storage_path,
+                    UploadId=payload['upload_id'],
+                    MultipartUpload={
+                        'Parts': sorted(
+                            [
+                                {'PartNumber': int(p['part_number']), 'ETag': p['etag']}
+                                for p in parts
+                            ],
+                            key=lambda p: p['PartNumber'],
+                        )
+                    },
+                )
+            except Exception as e:
+                logger.warning(f"合并分片失败: {storage_path}: {e}")
+                try:
+                    self.client.abort_multipart_upload(
+                        Bucket=self.bucket, Key=storage_path, UploadId=payload['upload_id'],
+                    )
+                except Exception as abort_error:
+                    logger.warning(f"取消分片上传失败: {storage_path}: {abort_error}")
+                raise DirectUploadError(f'合并分片失败: {e}')
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=storage_path)
+        except Exception as e:
+            logger.warning(f"直传对象校验失败: {storage_path}: {e}")
+            raise DirectUploadError('未找到已上传的文件，请重新上传')
+
+        # 分片上传无法在签名中限制大小，实际大小必须与签发时声明（并据此检查配额）的一致
+        size = head.get('ContentLength', 0)
+        if size != payload['size'] or size > self.options['max_file_size']:
+            logger.warning(f"直传文件大小不符: {storage_path} ({size} != {payload['size']})")
+            try:
+                self.client.delete_object(Bucket=self.bucket, Key=storage_path)
+            except Exception as e:
+                logger.warning(f"删除直传对象失败: {storage_path}: {e}")
+            raise DirectUploadError('上传的文件大小与声明的不一致，请重新上传')
+
+        attachment, created = Attachment.objects.get_or_create(
+            owner_id=str(self.user.id),
+            storage_config_id=str(self.settings_obj.id),
+            storage_path=storage_path,
+            defaults={
+                'id': generate_uuid(),
+                'original_name': payload['original_name'],
+                'mime_type': head.get('ContentType') or payload['content_type'],
+                'size': size,
+                'is_public': payload.get('is_public', False),
+            },
+        )
+        if created:
+            record_attachment_added(attachment)
+            try_publish_attachment(attachment, DjangoStorageEngine(self._storage))
+            logger.info(f"直传完成: {storage_path} ({size} bytes)")
+        return attachment
@@ -0,0 +1,252 @@
+"""
+S3 附件的本地磁盘缓存
+
+自建部署常见 NAT 后的 MinIO 等 S3 端点，读对象比本地磁盘慢得多，每次预览都重定向或回源并不划算。
+开启后（S3_DISK_CACHE_BYTES > 0）预览/下载 S3 附件时先读 MEDIA_ROOT 下的缓存文件，
+未命中则从 S3 拉取写入缓存，再与本地附件一样走 sendfile / X-Accel-Redirect 零拷贝输出。
+
+- 缓存键：存储配置 ID + 存储桶/端点 + 存储路径，文件名取其 SHA-256，配置修改存储桶后不会读到旧文件
+- 原子写入：先写同目录的临时文件，大小校验通过后 os.replace 到最终路径，读者不会看到半个文件
+- 未命中合并：同一对象的并发未命中只回源一次（进程内用按路径哈希分段的固定数量线程锁，多 worker 之间用 flock 文件锁）
+- LRU 淘汰：命中时刷新文件 mtime（同一文件每分钟最多一次），总大小超过上限后按 mtime
+  从旧到新删除，直到低于上限的 90%
+
+附件内容上传后不会变化，缓存不需要失效；删除的附件不再有记录指向缓存文件，由 LRU 自然淘汰。
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+from django.conf import settings
+
+from .storage_io import COPY_CHUNK_SIZE, open_stream, s3_backend
+
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境：只合并进程内的并发未命中
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 命中时刷新 mtime 的最小间隔（秒），避免每次读取都写 inode
+TOUCH_INTERVAL = 60
+
+# 淘汰时删除到上限的该比例，避免每次写入都触发淘汰
+EVICT_LOW_WATERMARK = 0.9
+
+# 超过该秒数的临时文件视为中断的写入，淘汰时一并清理
+STALE_TEMP_SECONDS = 3600
+
+# 进程内合并未命中用的线程锁数量，按缓存路径哈希取锁，锁的数量不随缓存文件增长
+LOCK_STRIPES = 64
+
+TEMP_MARKER = '.tmp-'
+LOCK_SUFFIX = '.lock'
+
+
+def _cache_settings() -> dict:
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    return {
+        'max_bytes': chewy_settings.get('S3_DISK_CACHE_BYTES', 0),
+        'max_object_bytes': chewy_settings.get('S3_DISK_CACHE_MAX_OBJECT_BYTES', 32 * 1024 * 1024),
+        'root': chewy_settings.get('S3_DISK_CACHE_ROOT') or Path(settings.MEDIA_ROOT) / 's3-cache',
+    }
+
+
+class AttachmentDiskCache:
+    """容量受限的 LRU 磁盘缓存"""
+
+    def __init__(self, root, max_bytes: int, max_object_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self._locks: List[threading.Lock] = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._size_guard = threading.Lock()
+        # 本进程估计的缓存总大小，首次写入时扫描目录得到；其他 worker 的写入在下次淘汰扫描时计入
+        self._approx_bytes: Optional[int] = None
+
+    def relative_path(self, storage_config_id, engine, storage_path: str) -> str:
+        """缓存文件相对缓存根目录的路径"""
+        backend = s3_backend(engine)
+        target = f"{getattr(backend, 'endpoint_url', '') or ''}|{getattr(backend, 'bucket_name', '')}|{storage_path}"
+        digest = hashlib.sha256(target.encode('utf-8')).hexdigest()
+        ext = os.path.splitext(storage_path)[1][:16]
+        return f"{storage_config_id or 'default'}/{digest[:2]}/{digest}{ext}"
+
+    def fetch(self, storage_config_id, engine, storage_path: str, size: Optional[int]) -> Optional[str]:
+        """
+        返回对象在本地缓存中的路径，未命中时回源写入
+
+        Args:
+            size: 对象大小，超过 max_object_bytes 的对象不缓存；同时用于校验写入结果
+
+        Returns:
+            缓存文件路径；对象过大或回源失败时返回 None，由调用方退回重定向
+        """
+        if size is None or size > self.max_object_bytes:
+            return None
+        relative = self.relative_path(storage_config_id, engine, storage_path)
+        path = self.root / relative
+        if self._hit(path):
+            return str(path)
+
+        with self._key_lock(relative):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with self._file_lock(path):
+                # 等锁期间其他线程或 worker 可能已经写好
+                if self._hit(path):
+                    return str(path)
+                if not self._fill(path, engine, storage_path, size):
+                    return None
+        self._account(size)
+        return str(path)
+
+    def _hit(self, path: Path) -> bool:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        now = time.time()
+        if now - stat.st_mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+        return True
+
+    def _key_lock(self, relative: str) -> threading.Lock:
+        return self._locks[hash(relative) % LOCK_STRIPES]
+
+    class _FileLock:
+        def __init__(self, path: Path):
+            self.lock_path = f"{path}{LOCK_SUFFIX}"
+            self.handle = None
+
+        def __enter__(self):
+            if fcntl is not None:
+                self.handle = open(self.lock_path, 'a')
+                fcntl.flock(self.handle, fcntl.LOCK_EX)
+            return self
+
+        def __exit__(self, *exc):
+            if self.handle is not None:
+                fcntl.flock(self.handle, fcntl.LOCK_UN)
+                self.handle.close()
+
+    def _file_lock(self, path: Path) -> '_FileLock':
+        return self._FileLock(path)
+
+    def _fill(self, path: Path, engine, storage_path: str, size: int) -> bool:
+        """从存储读取对象写入临时文件，校验大小后原子替换到缓存路径"""
+        temp_path = path.with_name(f"{path.name}{TEMP_MARKER}{uuid.uuid4().hex}")
+        try:
+            stream = open_stream(engine, storage_path)
+            try:
+                written = 0
+                with open(temp_path, 'wb') as f:
+                    while True:
+                        chunk = stream.read(COPY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        written += len(chunk)
+            finally:
+                stream.close()
+            if written != size:
+                raise ValueError(f'读取大小不一致: 期望 {size}，实际 {written}')
+            os.replace(temp_path, path)
+            return True
+        except Exception as e:
+            logger.warning(f"写入附件缓存失败: {storage_path}: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+
+    def _account(self, size: int) -> None:
+        with self._size_guard:
+            if self._approx_bytes is None:
+                self._approx_bytes = self._scan_size()
+            else:
+                self._approx_bytes += size
+            over_limit = self._approx_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _entries(self):
+        """遍历缓存文件，顺带清理中断写入留下的临时文件"""
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(full_path)
+                except FileNotFoundError:
+                    continue
+                if filename.endswith(LOCK_SUFFIX):
+                    continue
+                if TEMP_MARKER in filename:
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        self._remove(full_path)
+                    continue
+                yield full_path, stat.st_size, stat.st_mtime
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> int:
+        """按 mtime 从旧到新删除缓存文件，直到总大小低于上限的 90%，返回删除的文件数"""
+        with self._size_guard:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            total = sum(size for _, size, _ in entries)
+            target = int(self.max_bytes * EVICT_LOW_WATERMARK)
+            removed = 0
+            for full_path, size, _ in entries:
+                if total <= target:
+                    break
+                if self._remove(full_path):
+                    total -= size
+                    removed += 1
+                    self._remove(f"{full_path}{LOCK_SUFFIX}")
+            self._approx_bytes = total
+        if removed:
+            logger.info(f"附件缓存淘汰 {removed} 个文件，当前 {total} 字节")
+        return removed
+
+    @staticmethod
+    def _remove(full_path: str) -> bool:
+        try:
+            os.remove(full_path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.warning(f"删除缓存文件失败: {full_path}: {e}")
+            return False
+
+
+_disk_cache: Optional[AttachmentDiskCache] = None
+_disk_cache_guard = threading.Lock()
+
+
+def get_disk_cache() -> Optional[AttachmentDiskCache]:
+    """返回进程内共享的磁盘缓存，未开启（S3_DISK_CACHE_BYTES 为 0）时返回 None"""
+    global _disk_cache
+    options = _cache_settings()
+    if not options['max_bytes']:
+        return None
+    with _disk_cache_guard:
+        if (
+            _disk_cache is None
+            or _disk_cache.root != Path(options['root'])
+            or _disk_cache.max_bytes != options['max_bytes']
+            or _disk_cache.max_object_bytes != options['max_object_bytes']
+        ):
+            _disk_cache = AttachmentDiskCache(options['root'], options['max_bytes'], options['max_object_bytes'])
+        return _disk_cache
@@ -0,0 +1,64 @@
+"""
+附件存储巡检管理命令
+
+并行检查附件对应的存储对象，报告缺失、大小不符或内容损坏的附件
+
+    python manage.py audit_attachments --user alice           # 检查某个用户的附件
+    python manage.py audit_attachments --config 3 --deep      # 检查某个存储配置，并重新计算内容哈希
+    python manage.py audit_attachments --config local --json  # 检查本地存储，输出 JSON
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bbtalk.models import User
+from bbtalk.storage_audit import audit_attachments
+
+
+class Command(BaseCommand):
+    help = '巡检附件存储，报告缺失或损坏的文件'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='只检查该用户（用户名或 ID）的附件')
+        parser.add_argument('--config', help='只检查该存储配置 ID 下的附件，local 表示本地存储')
+        parser.add_argument('--deep', action='store_true', help='重新读取对象，校验内容哈希')
+        parser.add_argument('--workers', type=int, help='并行检查的线程数，默认同 MIGRATION_WORKERS')
+        parser.add_argument('--json', action='store_true', help='以 JSON 输出完整报告')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            lookup = options['user']
+            user = User.objects.filter(username=lookup).first()
+            if user is None and lookup.isdigit():
+                user = User.objects.filter(id=int(lookup)).first()
+            if user is None:
+                raise CommandError(f'用户 {lookup} 不存在')
+
+        config = options['config']
+        if config is not None and config.lower() == 'local':
+            config = ''
+
+        report = audit_attachments(
+            user=user,
+            storage_config_id=config,
+            deep=options['deep'],
+            workers=options['workers'],
+        )
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        for problem in report['problems']:
+            self.stdout.write(self.style.ERROR(
+                f"[{problem['status']}] {problem['id']} "
+                f"(配置 {problem['storage_config_id'] or '本地'}) {problem['storage_path']}: {problem['detail']}"
+            ))
+        summary = (
+            f"共检查 {report['total']} 个附件：正常 {report['ok']}，缺失 {report['missing']}，"
+            f"大小不符 {report['size_mismatch']}，损坏 {report['corrupt']}，错误 {report['error']}"
+        )
+        if options['deep'] and report['unverified']:
+            summary += f"（{report['unverified']} 个老附件没有内容哈希，只检查了大小）"
+        self.stdout.write(self.style.SUCCESS(summary) if not report['problems'] else self.style.WARNING(summary))
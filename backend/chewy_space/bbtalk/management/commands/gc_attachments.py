@@ -0,0 +1,79 @@
+"""
+附件垃圾回收管理命令
+
+回收没有被任何 BBTalk 引用的附件，以及存储中没有附件记录对应的文件
+
+    python manage.py gc_attachments --dry-run          # 只报告，不删除
+    python manage.py gc_attachments                    # 执行回收
+    python manage.py gc_attachments --grace-hours 72   # 只回收 72 小时之前的文件
+    python manage.py gc_attachments --scheduled        # 按 GC_INTERVAL_HOURS 定时回收（供 supervisord 使用）
+"""
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from bbtalk.storage_gc import StorageGarbageCollector
+
+
+class Command(BaseCommand):
+    help = '回收孤立的附件记录和存储对象'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='只报告将被回收的内容，不删除')
+        parser.add_argument('--grace-hours', type=float, help='只回收超过该小时数的附件和对象，默认同 GC_GRACE_HOURS')
+        parser.add_argument('--skip-attachments', action='store_true', help='不回收孤立的附件记录')
+        parser.add_argument('--skip-objects', action='store_true', help='不扫描存储中的孤立对象')
+        parser.add_argument('--scheduled', action='store_true', help='按 GC_INTERVAL_HOURS 循环执行，未配置间隔时直接退出')
+        parser.add_argument('--json', action='store_true', help='以 JSON 输出完整报告')
+
+    def handle(self, *args, **options):
+        if not options['scheduled']:
+            self._run_once(options)
+            return
+
+        interval = getattr(settings, 'CHEWY_ATTACHMENT', {}).get('GC_INTERVAL_HOURS', 0)
+        if not interval:
+            self.stdout.write('未配置 ATTACHMENT_GC_INTERVAL_HOURS，不执行定时回收')
+            return
+        while True:
+            try:
+                self._run_once(options)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'附件回收失败: {e}'))
+            finally:
+                close_old_connections()
+            time.sleep(interval * 3600)
+
+    def _run_once(self, options):
+        report = StorageGarbageCollector(
+            dry_run=options['dry_run'],
+            grace_hours=options['grace_hours'],
+        ).run(
+            attachments=not options['skip_attachments'],
+            objects=not options['skip_objects'],
+        )
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        for sample in report['samples']:
+            self.stdout.write(f'  {sample}')
+        for error in report['errors']:
+            self.stdout.write(self.style.ERROR(error))
+        if report['dry_run']:
+            summary = (
+                f"试运行：可回收 {report['orphan_attachments']} 个附件（{report['orphan_attachment_bytes']} 字节），"
+                f"{report['orphan_objects']} 个存储对象（{report['orphan_object_bytes']} 字节），"
+                f"共扫描 {report['scanned_objects']} 个对象"
+            )
+        else:
+            summary = (
+                f"已回收 {report['deleted_attachments']}/{report['orphan_attachments']} 个附件，"
+                f"{report['deleted_objects']}/{report['orphan_objects']} 个存储对象，"
+                f"共扫描 {report['scanned_objects']} 个对象"
+            )
+        self.stdout.write(self.style.SUCCESS(summary) if not report['errors'] else self.style.WARNING(summary))
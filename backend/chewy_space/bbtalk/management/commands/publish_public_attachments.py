@@ -0,0 +1,46 @@
+"""
+发布公开附件管理命令
+
+为还没有公开副本的公开附件（功能启用前上传的附件，或存储配置新设置了公开前缀）放置公开副本
+
+    python manage.py publish_public_attachments          # 只处理还没有公开地址的附件
+    python manage.py publish_public_attachments --all    # 全部重新发布（修改公开前缀或自定义域名后）
+"""
+from django.core.management.base import BaseCommand
+
+from bbtalk.models import Attachment, User
+from bbtalk.public_attachments import publish_attachment
+from bbtalk.storage_migration import StorageMigrationService
+
+
+class Command(BaseCommand):
+    help = '为公开附件放置公开副本并记录无签名地址'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='已有公开地址的附件也重新发布')
+
+    def handle(self, *args, **options):
+        queryset = Attachment.objects.filter(is_public=True)
+        if not options['all']:
+            queryset = queryset.filter(public_url='')
+
+        services = {}
+        published = skipped = failed = 0
+        for attachment in queryset.order_by('owner_id', 'created_at').iterator(chunk_size=500):
+            if not str(attachment.owner_id).isdigit():
+                skipped += 1
+                continue
+            service = services.get(attachment.owner_id)
+            if service is None:
+                service = services[attachment.owner_id] = StorageMigrationService(User(id=int(attachment.owner_id)))
+            try:
+                engine = service.get_engine(attachment.storage_config_id or None)
+                if publish_attachment(attachment, engine):
+                    published += 1
+                else:
+                    skipped += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'{attachment.id} {attachment.original_name}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(f'已发布 {published} 个，跳过 {skipped} 个（存储未启用公开地址），失败 {failed} 个'))
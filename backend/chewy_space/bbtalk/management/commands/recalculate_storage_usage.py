@@ -0,0 +1,32 @@
+"""
+重新统计存储用量管理命令
+
+存储用量在上传、删除、迁移时增量更新；手工改动附件表或计数出现偏差时，按附件表重新统计
+
+    python manage.py recalculate_storage_usage               # 所有用户
+    python manage.py recalculate_storage_usage --user alice  # 单个用户
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from bbtalk.models import User
+from bbtalk.storage_usage import recalculate_usage
+
+
+class Command(BaseCommand):
+    help = '按附件表重新统计存储用量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='只统计该用户（用户名或 ID）')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            lookup = options['user']
+            user = User.objects.filter(username=lookup).first()
+            if user is None and lookup.isdigit():
+                user = User.objects.filter(id=int(lookup)).first()
+            if user is None:
+                raise CommandError(f'用户 {lookup} 不存在')
+
+        count = recalculate_usage(user)
+        self.stdout.write(self.style.SUCCESS(f'已更新 {count} 条存储用量'))
@@ -0,0 +1,52 @@
+"""
+恢复中断的存储迁移任务
+
+进程崩溃或重启后，运行中的迁移任务会停留在 running 状态且心跳过期。
+本命令在前台逐个执行这些任务（以及尚未开始的任务），已迁移的附件不会重复复制。
+
+    python manage.py resume_storage_migrations            # 恢复所有中断的任务
+    python manage.py resume_storage_migrations --job 12   # 恢复指定任务（含失败、已取消的任务）
+"""
+from django.core.management.base import BaseCommand
+
+from bbtalk.migration_jobs import is_stale, prepare_resume, run_migration_job
+from bbtalk.models import StorageMigrationJob
+
+
+class Command(BaseCommand):
+    help = '恢复中断的存储迁移任务'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, help='只恢复指定 ID 的任务')
+
+    def handle(self, *args, **options):
+        if options['job']:
+            jobs = list(StorageMigrationJob.objects.filter(id=options['job']))
+            if not jobs:
+                self.stdout.write(self.style.ERROR(f'任务 {options["job"]} 不存在'))
+                return
+        else:
+            jobs = [
+                job for job in StorageMigrationJob.objects.filter(
+                    status__in=StorageMigrationJob.ACTIVE_STATUSES,
+                ).order_by('created_at')
+                if job.status == StorageMigrationJob.STATUS_PENDING or is_stale(job)
+            ]
+
+        if not jobs:
+            self.stdout.write('没有需要恢复的迁移任务')
+            return
+
+        for job in jobs:
+            if not prepare_resume(job):
+                self.stdout.write(self.style.WARNING(f'任务 {job.id} 无需恢复（{job.get_status_display()}）'))
+                continue
+            self.stdout.write(f'恢复任务 {job.id}: {job.user_id} -> {job.target_config_id or "本地存储"}')
+            result = run_migration_job(job.id)
+            if result is None:
+                self.stdout.write(self.style.WARNING(f'任务 {job.id} 正在其他进程中运行，跳过'))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'任务 {result.id} {result.get_status_display()}: '
+                f'已迁移 {result.migrated}/{result.total}，失败 {result.failed}'
+            ))
@@ -0,0 +1,435 @@
+"""
+附件媒体处理
+
+上传完成后在后台线程池中处理附件，结果记录在 Attachment.media_info 中：
+- 图片：生成多档宽度的缩略图，和原图存放在同一存储引擎中（<原路径去扩展名>_w<宽度>.<格式>）
+- 音频：提取时长和降采样后的波形峰值，客户端无需下载整个文件即可显示时长和波形
+
+老附件没有缩略图时，preview?size= 会按需同步生成并记录，之后直接复用。
+
+上传压缩（IMAGE_UPLOAD_MAX_DIMENSION > 0 时开启）：普通上传的图片在写入存储前限制最长边、
+按目标质量重新编码并去掉 EXIF 等元数据，在独立的上传线程池中执行，Attachment.original_size 记录原始大小。
+Pillow 未安装时跳过图片处理，preview 退回原图；找不到 ffmpeg 时跳过音频处理。
+"""
+import array
+import base64
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import Attachment
+
+logger = logging.getLogger(__name__)
+
+# 缩略图格式对应的 MIME 类型和扩展名
+DERIVATIVE_FORMATS = {
+    'webp': ('image/webp', '.webp'),
+    'jpeg': ('image/jpeg', '.jpg'),
+}
+
+# Pillow 能可靠处理的图片类型（SVG、HEIC 等不处理）
+PROCESSABLE_IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp'}
+
+# 需要提取时长和波形的音频扩展名（部分客户端录音的 MIME 类型不准确，按扩展名兜底）
+AUDIO_EXTENSIONS = {'.mp3', '.m4a', '.aac', '.wav', '.ogg', '.webm', '.3gp', '.caf', '.flac'}
+
+# 上传压缩保持原格式重新编码（GIF 可能是动图、BMP 体积无意义，不处理）
+UPLOAD_RECOMPRESS_FORMATS = {'image/jpeg': 'JPEG', 'image/png': 'PNG', 'image/webp': 'WEBP'}
+
+# 上传压缩的输出超过该大小后写入临时文件
+UPLOAD_SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+# 解码波形时的采样率，只用于计算峰值包络，8kHz 足够
+WAVEFORM_SAMPLE_RATE = 8000
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+_upload_executor: Optional[ThreadPoolExecutor] = None
+
+# 同一附件的按需生成请求合并为一次
+_generation_locks: Dict[str, threading.Lock] = {}
+_generation_locks_guard = threading.Lock()
+
+
+def _media_settings() -> Dict[str, Any]:
+    """读取媒体处理相关配置"""
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    derivative_format = chewy_settings.get('IMAGE_DERIVATIVE_FORMAT', 'webp')
+    if derivative_format not in DERIVATIVE_FORMATS:
+        derivative_format = 'webp'
+    return {
+        'workers': chewy_settings.get('MEDIA_WORKERS', 2),
+        'widths': sorted(chewy_settings.get('IMAGE_DERIVATIVE_WIDTHS', [320, 640, 1280])),
+        'format': derivative_format,
+        'quality': chewy_settings.get('IMAGE_DERIVATIVE_QUALITY', 80),
+        'waveform_points': chewy_settings.get('AUDIO_WAVEFORM_POINTS', 100),
+        'ffmpeg_timeout': chewy_settings.get('FFMPEG_TIMEOUT', 60),
+        'upload_max_dimension': chewy_settings.get('IMAGE_UPLOAD_MAX_DIMENSION', 0),
+        'upload_quality': chewy_settings.get('IMAGE_UPLOAD_QUALITY', 85),
+        'upload_workers': chewy_settings.get('IMAGE_UPLOAD_WORKERS', 2),
+    }
+
+
+def derivative_widths() -> List[int]:
+    """缩略图宽度档位（升序）"""
+    return _media_settings()['widths']
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=max(1, _media_settings()['workers']),
+                    thread_name_prefix='bbtalk-media',
+                )
+    return _executor
+
+
+def _get_upload_executor() -> ThreadPoolExecutor:
+    global _upload_executor
+    if _upload_executor is None:
+        with _executor_lock:
+            if _upload_executor is None:
+                _upload_executor = ThreadPoolExecutor(
+                    max_workers=max(1, _media_settings()['upload_workers']),
+                    thread_name_prefix='bbtalk-upload-image',
+                )
+    return _upload_executor
+
+
+def is_processable_image(attachment: Attachment) -> bool:
+    return attachment.mime_type in PROCESSABLE_IMAGE_TYPES
+
+
+def is_processable_audio(attachment: Attachment) -> bool:
+    if attachment.mime_type.startswith('audio/'):
+        return True
+    return os.path.splitext(attachment.original_name)[1].lower() in AUDIO_EXTENSIONS
+
+
+def schedule_media_processing(attachment: Attachment):
+    """
+    在事务提交后把附件交给后台线程池处理
+
+    不需要处理的附件直接忽略；提交前调度会读不到记录，因此挂在 on_commit 上
+    """
+    if not is_processable_image(attachment) and not is_processable_audio(attachment):
+        return
+    attachment_id = str(attachment.id)
+    transaction.on_commit(lambda: _get_executor().submit(process_attachment, attachment_id))
+
+
+def process_attachment(attachment_id: str):
+    """后台任务入口：按附件类型执行对应的处理"""
+    try:
+        attachment = Attachment.objects.filter(id=attachment_id).first()
+        if attachment is None:
+            return
+        if is_processable_image(attachment):
+            generate_image_derivatives(attachment)
+        elif is_processable_audio(attachment):
+            extract_audio_metadata(attachment)
+    except Exception as e:
+        logger.error(f"附件媒体处理失败 ({attachment_id}): {e}", exc_info=True)
+    finally:
+        # 线程池中的线程不经过请求周期，需要自己释放数据库连接
+        close_old_connections()
+
+
+def _recompress_image(source, image_format: str, max_dimension: int, quality: int):
+    """
+    限制最长边并重新编码，返回写有结果的临时文件（已定位到开头）
+
+    JPEG 用 draft 在解码时直接按 1/2、1/4、1/8 缩小，大照片不需要完整解码到内存；
+    不传 exif 即去掉元数据，只保留 ICC 色彩配置
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as image:
+        if getattr(image, 'is_animated', False):
+            return None
+        icc_profile = image.info.get('icc_profile')
+        if image_format == 'JPEG':
+            image.draft('RGB', (max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(image)
+        if max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+        save_options = {'format': image_format}
+        if icc_profile:
+            save_options['icc_profile'] = icc_profile
+        if image_format == 'JPEG':
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            save_options.update(quality=quality, optimize=True, progressive=True)
+        elif image_format == 'WEBP':
+            save_options.update(quality=quality, method=4)
+        else:
+            save_options.update(optimize=True)
+
+        output = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+        image.save(output, **save_options)
+    output.seek(0)
+    return output
+
+
+def optimize_uploaded_image(uploaded_file, mime_type: str):
+    """
+    上传压缩：在上传线程池中缩小并重新编码图片
+
+    Args:
+        uploaded_file: 上传的文件（Django UploadedFile）
+        mime_type: 检测到的 MIME 类型
+
+    Returns:
+        压缩后的 django File（name 与原文件相同）；未开启、不支持的格式、处理失败或压缩后不更小时返回 None，
+        调用方继续使用原文件
+    """
+    options = _media_settings()
+    image_format = UPLOAD_RECOMPRESS_FORMATS.get(mime_type)
+    if not options['upload_max_dimension'] or image_format is None:
+        return None
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        logger.warning("未安装 Pillow，跳过上传图片压缩")
+        return None
+
+    from django.core.files import File
+
+    uploaded_file.seek(0)
+    try:
+        output = _get_upload_executor().submit(
+            _recompress_image, uploaded_file, image_format,
+            options['upload_max_dimension'], options['upload_quality'],
+        ).result()
+    except Exception as e:
+        logger.warning(f"上传图片压缩失败，保存原图 ({uploaded_file.name}): {e}")
+        return None
+    finally:
+        uploaded_file.seek(0)
+    if output is None:
+        return None
+
+    output.seek(0, os.SEEK_END)
+    optimized = File(output, name=uploaded_file.name)
+    optimized.size = output.tell()
+    output.seek(0)
+    if optimized.size >= uploaded_file.size:
+        output.close()
+        return None
+    logger.info(f"上传图片压缩: {uploaded_file.name} {uploaded_file.size} -> {optimized.size} 字节")
+    return optimized
+
+
+def derivative_storage_path(storage_path: str, width: int, derivative_format: str) -> str:
+    """缩略图存储路径：与原图同目录，<原文件名>_w<宽度>.<格式>"""
+    root, _ = os.path.splitext(storage_path)
+    return f"{root}_w{width}{DERIVATIVE_FORMATS[derivative_format][1]}"
+
+
+def generate_image_derivatives(attachment: Attachment, engine=None) -> Dict[str, Any]:
+    """
+    生成图片缩略图并写回 media_info
+
+    只生成比原图窄的档位；原图不超过某档宽度时，该档直接使用原图。
+
+    Returns:
+        更新后的 media_info
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.warning("未安装 Pillow，跳过图片缩略图生成")
+        return attachment.media_info
+
+    from .storage import get_attachment_storage_engine
+
+    options = _media_settings()
+    mime_type, _ = DERIVATIVE_FORMATS[options['format']]
+    engine = engine or get_attachment_storage_engine(attachment.storage_config_id)
+
+    content = engine.get_file(attachment.storage_path)
+    with Image.open(io.BytesIO(content)) as image:
+        # 按 EXIF 方向摆正，缩略图不再携带 EXIF
+        image = ImageOps.exif_transpose(image)
+        width, height = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'P') else 'RGB')
+        if options['format'] == 'jpeg' and image.mode == 'RGBA':
+            image = image.convert('RGB')
+
+        derivatives = {}
+        for target_width in options['widths']:
+            if target_width >= width:
+                break
+            target_height = max(1, round(height * target_width / width))
+            resized = image.resize((target_width, target_height), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, format=options['format'].upper(), quality=options['quality'])
+            result = engine.save_file(
+                buffer.getvalue(),
+                attachment.original_name,
+                storage_path=derivative_storage_path(attachment.storage_path, target_width, options['format']),
+            )
+            derivatives[str(target_width)] = {
+                'path': result.storage_path,
+                'width': target_width,
+                'height': target_height,
+                'size': result.size,
+                'mime_type': mime_type,
+            }
+
+    media_info = dict(attachment.media_info or {})
+    media_info['image'] = {'width': width, 'height': height}
+    media_info['derivatives'] = derivatives
+    Attachment.objects.filter(id=attachment.id).update(media_info=media_info)
+    attachment.media_info = media_info
+    logger.info(f"生成缩略图: {attachment.storage_path} ({len(derivatives)} 档)")
+    return media_info
+
+
+def get_image_derivative(attachment: Attachment, requested_width: int, engine=None) -> Optional[Dict[str, Any]]:
+    """
+    获取不小于 requested_width 的最小一档缩略图
+
+    还没有缩略图的老附件会在这里同步生成。
+
+    Returns:
+        缩略图信息字典；应直接使用原图时返回 None
+    """
+    if not is_processable_image(attachment):
+        return None
+
+    widths = _media_settings()['widths']
+    target_width = next((w for w in widths if w >= requested_width), None)
+    if target_width is None:
+        return None
+
+    media_info = attachment.media_info or {}
+    if 'image' not in media_info or 'derivatives' not in media_info:
+        with _generation_locks_guard:
+            lock = _generation_locks.setdefault(str(attachment.id), threading.Lock())
+        with lock:
+            # 等锁期间可能已由其他请求或后台任务生成
+            attachment.refresh_from_db(fields=['media_info'])
+            media_info = attachment.media_info or {}
+            if 'image' not in media_info or 'derivatives' not in media_info:
+                try:
+                    media_info = generate_image_derivatives(attachment, engine)
+                except Exception as e:
+                    logger.warning(f"按需生成缩略图失败 ({attachment.id}): {e}")
+                    return None
+        with _generation_locks_guard:
+            _generation_locks.pop(str(attachment.id), None)
+
+    return (media_info.get('derivatives') or {}).get(str(target_width))
+
+
+def delete_image_derivatives(attachment: Attachment, engine) -> None:
+    """删除附件的所有缩略图文件"""
+    for derivative in ((attachment.media_info or {}).get('derivatives') or {}).values():
+        try:
+            engine.delete_file(derivative['path'])
+        except Exception as e:
+            logger.warning(f"删除缩略图失败: {derivative.get('path')}: {e}")
+
+
+def compute_waveform_peaks(samples: array.array, points: int) -> bytes:
+    """
+    把 16 位单声道采样按时间均分为 points 段，每段取绝对值峰值并量化到 0-255
+
+    采样数不足 points 时按实际采样数输出
+    """
+    if not samples:
+        return b''
+    points = min(points, len(samples))
+    bucket = len(samples) / points
+    peaks = bytearray(points)
+    for i in range(points):
+        chunk = samples[int(i * bucket):int((i + 1) * bucket)] or samples[int(i * bucket):int(i * bucket) + 1]
+        # max/min 在 C 层遍历 array，比逐个 abs 快得多
+        peak = max(max(chunk), -min(chunk))
+        peaks[i] = min(255, peak * 255 // 32767)
+    return bytes(peaks)
+
+
+def extract_audio_metadata(attachment: Attachment, engine=None) -> Dict[str, Any]:
+    """
+    用 ffmpeg 把音频解码为 8kHz 单声道 PCM，计算时长和波形峰值并写回 media_info
+
+    media_info['audio'] = {
+        'duration': 秒（保留 3 位小数）,
+        'peaks': base64 编码的 uint8 峰值数组（0-255）,
+    }
+
+    Returns:
+        更新后的 media_info
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        logger.warning("未找到 ffmpeg，跳过音频元数据提取")
+        return attachment.media_info
+
+    from .storage import get_attachment_storage_engine
+
+    options = _media_settings()
+    engine = engine or get_attachment_storage_engine(attachment.storage_config_id)
+
+    temp_file = None
+    try:
+        try:
+            # 本地存储直接读原文件，云存储先下载到临时文件
+            source_path = str(engine.get_file_path(attachment.storage_path))
+        except Exception:
+            suffix = os.path.splitext(attachment.storage_path)[1]
+            temp_file = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+            temp_file.write(engine.get_file(attachment.storage_path))
+            temp_file.close()
+            source_path = temp_file.name
+
+        result = subprocess.run(
+            [
+                ffmpeg, '-v', 'error', '-nostdin', '-i', source_path,
+                '-vn', '-ac', '1', '-ar', str(WAVEFORM_SAMPLE_RATE),
+                '-f', 's16le', '-acodec', 'pcm_s16le', '-',
+            ],
+            capture_output=True,
+            timeout=options['ffmpeg_timeout'],
+        )
+    finally:
+        if temp_file is not None:
+            os.unlink(temp_file.name)
+
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg 解码失败: {result.stderr.decode(errors='replace').strip()[:200]}")
+
+    pcm = result.stdout[:len(result.stdout) - len(result.stdout) % 2]
+    samples = array.array('h')
+    samples.frombytes(pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+
+    peaks = compute_waveform_peaks(samples, options['waveform_points'])
+    media_info = dict(attachment.media_info or {})
+    media_info['audio'] = {
+        'duration': round(len(samples) / WAVEFORM_SAMPLE_RATE, 3),
+        'peaks': base64.b64encode(peaks).decode('ascii'),
+    }
+    Attachment.objects.filter(id=attachment.id).update(media_info=media_info)
+    attachment.media_info = media_info
+    logger.info(f"提取音频元数据: {attachment.storage_path} ({media_info['audio']['duration']}s)")
+    return media_info
@@ -0,0 +1,296 @@
+"""
+存储迁移后台任务
+
+执行迁移的请求只创建 StorageMigrationJob 并立即返回任务 ID，迁移在后台线程中进行，
+前端轮询任务进度（完成数/总数、字节数、速率、预计剩余时间）。
+
+- 检查点：每个附件迁移完成时其记录已指向目标存储，恢复时自动跳过，任务计数随之累加
+- 恢复：进程崩溃或重启后任务停留在 running 且心跳过期，可通过接口或
+  manage.py resume_storage_migrations 重新执行，已迁移的附件不会重复复制
+- 取消：设置 cancel_requested，运行中的任务在几秒内停止派发新附件并标记为已取消
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Optional, Dict, Any
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .models import Attachment, StorageMigrationJob, User
+from .storage_migration import StorageMigrationService
+
+logger = logging.getLogger(__name__)
+
+# 任务上最多保留的失败信息条数
+MAX_JOB_ERRORS = 100
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _stale_seconds() -> int:
+    return getattr(settings, 'CHEWY_ATTACHMENT', {}).get('MIGRATION_JOB_STALE_SECONDS', 60)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # 每个进程同时只跑一个迁移任务，任务内部再并行复制附件
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bbtalk-migration-job')
+    return _executor
+
+
+def _pending_attachments(user: User, target_config_id: str):
+    """尚未位于目标存储的附件"""
+    queryset = Attachment.objects.filter(owner_id=user.id)
+    if target_config_id:
+        return queryset.exclude(storage_config_id=target_config_id)
+    return queryset.exclude(Q(storage_config_id__isnull=True) | Q(storage_config_id=''))
+
+
+def is_stale(job: StorageMigrationJob) -> bool:
+    """运行中的任务心跳过期，说明执行它的进程已经退出"""
+    if job.status != StorageMigrationJob.STATUS_RUNNING:
+        return False
+    return job.heartbeat_at is None or job.heartbeat_at < timezone.now() - timedelta(seconds=_stale_seconds())
+
+
+def get_active_job(user: User) -> Optional[StorageMigrationJob]:
+    """用户当前未结束的迁移任务"""
+    return StorageMigrationJob.objects.filter(
+        user=user,
+        status__in=StorageMigrationJob.ACTIVE_STATUSES,
+    ).first()
+
+
+def start_migration_job(user: User, target_config_id: Optional[str]) -> StorageMigrationJob:
+    """
+    创建迁移任务并在事务提交后交给后台线程执行
+
+    用户已有未结束的任务时直接返回该任务（并发请求由唯一约束保证只创建一个）。
+    目标存储不可用时抛出 ValueError。
+    """
+    active = get_active_job(user)
+    if active is not None:
+        return active
+
+    target = str(target_config_id) if target_config_id else ''
+    # 提前校验目标存储，配置错误时直接返回给调用方
+    StorageMigrationService(user).get_engine(target or None)
+
+    pending = _pending_attachments(user, target)
+    try:
+        with transaction.atomic():
+            job = StorageMigrationJob.objects.create(
+                user=user,
+                target_config_id=target,
+                total=pending.count(),
+                bytes_total=pending.aggregate(total=Sum('size'))['total'] or 0,
+            )
+    except IntegrityError:
+        # 并发请求（如重复点击）已经创建了任务
+        active = get_active_job(user)
+        if active is None:
+            raise
+        return active
+    schedule_migration_job(job)
+    logger.info(f"创建存储迁移任务 {job.id}: 用户 {user.username} -> {target or '本地存储'}, {job.total} 个附件")
+    return job
+
+
+def schedule_migration_job(job: StorageMigrationJob):
+    job_id = job.id
+    transaction.on_commit(lambda: _get_executor().submit(_run_in_background, job_id))
+
+
+def _run_in_background(job_id: int):
+    try:
+        run_migration_job(job_id)
+    except Exception as e:
+        logger.error(f"存储迁移任务 {job_id} 执行异常: {e}", exc_info=True)
+    finally:
+        close_old_connections()
+
+
+def _claim(job_id: int) -> bool:
+    """
+    把任务标记为运行中；等待中或心跳过期的任务才能被认领，保证同一任务只有一个执行者
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=_stale_seconds())
+    return StorageMigrationJob.objects.filter(id=job_id).filter(
+        Q(status=StorageMigrationJob.STATUS_PENDING)
+        | Q(status=StorageMigrationJob.STATUS_RUNNING, heartbeat_at__lt=stale_before)
+        | Q(status=StorageMigrationJob.STATUS_RUNNING, heartbeat_at__isnull=True)
+    ).update(
+        status=StorageMigrationJob.STATUS_RUNNING,
+        heartbeat_at=now,
+        run_started_at=now,
+        run_bytes_start=F('bytes_done'),
+        updated_at=now,
+    ) == 1
+
+
+def run_migration_job(job_id: int) -> Optional[StorageMigrationJob]:
+    """
+    在当前线程执行（或恢复）迁移任务
+
+    Returns:
+        执行结束后的任务；任务不存在或已被其他进程认领时返回 None
+    """
+    if not _claim(job_id):
+        logger.info(f"存储迁移任务 {job_id} 不可认领（已结束或正在其他进程中运行）")
+        return None
+
+    job = StorageMigrationJob.objects.select_related('user').get(id=job_id)
+    target = job.target_config_id
+    # 恢复时失败的附件会重新尝试：以已迁移数 + 仍未迁移数作为总数
+    pending = _pending_attachments(job.user, target)
+    remaining = pending.aggregate(count=Count('id'), size=Sum('size'))
+    StorageMigrationJob.objects.filter(id=job_id).update(
+        total=job.migrated + (remaining['count'] or 0),
+        bytes_total=job.bytes_done + (remaining['size'] or 0),
+        failed=0,
+        errors=[],
+        error='',
+    )
+
+    lock = threading.Lock()
+    errors = []
+
+    def on_progress(att: Attachment, copied: int, error: Optional[str]):
+        # 按附件大小计进度：去重命中或服务端复制时实际传输的字节数不能反映进度
+        with lock:
+            if error:
+                errors.append(error)
+                StorageMigrationJob.objects.filter(id=job_id).update(
+                    failed=F('failed') + 1,
+                    errors=errors[:MAX_JOB_ERRORS],
+                    heartbeat_at=timezone.now(),
+                )
+            else:
+                StorageMigrationJob.objects.filter(id=job_id).update(
+                    migrated=F('migrated') + 1,
+                    bytes_done=F('bytes_done') + att.size,
+                    heartbeat_at=timezone.now(),
+                )
+
+    def should_stop() -> bool:
+        StorageMigrationJob.objects.filter(id=job_id).update(heartbeat_at=timezone.now())
+        return StorageMigrationJob.objects.filter(id=job_id, cancel_requested=True).exists()
+
+    try:
+        stats = StorageMigrationService(job.user).migrate(
+            target or None,
+            on_progress=on_progress,
+            should_stop=should_stop,
+        )
+    except Exception as e:
+        logger.error(f"存储迁移任务 {job_id} 失败: {e}", exc_info=True)
+        StorageMigrationJob.objects.filter(id=job_id).update(
+            status=StorageMigrationJob.STATUS_FAILED,
+            error=str(e),
+            finished_at=timezone.now(),
+        )
+    else:
+        cancelled = stats['stopped'] or StorageMigrationJob.objects.filter(id=job_id, cancel_requested=True).exists()
+        StorageMigrationJob.objects.filter(id=job_id).update(
+            status=StorageMigrationJob.STATUS_CANCELLED if cancelled else StorageMigrationJob.STATUS_COMPLETED,
+            transfer_stats=_merge_transfer_stats(job.transfer_stats, stats['transfer']),
+            finished_at=timezone.now(),
+        )
+    job.refresh_from_db()
+    logger.info(f"存储迁移任务 {job_id} 结束: {job.status}, {job.migrated}/{job.total}, 失败 {job.failed}")
+    return job
+
+
+def _merge_transfer_stats(previous: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    """恢复执行时把本次的传输统计累加到之前的记录上"""
+    merged = {source: dict(transfer) for source, transfer in (previous or {}).items()}
+    for source, transfer in current.items():
+        entry = merged.setdefault(source, {'bytes': 0, 'seconds': 0.0})
+        entry['bytes'] += transfer['bytes']
+        entry['seconds'] = round(entry['seconds'] + transfer['seconds'], 3)
+    return merged
+
+
+def prepare_resume(job: StorageMigrationJob) -> bool:
+    """
+    把可恢复的任务重置为等待中，返回是否需要重新执行
+
+    可恢复：等待中、心跳过期的 running、失败、已取消，以及有失败附件的已完成任务。
+    同一用户已有其他未结束任务时不恢复。
+    """
+    if job.status == StorageMigrationJob.STATUS_PENDING:
+        return True
+    if job.status == StorageMigrationJob.STATUS_RUNNING:
+        return is_stale(job)
+    if job.status == StorageMigrationJob.STATUS_COMPLETED and not job.failed:
+        return False
+    if StorageMigrationJob.objects.filter(
+        user_id=job.user_id,
+        status__in=StorageMigrationJob.ACTIVE_STATUSES,
+    ).exclude(id=job.id).exists():
+        return False
+    try:
+        with transaction.atomic():
+            StorageMigrationJob.objects.filter(id=job.id).update(
+                status=StorageMigrationJob.STATUS_PENDING,
+                cancel_requested=False,
+                finished_at=None,
+            )
+    except IntegrityError:
+        # 并发创建或恢复了其他任务
+        return False
+    return True
+
+
+def resume_migration_job(job: StorageMigrationJob) -> StorageMigrationJob:
+    """
+    在后台恢复中断的任务
+
+    已迁移的附件不会重复复制，失败的附件会重新尝试；
+    重复调度是安全的，认领时保证只有一个执行者。
+    """
+    if prepare_resume(job):
+        schedule_migration_job(job)
+    job.refresh_from_db()
+    return job
+
+
+def cancel_migration_job(job: StorageMigrationJob) -> StorageMigrationJob:
+    """
+    取消任务：运行中的任务在下一次检查时停止，等待中或已失去执行者的任务直接标记为已取消
+    """
+    if not job.is_active:
+        return job
+    StorageMigrationJob.objects.filter(id=job.id).update(cancel_requested=True)
+    if job.status == StorageMigrationJob.STATUS_PENDING or is_stale(job):
+        StorageMigrationJob.objects.filter(id=job.id, status__in=StorageMigrationJob.ACTIVE_STATUSES).update(
+            status=StorageMigrationJob.STATUS_CANCELLED,
+            finished_at=timezone.now(),
+        )
+    job.refresh_from_db()
+    return job
+
+
+def job_progress(job: StorageMigrationJob) -> Dict[str, Any]:
+    """任务进度：完成数、字节数、本次运行的平均速率和预计剩余时间"""
+    rate = 0
+    if job.status == StorageMigrationJob.STATUS_RUNNING and job.run_started_at:
+        elapsed = (timezone.now() - job.run_started_at).total_seconds()
+        if elapsed > 0:
+            rate = int((job.bytes_done - job.run_bytes_start) / elapsed)
+    remaining = max(0, job.bytes_total - job.bytes_done)
+    return {
+        'done': job.migrated + job.failed,
+        'rate_bytes_per_second': rate,
+        'eta_seconds': int(remaining / rate) if rate > 0 else None,
+        'stale': is_stale(job),
+    }
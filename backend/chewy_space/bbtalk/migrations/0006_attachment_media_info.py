@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0005_comment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='media_info',
+            field=models.JSONField(blank=True, default=dict, help_text='后台处理生成的媒体信息，如图片尺寸和缩略图', verbose_name='媒体信息'),
+        ),
+    ]
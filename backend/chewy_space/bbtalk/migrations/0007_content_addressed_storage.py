@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0006_attachment_media_info'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='文件内容 SHA-256，用于去重存储；为空表示未参与去重', max_length=64, verbose_name='内容哈希'),
+        ),
+        migrations.CreateModel(
+            name='StorageBlob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('storage_config_id', models.CharField(blank=True, default='', help_text='存储配置 ID，空字符串表示本地存储', max_length=100, verbose_name='存储配置ID')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='内容哈希')),
+                ('storage_path', models.CharField(max_length=500, verbose_name='存储路径')),
+                ('size', models.BigIntegerField(verbose_name='文件大小')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='引用次数')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '存储文件',
+                'verbose_name_plural': '存储文件',
+                'db_table': 'cb_storage_blobs',
+                'constraints': [models.UniqueConstraint(fields=('storage_config_id', 'content_hash'), name='blob_config_hash_uniq')],
+            },
+        ),
+    ]
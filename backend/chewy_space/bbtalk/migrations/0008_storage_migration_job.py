@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0007_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageMigrationJob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('target_config_id', models.CharField(blank=True, default='', help_text='目标存储配置 ID，空字符串表示本地存储', max_length=100, verbose_name='目标存储配置ID')),
+                ('status', models.CharField(choices=[('pending', '等待中'), ('running', '迁移中'), ('completed', '已完成'), ('failed', '失败'), ('cancelled', '已取消')], default='pending', max_length=16, verbose_name='状态')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='待迁移数')),
+                ('migrated', models.PositiveIntegerField(default=0, verbose_name='已迁移数')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='失败数')),
+                ('bytes_total', models.BigIntegerField(default=0, verbose_name='待迁移字节数')),
+                ('bytes_done', models.BigIntegerField(default=0, verbose_name='已迁移字节数')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='错误信息')),
+                ('error', models.TextField(blank=True, default='', verbose_name='任务错误')),
+                ('cancel_requested', models.BooleanField(default=False, verbose_name='请求取消')),
+                ('run_started_at', models.DateTimeField(blank=True, null=True, verbose_name='本次开始时间')),
+                ('run_bytes_start', models.BigIntegerField(default=0, verbose_name='本次起始字节数')),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True, verbose_name='心跳时间')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='storage_migration_jobs', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '存储迁移任务',
+                'verbose_name_plural': '存储迁移任务',
+                'db_table': 'cb_storage_migration_jobs',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['user', 'status'], name='migration_job_user_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0008_storage_migration_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storagemigrationjob',
+            name='transfer_stats',
+            field=models.JSONField(blank=True, default=dict, verbose_name='传输统计'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_storage_usage(apps, schema_editor):
+    """按现有附件统计每个用户在各存储配置下的用量"""
+    Attachment = apps.get_model('bbtalk', 'Attachment')
+    StorageUsage = apps.get_model('bbtalk', 'StorageUsage')
+
+    totals = {}
+    rows = Attachment.objects.values('owner_id', 'storage_config_id').annotate(count=Count('id'), size=Sum('size'))
+    for row in rows:
+        if not str(row['owner_id']).isdigit():
+            continue
+        key = (int(row['owner_id']), row['storage_config_id'] or '')
+        count, size = totals.get(key, (0, 0))
+        totals[key] = (count + row['count'], size + (row['size'] or 0))
+
+    StorageUsage.objects.bulk_create([
+        StorageUsage(user_id=user_id, storage_config_id=config_id, file_count=count, bytes_used=size)
+        for (user_id, config_id), (count, size) in totals.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0009_storagemigrationjob_transfer_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('storage_config_id', models.CharField(blank=True, default='', help_text='存储配置 ID，空字符串表示本地存储', max_length=100, verbose_name='存储配置ID')),
+                ('file_count', models.IntegerField(default=0, verbose_name='附件数')),
+                ('bytes_used', models.BigIntegerField(default=0, verbose_name='已用字节数')),
+                ('quota_bytes', models.BigIntegerField(blank=True, help_text='配额（字节），为空时本地存储使用 LOCAL_QUOTA_BYTES 设置，S3 存储不限制', null=True, verbose_name='配额')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='storage_usages', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '存储用量',
+                'verbose_name_plural': '存储用量',
+                'db_table': 'cb_storage_usage',
+                'constraints': [models.UniqueConstraint(fields=('user', 'storage_config_id'), name='storage_usage_user_config_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_storage_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0010_storage_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstoragesettings',
+            name='benchmark',
+            field=models.JSONField(blank=True, default=dict, verbose_name='性能测试结果'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0011_userstoragesettings_benchmark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstoragesettings',
+            name='s3_connect_timeout',
+            field=models.FloatField(blank=True, null=True, verbose_name='连接超时（秒）'),
+        ),
+        migrations.AddField(
+            model_name='userstoragesettings',
+            name='s3_max_attempts',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='包含首次请求', null=True, verbose_name='最大尝试次数'),
+        ),
+        migrations.AddField(
+            model_name='userstoragesettings',
+            name='s3_read_timeout',
+            field=models.FloatField(blank=True, null=True, verbose_name='读取超时（秒）'),
+        ),
+    ]
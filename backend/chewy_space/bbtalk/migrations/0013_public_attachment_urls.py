@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0012_userstoragesettings_timeouts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='public_url',
+            field=models.CharField(blank=True, default='', help_text='公开附件的无签名地址（S3 公开前缀或 nginx 输出的本地路径），为空表示没有公开副本', max_length=1024, verbose_name='公开地址'),
+        ),
+        migrations.AddField(
+            model_name='userstoragesettings',
+            name='s3_public_prefix',
+            field=models.CharField(blank=True, help_text='公开附件复制到该前缀下，以无签名地址访问；需要在存储桶策略中允许匿名读取该前缀，留空不启用', max_length=255, verbose_name='公开前缀'),
+        ),
+    ]
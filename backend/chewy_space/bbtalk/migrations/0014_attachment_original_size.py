@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0013_public_attachment_urls'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachment',
+            name='original_size',
+            field=models.BigIntegerField(blank=True, help_text='上传压缩前的原始大小（字节），为空表示按原文件保存，size 为实际存储的大小', null=True, verbose_name='原始大小'),
+        ),
+    ]
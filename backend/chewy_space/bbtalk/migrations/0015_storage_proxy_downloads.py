@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0014_attachment_original_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstoragesettings',
+            name='s3_proxy_downloads',
+            field=models.BooleanField(default=False, help_text='预览/下载由服务器从 S3 读取后转发（支持 Range），不重定向到签名地址；端点只能从服务器访问时开启', verbose_name='服务器转发'),
+        ),
+    ]
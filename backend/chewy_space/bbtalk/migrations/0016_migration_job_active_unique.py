@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:05
+
+from django.db import migrations, models
+
+
+def cancel_duplicate_active_jobs(apps, schema_editor):
+    """同一用户有多个未结束的任务时只保留最新的一个，其余标记为已取消"""
+    StorageMigrationJob = apps.get_model('bbtalk', 'StorageMigrationJob')
+    seen = set()
+    active = StorageMigrationJob.objects.filter(status__in=['pending', 'running']).order_by('user_id', '-created_at', '-id')
+    for job in active:
+        if job.user_id in seen:
+            StorageMigrationJob.objects.filter(id=job.id).update(status='cancelled', cancel_requested=True)
+        seen.add(job.user_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bbtalk', '0015_storage_proxy_downloads'),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_duplicate_active_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='storagemigrationjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running'])), fields=('user',), name='migration_job_user_active_uniq'),
+        ),
+    ]
@@ -275,6 +275,17 @@ class UserStorageSettings(models.Model):
         verbose_name="自定义域名",
         help_text="用于 CDN 或自定义域名访问"
     )
+    s3_public_prefix = models.CharField(
+        max_length=255,
+        blank=True,
+        verbose_name="公开前缀",
+        help_text="公开附件复制到该前缀下，以无签名地址访问；需要在存储桶策略中允许匿名读取该前缀，留空不启用"
+    )
+    s3_proxy_downloads = models.BooleanField(
+        default=False,
+        verbose_name="服务器转发",
+        help_text="预览/下载由服务器从 S3 读取后转发（支持 Range），不重定向到签名地址；端点只能从服务器访问时开启"
+    )
     
     # 状态
     is_active = models.BooleanField(
@@ -282,6 +293,31 @@ class UserStorageSettings(models.Model):
         verbose_name="启用",
         help_text="是否启用自定义存储"
     )
+
+    # 超时与重试：为空时使用 CHEWY_ATTACHMENT 中的 S3_CONNECT_TIMEOUT / S3_READ_TIMEOUT / S3_MAX_ATTEMPTS
+    s3_connect_timeout = models.FloatField(
+        null=True,
+        blank=True,
+        verbose_name="连接超时（秒）"
+    )
+    s3_read_timeout = models.FloatField(
+        null=True,
+        blank=True,
+        verbose_name="读取超时（秒）"
+    )
+    s3_max_attempts = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="最大尝试次数",
+        help_text="包含首次请求"
+    )
+
+    # 最近一次性能测试结果：小对象/大对象的 PUT/GET 延迟分位数和吞吐量
+    benchmark = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name="性能测试结果"
+    )
     
     # 时间字段
     create_time = models.DateTimeField(default=timezone.now, verbose_name="创建时间")
@@ -318,6 +354,11 @@ class UserStorageSettings(models.Model):
             'region_name': self.s3_region_name or 'us-east-1',
             'endpoint_url': self.s3_endpoint_url or None,
             'custom_domain': self.s3_custom_domain or None,
+            'public_prefix': self.s3_public_prefix,
+            'proxy_downloads': self.s3_proxy_downloads,
+            'connect_timeout': self.s3_connect_timeout,
+            'read_timeout': self.s3_read_timeout,
+            'max_attempts': self.s3_max_attempts,
         }
 
 
@@ -403,6 +444,34 @@ class Attachment(AttachmentBase):
     使用 ChewyAttachment 的模型交换机制，类似 Django 的 AUTH_USER_MODEL
     这样可以自定义表名并避免多项目冲突
     """
+
+    media_info = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="后台处理生成的媒体信息，如图片尺寸和缩略图",
+        verbose_name="媒体信息"
+    )
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        default='',
+        db_index=True,
+        help_text="文件内容 SHA-256，用于去重存储；为空表示未参与去重",
+        verbose_name="内容哈希"
+    )
+    public_url = models.CharField(
+        max_length=1024,
+        blank=True,
+        default='',
+        help_text="公开附件的无签名地址（S3 公开前缀或 nginx 输出的本地路径），为空表示没有公开副本",
+        verbose_name="公开地址"
+    )
+    original_size = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text="上传压缩前的原始大小（字节），为空表示按原文件保存，size 为实际存储的大小",
+        verbose_name="原始大小"
+    )
     
     class Meta(AttachmentBase.Meta):
         db_table = "cb_attachments"  # 自定义表名，与项目其他表保持一致的 cb_ 前缀
@@ -410,3 +479,162 @@ class Attachment(AttachmentBase):
         app_label = 'bbtalk'
         verbose_name = "附件"
         verbose_name_plural = "附件"
+
+
+class StorageBlob(models.Model):
+    """
+    内容寻址存储的文件记录
+
+    同一存储配置下相同内容只保存一份，多个 Attachment 共享 storage_path，
+    ref_count 归零时才删除实际文件
+    """
+    id = models.AutoField(primary_key=True)
+    storage_config_id = models.CharField(
+        max_length=100,
+        blank=True,
+        default='',
+        help_text="存储配置 ID，空字符串表示本地存储",
+        verbose_name="存储配置ID"
+    )
+    content_hash = models.CharField(max_length=64, verbose_name="内容哈希")
+    storage_path = models.CharField(max_length=500, verbose_name="存储路径")
+    size = models.BigIntegerField(verbose_name="文件大小")
+    ref_count = models.PositiveIntegerField(default=0, verbose_name="引用次数")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = "cb_storage_blobs"
+        verbose_name = verbose_name_plural = "存储文件"
+        constraints = [
+            models.UniqueConstraint(fields=['storage_config_id', 'content_hash'], name='blob_config_hash_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({self.ref_count})"
+
+
+class StorageUsage(models.Model):
+    """
+    用户在每个存储配置下的用量
+
+    附件上传、删除和迁移时增量更新，避免每次都对 Attachment.size 求和；
+    quota_bytes 为该存储下的配额，上传时读取这一行即可判断是否超额
+    """
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='storage_usages',
+        db_constraint=False,
+        verbose_name="用户"
+    )
+    storage_config_id = models.CharField(
+        max_length=100,
+        blank=True,
+        default='',
+        help_text="存储配置 ID，空字符串表示本地存储",
+        verbose_name="存储配置ID"
+    )
+    file_count = models.IntegerField(default=0, verbose_name="附件数")
+    bytes_used = models.BigIntegerField(default=0, verbose_name="已用字节数")
+    quota_bytes = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text="配额（字节），为空时本地存储使用 LOCAL_QUOTA_BYTES 设置，S3 存储不限制",
+        verbose_name="配额"
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = "cb_storage_usage"
+        verbose_name = verbose_name_plural = "存储用量"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'storage_config_id'], name='storage_usage_user_config_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.storage_config_id or 'local'} {self.bytes_used}"
+
+
+class StorageMigrationJob(models.Model):
+    """
+    存储迁移后台任务
+
+    附件记录本身就是检查点：迁移完成的附件 storage_config_id 已指向目标存储，
+    恢复时只会处理仍未迁移的附件。任务上的计数用于展示进度。
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, '等待中'),
+        (STATUS_RUNNING, '迁移中'),
+        (STATUS_COMPLETED, '已完成'),
+        (STATUS_FAILED, '失败'),
+        (STATUS_CANCELLED, '已取消'),
+    ]
+    ACTIVE_STATUSES = (STATUS_PENDING, STATUS_RUNNING)
+
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='storage_migration_jobs',
+        db_constraint=False,
+        verbose_name="用户"
+    )
+    target_config_id = models.CharField(
+        max_length=100,
+        blank=True,
+        default='',
+        help_text="目标存储配置 ID，空字符串表示本地存储",
+        verbose_name="目标存储配置ID"
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name="状态")
+
+    # 进度：total/bytes_total 为需要迁移的附件数和总字节数
+    total = models.PositiveIntegerField(default=0, verbose_name="待迁移数")
+    migrated = models.PositiveIntegerField(default=0, verbose_name="已迁移数")
+    failed = models.PositiveIntegerField(default=0, verbose_name="失败数")
+    bytes_total = models.BigIntegerField(default=0, verbose_name="待迁移字节数")
+    bytes_done = models.BigIntegerField(default=0, verbose_name="已迁移字节数")
+    errors = models.JSONField(default=list, blank=True, verbose_name="错误信息")
+    error = models.TextField(blank=True, default='', verbose_name="任务错误")
+    # 按源存储配置统计的复制字节数和单线程耗时：{源配置ID: {'bytes': n, 'seconds': s}}，用于预估之后的迁移耗时
+    transfer_stats = models.JSONField(default=dict, blank=True, verbose_name="传输统计")
+
+    cancel_requested = models.BooleanField(default=False, verbose_name="请求取消")
+
+    # 本次运行的起点，用于计算速率（恢复后重新计时）
+    run_started_at = models.DateTimeField(null=True, blank=True, verbose_name="本次开始时间")
+    run_bytes_start = models.BigIntegerField(default=0, verbose_name="本次起始字节数")
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name="心跳时间")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="结束时间")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        db_table = "cb_storage_migration_jobs"
+        verbose_name = verbose_name_plural = "存储迁移任务"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'status'], name='migration_job_user_status_idx'),
+        ]
+        constraints = [
+            # 每个用户同时只能有一个未结束的任务，并发创建时由数据库拒绝
+            models.UniqueConstraint(
+                fields=['user'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='migration_job_user_active_uniq',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} -> {self.target_config_id or 'local'} ({self.status})"
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in self.ACTIVE_STATUSES
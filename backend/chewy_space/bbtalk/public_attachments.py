@@ -0,0 +1,181 @@
+"""
+公开附件的无签名地址
+
+公开附件原本也要经过签名 URL（每个时间桶不同）或 Django 预览接口，公开页面无法被 CDN / nginx 缓存。
+这里为 is_public 的附件额外放一份可以匿名读取的副本，地址固定不变：
+
+- S3：存储配置设置了 s3_public_prefix 时，服务端复制到存储桶的 <前缀>/<存储路径>，
+  该前缀需要在存储桶策略中允许匿名读取（s3:GetObject）；地址为不带签名的对象 URL（有自定义域名时使用域名）
+- 本地存储：硬链接到 MEDIA_ROOT/public/<存储路径>（跨文件系统时复制），由 nginx 的 /media/ 直接输出
+
+地址记录在 Attachment.public_url 上，PublicBBTalkViewSet 返回的附件地址直接替换为该地址，
+公开页面的附件流量不再经过 Python worker。去重存储中多个附件共享同一文件时共享同一份公开副本，
+最后一个引用它的公开附件删除时才删除副本。
+"""
+import copy
+import logging
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from chewy_attachment.core.storage import BaseStorageEngine, FileStorageEngine
+
+from .models import Attachment, BBTalk
+from .storage_io import s3_backend, s3_key
+
+logger = logging.getLogger(__name__)
+
+# 公开副本的缓存头：内容不会变化，允许 CDN 和浏览器长期缓存
+PUBLIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _public_settings() -> dict:
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    return {
+        'local_root': chewy_settings.get('PUBLIC_LOCAL_ROOT') or Path(settings.MEDIA_ROOT) / 'public',
+        'local_url': chewy_settings.get('PUBLIC_LOCAL_URL', ''),
+    }
+
+
+def _s3_public_prefix(engine: BaseStorageEngine) -> str:
+    """S3 存储配置的公开前缀，未设置时返回空字符串"""
+    backend = s3_backend(engine)
+    config = getattr(backend, 's3_config', None) or {}
+    return (config.get('public_prefix') or '').strip('/')
+
+
+def public_storage_path(engine: BaseStorageEngine, storage_path: str) -> Optional[str]:
+    """
+    附件公开副本的路径（S3 为存储桶内相对 location 的路径，本地为公开目录内的路径）
+
+    存储不支持公开副本时返回 None
+    """
+    if s3_backend(engine) is not None:
+        prefix = _s3_public_prefix(engine)
+        return f"{prefix}/{storage_path}" if prefix else None
+    if isinstance(engine, FileStorageEngine) and _public_settings()['local_url']:
+        return storage_path
+    return None
+
+
+def local_public_file(public_path: str) -> Path:
+    """本地存储公开副本的文件路径"""
+    return Path(_public_settings()['local_root']) / public_path
+
+
+def _public_url(engine: BaseStorageEngine, public_path: str) -> str:
+    backend = s3_backend(engine)
+    if backend is not None:
+        # 复制一份不带签名的存储实例生成 URL，不影响原实例的签名 URL
+        unsigned = copy.copy(backend)
+        unsigned.querystring_auth = False
+        return unsigned.url(public_path)
+    return _public_settings()['local_url'].rstrip('/') + '/' + public_path
+
+
+def publish_attachment(attachment: Attachment, engine: BaseStorageEngine) -> str:
+    """
+    为公开附件放置公开副本并记录 public_url
+
+    Returns:
+        公开地址；附件不公开或存储不支持时返回空字符串
+    """
+    if not attachment.is_public:
+        return ''
+    public_path = public_storage_path(engine, attachment.storage_path)
+    if public_path is None:
+        return ''
+
+    backend = s3_backend(engine)
+    if backend is not None:
+        backend.connection.meta.client.copy_object(
+            Bucket=backend.bucket_name,
+            Key=s3_key(backend, public_path),
+            CopySource={'Bucket': backend.bucket_name, 'Key': s3_key(backend, attachment.storage_path)},
+            MetadataDirective='REPLACE',
+            ContentType=attachment.mime_type or 'application/octet-stream',
+            CacheControl=PUBLIC_CACHE_CONTROL,
+        )
+    else:
+        target = local_public_file(public_path)
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            source = engine.get_file_path(attachment.storage_path)
+            try:
+                os.link(source, target)
+            except FileExistsError:
+                pass
+            except OSError:
+                # 公开目录与附件目录不在同一文件系统时无法硬链接
+                shutil.copyfile(source, target)
+
+    attachment.public_url = _public_url(engine, public_path)
+    Attachment.objects.filter(id=attachment.id).update(public_url=attachment.public_url)
+    return attachment.public_url
+
+
+def try_publish_attachment(attachment: Attachment, engine: BaseStorageEngine) -> str:
+    """publish_attachment，失败时只记录日志（附件仍可通过签名地址访问）"""
+    try:
+        return publish_attachment(attachment, engine)
+    except Exception as e:
+        logger.warning(f"发布公开附件失败: {attachment.id}: {e}")
+        return ''
+
+
+def unpublish_attachment(
+    attachment: Attachment,
+    engine: BaseStorageEngine,
+    storage_config_id: Optional[str] = None,
+    storage_path: Optional[str] = None,
+) -> None:
+    """
+    删除附件的公开副本（仍有其他公开附件共享同一文件时保留）
+
+    storage_config_id / storage_path 默认取附件当前值，迁移时传入迁移前的值
+    """
+    if not attachment.public_url:
+        return
+    storage_config_id = attachment.storage_config_id if storage_config_id is None else storage_config_id
+    storage_path = storage_path or attachment.storage_path
+    shared = Attachment.objects.filter(
+        storage_config_id=storage_config_id,
+        storage_path=storage_path,
+    ).exclude(id=attachment.id).exclude(public_url='').exists()
+    if not shared:
+        public_path = public_storage_path(engine, storage_path)
+        if public_path is not None:
+            backend = s3_backend(engine)
+            try:
+                if backend is not None:
+                    backend.connection.meta.client.delete_object(
+                        Bucket=backend.bucket_name, Key=s3_key(backend, public_path),
+                    )
+                else:
+                    local_public_file(public_path).unlink(missing_ok=True)
+            except Exception as e:
+                logger.warning(f"删除公开副本失败: {public_path}: {e}")
+    attachment.public_url = ''
+    Attachment.objects.filter(id=attachment.id).update(public_url='')
+
+
+def public_attachment_urls(bbtalks: Iterable[BBTalk]) -> Dict[str, str]:
+    """一次查询得到这些 BBTalk 引用的公开附件地址 {附件 ID: public_url}"""
+    attachment_ids: List[uuid.UUID] = []
+    for bbtalk in bbtalks:
+        for item in bbtalk.attachments or []:
+            if not isinstance(item, dict):
+                continue
+            try:
+                attachment_ids.append(uuid.UUID(str(item.get('uid') or item.get('id'))))
+            except ValueError:
+                continue
+    if not attachment_ids:
+        return {}
+    rows = Attachment.objects.filter(
+        id__in=attachment_ids, is_public=True,
+    ).exclude(public_url='').values_list('id', 'public_url')
+    return {str(attachment_id).lower(): public_url for attachment_id, public_url in rows}
@@ -0,0 +1,196 @@
+"""
+共享的 S3 客户端
+
+UserS3Storage 每个请求都会新建，连同 boto3 Session、客户端和 urllib3 连接池一起新建，
+每次预览、迁移复制都要重新握手 TLS。这里在进程内按 (存储配置, 凭证, 端点, 超时) 缓存客户端：
+
+- boto3 客户端线程安全，同一配置的所有线程共享一个客户端和它的连接池
+  （max_pool_connections 决定并发连接上限，开启 TCP keep-alive）
+- 资源对象（S3Boto3Storage.connection）不是线程安全的，每个线程各建一个，但都包装同一个共享客户端
+- 带存储配置 ID 的客户端注册熔断钩子（storage_health），连接测试等场景可以不经过熔断
+- 缓存数量有上限，凭证修改后旧客户端按最近使用淘汰，没有线程再使用后由垃圾回收释放连接池
+
+pool_stats() 返回各客户端的请求数和连接池状态，用于观察并发迁移、预览时连接是否被复用。
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from .storage_health import instrument_session, s3_client_config
+
+logger = logging.getLogger(__name__)
+
+
+def _client_settings() -> Dict[str, Any]:
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    return {
+        'max_pool_connections': chewy_settings.get('S3_MAX_POOL_CONNECTIONS', 20),
+        'cache_size': chewy_settings.get('S3_CLIENT_CACHE_SIZE', 32),
+    }
+
+
+@dataclass
+class _ClientEntry:
+    """缓存的客户端及其统计"""
+    client: Any
+    resource_class: type
+    config_id: Optional[str]
+    endpoint: str
+    created_at: float = field(default_factory=time.time)
+    requests: int = 0
+    errors: int = 0
+
+
+_lock = threading.Lock()
+_clients: 'OrderedDict[Tuple, _ClientEntry]' = OrderedDict()
+_local = threading.local()
+
+
+def _client_key(config: Dict[str, Any], config_id, overrides: Dict[str, Any]) -> Tuple:
+    secret_hash = hashlib.sha256((config.get('secret_access_key') or '').encode('utf-8')).hexdigest()
+    return (
+        str(config_id) if config_id else '',
+        config.get('access_key_id'),
+        secret_hash,
+        config.get('region_name') or 'us-east-1',
+        config.get('endpoint_url') or '',
+        config.get('connect_timeout'),
+        config.get('read_timeout'),
+        overrides.get('max_attempts', config.get('max_attempts')),
+    )
+
+
+def _build_entry(config: Dict[str, Any], config_id, overrides: Dict[str, Any]) -> _ClientEntry:
+    import boto3
+    from botocore.config import Config
+
+    session = boto3.Session(
+        aws_access_key_id=config['access_key_id'],
+        aws_secret_access_key=config['secret_access_key'],
+        region_name=config.get('region_name') or 'us-east-1',
+    )
+    if config_id:
+        instrument_session(session, config_id, config)
+
+    client_config = s3_client_config({**config, **overrides}).merge(Config(
+        max_pool_connections=_client_settings()['max_pool_connections'],
+        tcp_keepalive=True,
+    ))
+    kwargs = {'config': client_config}
+    if config.get('endpoint_url'):
+        kwargs['endpoint_url'] = config['endpoint_url']
+    # 资源类只用于之后包装共享客户端；资源自带的客户端不会发出请求，连接池按需创建
+    resource = session.resource('s3', **kwargs)
+    entry = _ClientEntry(
+        client=session.client('s3', **kwargs),
+        resource_class=type(resource),
+        config_id=str(config_id) if config_id else None,
+        endpoint=config.get('endpoint_url') or 'aws',
+    )
+
+    def count_request(http_response=None, **_):
+        entry.requests += 1
+        if http_response is not None and http_response.status_code >= 500:
+            entry.errors += 1
+
+    def count_error(**_):
+        entry.requests += 1
+        entry.errors += 1
+
+    entry.client.meta.events.register('after-call.s3', count_request)
+    entry.client.meta.events.register('after-call-error.s3', count_error)
+    return entry
+
+
+def _get_entry(config: Dict[str, Any], config_id=None, **overrides) -> _ClientEntry:
+    key = _client_key(config, config_id, overrides)
+    with _lock:
+        entry = _clients.get(key)
+        if entry is not None:
+            _clients.move_to_end(key)
+            return entry
+        entry = _build_entry(config, config_id, overrides)
+        _clients[key] = entry
+        # 淘汰时不关闭客户端：其他线程可能还在用它发请求，没有引用后由垃圾回收释放连接池
+        while len(_clients) > _client_settings()['cache_size']:
+            _clients.popitem(last=False)
+    return entry
+
+
+def get_s3_client(config: Dict[str, Any], config_id=None, **overrides):
+    """
+    获取共享的 S3 客户端
+
+    Args:
+        config: UserStorageSettings.get_s3_config() 返回的字典
+        config_id: 存储配置 ID，传入时客户端经过熔断检查
+        overrides: 覆盖超时与重试设置（如 max_attempts=1）
+    """
+    return _get_entry(config, config_id, **overrides).client
+
+
+def get_s3_resource(config: Dict[str, Any], config_id=None):
+    """获取当前线程的 S3 资源对象，底层使用共享客户端"""
+    entry = _get_entry(config, config_id)
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+    resource = resources.get(id(entry))
+    if resource is None or resource.meta.client is not entry.client:
+        resource = resources[id(entry)] = entry.resource_class(client=entry.client)
+    return resource
+
+
+def _pool_info(client) -> List[Dict[str, Any]]:
+    """读取 urllib3 连接池状态（botocore 内部结构，读取失败时返回空列表）"""
+    try:
+        manager = client._endpoint.http_session._manager
+        pools = [manager.pools[key] for key in manager.pools.keys()]
+    except Exception:
+        return []
+    info = []
+    for pool in pools:
+        info.append({
+            'host': f"{pool.host}:{pool.port}",
+            'connections_created': pool.num_connections,
+            'requests': pool.num_requests,
+            # 队列中预先放了 None 占位，只统计真正保持着的连接
+            'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+        })
+    return info
+
+
+def pool_stats() -> Dict[str, Any]:
+    """各共享客户端的请求数和连接池状态"""
+    with _lock:
+        entries = list(_clients.values())
+    clients = []
+    for entry in entries:
+        pools = _pool_info(entry.client)
+        clients.append({
+            'config_id': entry.config_id,
+            'endpoint': entry.endpoint,
+            'created_at': entry.created_at,
+            'requests': entry.requests,
+            'errors': entry.errors,
+            'connections_created': sum(pool['connections_created'] for pool in pools),
+            'idle_connections': sum(pool['idle_connections'] for pool in pools),
+            'pools': pools,
+        })
+    return {
+        'max_pool_connections': _client_settings()['max_pool_connections'],
+        'cache_size': _client_settings()['cache_size'],
+        'clients': clients,
+    }
+
+
+def clear_clients() -> None:
+    """清空缓存的客户端（不关闭，正在使用的请求不受影响）"""
+    with _lock:
+        _clients.clear()
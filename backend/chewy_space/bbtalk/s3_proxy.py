@@ -0,0 +1,98 @@
+"""
+S3 附件的服务器转发
+
+默认 S3 附件的预览/下载重定向到签名地址，由浏览器直接从 S3 读取（Range 由 S3 处理）。
+端点只能从服务器访问（内网 MinIO）或客户端不跟随媒体请求的重定向时，可以改为服务器转发：
+存储配置开启 s3_proxy_downloads，或设置 S3_PROXY_DOWNLOADS 对所有 S3 存储开启。
+
+- Range 请求转成 GetObject 的 Range（多段时逐段请求），返回 206 与对应的 Content-Range
+- 响应体按块流式输出，内存占用与文件大小无关
+- 客户端断开时 WSGI 服务器关闭响应，随即关闭上游响应体，不会继续占用 S3 连接
+"""
+import logging
+from typing import Iterator, Optional
+
+from django.conf import settings
+from chewy_attachment.core.storage import BaseStorageEngine
+
+from .storage_io import s3_backend, s3_key
+
+logger = logging.getLogger(__name__)
+
+# 转发时每次从上游读取的块大小
+PROXY_CHUNK_SIZE = 64 * 1024
+
+
+class S3ObjectNotFound(Exception):
+    """S3 中不存在该对象"""
+    pass
+
+
+def proxy_downloads_enabled(engine: BaseStorageEngine) -> bool:
+    """该存储的附件是否由服务器转发（不是 S3 时返回 False）"""
+    backend = s3_backend(engine)
+    if backend is None:
+        return False
+    if getattr(settings, 'CHEWY_ATTACHMENT', {}).get('S3_PROXY_DOWNLOADS', False):
+        return True
+    return bool((getattr(backend, 's3_config', None) or {}).get('proxy_downloads'))
+
+
+class S3ObjectStream:
+    """
+    GetObject 响应体的流式包装
+
+    迭代时按块读取；迭代结束或响应关闭（包括客户端中途断开）时关闭上游响应体
+    """
+
+    def __init__(self, body, content_length: int, content_range: Optional[str] = None):
+        self.body = body
+        self.content_length = content_length
+        self.content_range = content_range
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            while True:
+                chunk = self.body.read(PROXY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+def open_s3_object(
+    engine: BaseStorageEngine,
+    storage_path: str,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+) -> S3ObjectStream:
+    """
+    打开 S3 对象（或其中 start-end 的字节范围，含两端）
+
+    Raises:
+        S3ObjectNotFound: 对象不存在
+    """
+    from botocore.exceptions import ClientError
+
+    backend = s3_backend(engine)
+    params = {'Bucket': backend.bucket_name, 'Key': s3_key(backend, storage_path)}
+    if start is not None:
+        params['Range'] = f'bytes={start}-{end}'
+    try:
+        response = backend.connection.meta.client.get_object(**params)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            raise S3ObjectNotFound(storage_path) from e
+        raise
+    return S3ObjectStream(response['Body'], response['ContentLength'], response.get('ContentRange'))
+
+
+def iter_s3_range(engine: BaseStorageEngine, storage_path: str, start: int, end: int) -> Iterator[bytes]:
+    """按块读取 S3 对象的一段，用于多段 Range 响应逐段请求"""
+    yield from open_s3_object(engine, storage_path, start, end)
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from rest_framework.request import Request
-from .models import BBTalk, Tag, generate_tag_color, User, UserStorageSettings, Comment
+from chewy_attachment.django_app.serializers import AttachmentSerializer as BaseAttachmentSerializer
+from .models import BBTalk, Tag, generate_tag_color, User, UserStorageSettings, Comment, Attachment, StorageMigrationJob
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -11,6 +12,19 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'username', 'is_staff', 'create_time', 'last_login')
 
 
+class CurrentUserSerializer(UserSerializer):
+    """当前用户序列化器，附带各存储的用量和配额"""
+    storage_usage = serializers.SerializerMethodField()
+
+    class Meta(UserSerializer.Meta):
+        fields = UserSerializer.Meta.fields + ('storage_usage',)
+
+    def get_storage_usage(self, obj) -> dict:
+        from .storage_usage import get_user_usage
+
+        return get_user_usage(obj)
+
+
 class TagSerializer(serializers.ModelSerializer):
     bbtalk_count = serializers.IntegerField(read_only=True)
     
@@ -66,6 +80,23 @@ class BBTalkSerializer(serializers.ModelSerializer):
         self.save_tags(instance, tag_names)
         return super().update(instance, validated_data)
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # 公开接口通过 context['public_attachment_urls'] 传入公开附件的无签名地址，替换附件原有地址
+        public_urls = self.context.get('public_attachment_urls')
+        if public_urls:
+            request = self.context.get('request')
+            attachments = []
+            for item in data.get('attachments') or []:
+                public_url = isinstance(item, dict) and public_urls.get(str(item.get('uid') or item.get('id')).lower())
+                if public_url:
+                    if public_url.startswith('/') and request is not None:
+                        public_url = request.build_absolute_uri(public_url)
+                    item = {**item, 'url': public_url}
+                attachments.append(item)
+            data['attachments'] = attachments
+        return data
+
     class Meta:
         model = BBTalk
         fields = ('uid', 'user', 'post_tags', 'content', 'visibility', 'context', 'tags', 'attachments', 'is_pinned', 'comment_count', 'create_time', 'update_time')
@@ -88,6 +119,12 @@ class UserStorageSettingsSerializer(serializers.ModelSerializer):
     
     # S3 配置是否完整
     is_s3_configured = serializers.SerializerMethodField()
+
+    # 该存储下的附件数、已用字节数和配额
+    usage = serializers.SerializerMethodField()
+
+    # 熔断状态：closed 正常，open 表示连续失败后暂停访问
+    health = serializers.SerializerMethodField()
     
     class Meta:
         model = UserStorageSettings
@@ -101,13 +138,28 @@ class UserStorageSettingsSerializer(serializers.ModelSerializer):
             's3_region_name',
             's3_endpoint_url',
             's3_custom_domain',
+            's3_public_prefix',
+            's3_proxy_downloads',
+            's3_connect_timeout',
+            's3_read_timeout',
+            's3_max_attempts',
             'is_active',
             'has_secret_key',
             'is_s3_configured',
+            'usage',
+            'benchmark',
+            'health',
             'create_time',
             'update_time',
         )
-        read_only_fields = ('id', 'has_secret_key', 'is_s3_configured', 'create_time', 'update_time')
+        read_only_fields = (
+            'id', 'has_secret_key', 'is_s3_configured', 'usage', 'benchmark', 'health', 'create_time', 'update_time',
+        )
+        extra_kwargs = {
+            's3_connect_timeout': {'min_value': 0.1, 'max_value': 60},
+            's3_read_timeout': {'min_value': 0.1, 'max_value': 300},
+            's3_max_attempts': {'min_value': 1, 'max_value': 10},
+        }
     
     def get_has_secret_key(self, obj) -> bool:
         """检查是否已配置密钥"""
@@ -116,11 +168,37 @@ class UserStorageSettingsSerializer(serializers.ModelSerializer):
     def get_is_s3_configured(self, obj) -> bool:
         """检查 S3 配置是否完整"""
         return obj.is_s3_configured()
+
+    def get_usage(self, obj) -> dict:
+        """列表接口通过 context['usage_map'] 传入用户的全部用量，避免逐个查询"""
+        from .models import StorageUsage
+        from .storage_usage import usage_entry
+
+        usage_map = self.context.get('usage_map')
+        if usage_map is not None:
+            usage = usage_map.get(str(obj.id))
+        else:
+            usage = StorageUsage.objects.filter(user_id=obj.user_id, storage_config_id=str(obj.id)).first()
+        return usage_entry(obj.id, usage)
+
+    def get_health(self, obj) -> dict:
+        from .storage_health import get_health
+
+        return get_health(obj.id)
     
     def update(self, instance, validated_data):
         # 如果没有提供新的密钥，保留原有密钥
         if 's3_secret_access_key' not in validated_data or not validated_data.get('s3_secret_access_key'):
             validated_data.pop('s3_secret_access_key', None)
+        # 端点或存储桶变化后，之前的性能测试结果和熔断状态不再适用
+        if any(
+            field in validated_data and validated_data[field] != getattr(instance, field)
+            for field in ('s3_endpoint_url', 's3_bucket_name', 's3_region_name')
+        ):
+            from .storage_health import reset_health
+
+            instance.benchmark = {}
+            reset_health(instance.id)
         return super().update(instance, validated_data)
 
 
@@ -133,3 +211,66 @@ class CommentSerializer(serializers.ModelSerializer):
         model = Comment
         fields = ('uid', 'user', 'user_display_name', 'user_avatar', 'user_username', 'bbtalk', 'content', 'create_time', 'update_time')
         read_only_fields = ('uid', 'user', 'user_display_name', 'user_avatar', 'user_username', 'bbtalk', 'create_time', 'update_time')
+
+
+class StorageMigrationJobSerializer(serializers.ModelSerializer):
+    """存储迁移任务序列化器，附带完成数、速率和预计剩余时间"""
+
+    class Meta:
+        model = StorageMigrationJob
+        fields = (
+            'id',
+            'target_config_id',
+            'status',
+            'total',
+            'migrated',
+            'failed',
+            'bytes_total',
+            'bytes_done',
+            'errors',
+            'error',
+            'cancel_requested',
+            'created_at',
+            'finished_at',
+        )
+        read_only_fields = fields
+
+    def to_representation(self, instance):
+        from .migration_jobs import job_progress
+
+        data = super().to_representation(instance)
+        data.update(job_progress(instance))
+        return data
+
+
+class AttachmentSerializer(BaseAttachmentSerializer):
+    """附件序列化器，额外返回后台处理得到的媒体信息（图片尺寸、缩略图等）"""
+    media_info = serializers.JSONField(read_only=True)
+
+    class Meta(BaseAttachmentSerializer.Meta):
+        model = Attachment
+        fields = BaseAttachmentSerializer.Meta.fields + ['media_info', 'public_url', 'original_size']
+        read_only_fields = fields
+
+    def get_file_url(self, obj):
+        """
+        云存储返回按时间桶缓存的签名 URL，本地存储和开启服务器转发的 S3 存储返回下载地址
+
+        列表序列化时按存储配置复用存储引擎
+        """
+        from .s3_proxy import proxy_downloads_enabled
+        from .signed_urls import get_cached_file_url
+        from .storage import get_attachment_storage_engine, is_cloud_storage_engine
+
+        try:
+            if not hasattr(self, '_storage_engines'):
+                self._storage_engines = {}
+            engines = self._storage_engines
+            if obj.storage_config_id not in engines:
+                engines[obj.storage_config_id] = get_attachment_storage_engine(obj.storage_config_id)
+            storage = engines[obj.storage_config_id]
+            if not is_cloud_storage_engine(storage) or proxy_downloads_enabled(storage):
+                return self.get_download_url(obj)
+            return get_cached_file_url(storage, obj.storage_config_id, obj.storage_path)[0]
+        except Exception:
+            return self.get_download_url(obj)
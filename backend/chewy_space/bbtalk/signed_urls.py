@@ -0,0 +1,71 @@
+"""
+S3 签名 URL 缓存
+
+签名里带有签名时间，每次调用 storage.get_file_url 都会得到不同的 URL，
+浏览器和 CDN 因此永远无法命中缓存。这里把时间按固定长度分桶，
+同一 (存储配置, 路径, 时间桶) 只签名一次并写入 Django 缓存，
+桶内所有请求（多 worker 时需共享缓存后端）拿到完全相同的 URL。
+
+桶长度不超过签名有效期的一半，因此返回的 URL 至少还有一半有效期。
+"""
+import hashlib
+import logging
+import time
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = 'bbtalk:signed_url'
+
+# 与 UserS3Storage / S3Boto3Storage 的默认签名有效期一致
+DEFAULT_SIGNED_URL_EXPIRE = 3600
+
+
+def _bucket_seconds(engine) -> int:
+    expire = getattr(getattr(engine, 'storage', None), 'querystring_expire', None) or DEFAULT_SIGNED_URL_EXPIRE
+    bucket = getattr(settings, 'CHEWY_ATTACHMENT', {}).get('SIGNED_URL_CACHE_BUCKET', 1800)
+    return max(1, min(bucket, expire // 2))
+
+
+def get_cached_file_url(engine, storage_config_id: Optional[str], storage_path: str) -> Tuple[str, int]:
+    """
+    获取缓存的签名 URL
+
+    Args:
+        engine: 附件所在的云存储引擎
+        storage_config_id: 存储配置 ID，用于区分不同存储桶中的同名路径
+        storage_path: 文件存储路径
+
+    Returns:
+        (url, ttl)，ttl 为该 URL 在当前时间桶内还能复用的秒数，可用作响应的 max-age；
+        缓存不可用时直接签名，ttl 为 0
+    """
+    now = time.time()
+    bucket_seconds = _bucket_seconds(engine)
+    bucket = int(now // bucket_seconds)
+    ttl = max(1, int((bucket + 1) * bucket_seconds - now))
+
+    # 存储桶或自定义域名修改后不应再返回旧 URL，一并计入 key
+    backend = getattr(engine, 'storage', None)
+    target = f"{getattr(backend, 'bucket_name', '')}|{getattr(backend, 'custom_domain', '')}|{storage_path}"
+    target_hash = hashlib.sha1(target.encode('utf-8')).hexdigest()
+    key = f"{CACHE_KEY_PREFIX}:{storage_config_id or ''}:{bucket}:{target_hash}"
+
+    try:
+        url = cache.get(key)
+    except Exception as e:
+        logger.warning(f"读取签名 URL 缓存失败: {e}")
+        return engine.get_file_url(storage_path), 0
+
+    if url is None:
+        url = engine.get_file_url(storage_path)
+        try:
+            # add 只在 key 不存在时写入：并发签名时以先写入的为准，保证桶内 URL 一致
+            if not cache.add(key, url, ttl):
+                url = cache.get(key) or url
+        except Exception as e:
+            logger.warning(f"写入签名 URL 缓存失败: {e}")
+    return url, ttl
@@ -8,6 +8,9 @@ from typing import Optional
 from storages.backends.s3boto3 import S3Boto3Storage
 from django.core.files.storage import default_storage
 
+from .s3_clients import get_s3_resource
+from .storage_health import s3_client_config
+
 logger = logging.getLogger(__name__)
 
 
@@ -15,7 +18,8 @@ class UserS3Storage(S3Boto3Storage):
     """
     用户自定义 S3 存储后端
     
-    根据用户的存储设置动态配置 S3 连接参数
+    根据用户的存储设置动态配置 S3 连接参数；连接使用 s3_clients 中按配置共享的客户端和连接池，
+    传入 UserStorageSettings 时按配置设置超时与重试，并经过熔断检查（见 storage_health）
     """
     
     def __init__(self, user_settings=None, **kwargs):
@@ -25,6 +29,8 @@ class UserS3Storage(S3Boto3Storage):
         Args:
             user_settings: UserStorageSettings 实例或配置字典
         """
+        self.storage_config_id = None
+        self.s3_config = None
         if user_settings is None:
             super().__init__(**kwargs)
             return
@@ -32,8 +38,10 @@ class UserS3Storage(S3Boto3Storage):
         # 如果是 UserStorageSettings 模型实例
         if hasattr(user_settings, 'get_s3_config'):
             config = user_settings.get_s3_config()
+            self.storage_config_id = user_settings.id
         else:
             config = user_settings
+        self.s3_config = config
         
         # 设置 S3 参数
         kwargs['access_key'] = config.get('access_key_id')
@@ -54,6 +62,13 @@ class UserS3Storage(S3Boto3Storage):
         kwargs.setdefault('querystring_expire', 3600)
         
         super().__init__(**kwargs)
+        self.client_config = self.client_config.merge(s3_client_config(config))
+
+    @property
+    def connection(self):
+        if self.s3_config is None:
+            return super().connection
+        return get_s3_resource(self.s3_config, self.storage_config_id)
 
 
 def get_user_storage(user) -> Optional[S3Boto3Storage]:
@@ -101,3 +116,43 @@ def get_storage_for_user(user):
     if user_storage:
         return user_storage
     return default_storage
+
+
+def get_attachment_storage_engine(storage_config_id: Optional[str] = None):
+    """
+    获取附件所在的存储引擎（供后台任务等脱离请求的场景使用）
+
+    与 AttachmentViewSet.get_storage_engine 规则一致：配置了可用的 S3 时返回
+    DjangoStorageEngine(UserS3Storage)，否则退回 ChewyAttachment 的默认存储（本地文件）
+    """
+    from chewy_attachment.core.storage import DjangoStorageEngine
+    from chewy_attachment.django_app.storage import get_storage_engine_for_attachment
+
+    if storage_config_id:
+        from .models import UserStorageSettings
+
+        settings_obj = UserStorageSettings.objects.filter(id=storage_config_id, is_active=True).first()
+        if settings_obj and settings_obj.is_s3_configured():
+            return DjangoStorageEngine(UserS3Storage(user_settings=settings_obj))
+        logger.warning(f"配置 ID {storage_config_id} 不存在或未配置完整，使用默认存储")
+
+    return get_storage_engine_for_attachment(storage_config_id)
+
+
+def is_cloud_storage_engine(engine) -> bool:
+    """
+    判断存储引擎是否为云存储（文件不在本地磁盘，需要重定向到 URL）
+
+    Django 的 Storage 基类本身定义了 path()，只是会抛 NotImplementedError，
+    所以不能像 chewy_attachment 的 _is_cloud_storage 那样用 hasattr 判断
+    """
+    from chewy_attachment.core.storage import DjangoStorageEngine, S3StorageEngine
+
+    if isinstance(engine, S3StorageEngine):
+        return True
+    if isinstance(engine, DjangoStorageEngine):
+        try:
+            engine.storage.path('')
+        except NotImplementedError:
+            return True
+    return False
@@ -0,0 +1,145 @@
+"""
+附件存储巡检
+
+并行检查附件记录对应的存储对象是否存在、大小是否一致；
+深度模式下流式读取对象重新计算哈希，与上传时记录的内容哈希比较，找出损坏的文件。
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Any, Optional
+
+from django.db.models import Q
+
+from .models import Attachment, User
+from .storage_io import hash_object, stat_object
+from .storage_migration import StorageMigrationService, migration_workers
+
+logger = logging.getLogger(__name__)
+
+# 每批提交给线程池的附件数，避免一次性为所有附件创建任务
+AUDIT_BATCH_SIZE = 500
+
+STATUS_OK = 'ok'
+STATUS_MISSING = 'missing'
+STATUS_SIZE_MISMATCH = 'size_mismatch'
+STATUS_CORRUPT = 'corrupt'
+STATUS_ERROR = 'error'
+
+
+class AttachmentAuditService:
+    """附件存储巡检服务"""
+
+    def __init__(self, deep: bool = False, workers: Optional[int] = None):
+        self.deep = deep
+        self.workers = workers or migration_workers()
+        self._services: Dict[int, StorageMigrationService] = {}
+        self.report = {
+            'total': 0,
+            STATUS_OK: 0,
+            STATUS_MISSING: 0,
+            STATUS_SIZE_MISMATCH: 0,
+            STATUS_CORRUPT: 0,
+            STATUS_ERROR: 0,
+            'unverified': 0,
+            'problems': [],
+        }
+
+    def _get_engine(self, attachment: Attachment):
+        """按附件所有者和存储配置获取存储引擎（复用迁移服务的引擎缓存）"""
+        service = self._services.get(attachment.owner_id)
+        if service is None:
+            service = StorageMigrationService(User(id=attachment.owner_id))
+            self._services[attachment.owner_id] = service
+        return service.get_engine(attachment.storage_config_id or None)
+
+    def audit(self, queryset) -> Dict[str, Any]:
+        """
+        巡检查询集中的附件
+
+        Returns:
+            各状态计数和问题列表
+        """
+        iterator = queryset.order_by().iterator()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bbtalk-audit') as executor:
+            while True:
+                batch = list(islice(iterator, AUDIT_BATCH_SIZE))
+                if not batch:
+                    break
+                # 引擎构建需要查库，在主线程完成；工作线程只访问存储
+                tasks = []
+                for attachment in batch:
+                    try:
+                        tasks.append((attachment, self._get_engine(attachment)))
+                    except ValueError as e:
+                        self._record(attachment, STATUS_ERROR, str(e))
+                for attachment, result in zip(
+                    [attachment for attachment, _ in tasks],
+                    executor.map(lambda task: self._check(*task), tasks),
+                ):
+                    self._record(attachment, *result)
+        logger.info(
+            f"附件巡检完成: {self.report['total']} 个, 缺失 {self.report[STATUS_MISSING]}, "
+            f"大小不符 {self.report[STATUS_SIZE_MISMATCH]}, 损坏 {self.report[STATUS_CORRUPT]}, "
+            f"错误 {self.report[STATUS_ERROR]}"
+        )
+        return self.report
+
+    def _check(self, attachment: Attachment, engine) -> tuple:
+        """检查单个附件，返回 (状态, 说明, 是否做了内容校验)"""
+        try:
+            info = stat_object(engine, attachment.storage_path)
+            if info is None:
+                return STATUS_MISSING, '存储中不存在该对象', False
+            if info.size != attachment.size:
+                return STATUS_SIZE_MISMATCH, f'记录 {attachment.size} 字节，实际 {info.size} 字节', False
+            if not self.deep:
+                return STATUS_OK, '', False
+            if not attachment.content_hash:
+                # 没有记录内容哈希的老附件只能确认存在且大小一致
+                return STATUS_OK, '', False
+            if hash_object(engine, attachment.storage_path).sha256 != attachment.content_hash:
+                return STATUS_CORRUPT, '内容哈希与上传时记录的不一致', True
+            return STATUS_OK, '', True
+        except Exception as e:
+            return STATUS_ERROR, str(e), False
+
+    def _record(self, attachment: Attachment, status: str, detail: str, verified: bool = False) -> None:
+        self.report['total'] += 1
+        self.report[status] += 1
+        if self.deep and status == STATUS_OK and not verified:
+            self.report['unverified'] += 1
+        if status != STATUS_OK:
+            self.report['problems'].append({
+                'id': str(attachment.id),
+                'owner_id': attachment.owner_id,
+                'storage_config_id': attachment.storage_config_id or None,
+                'storage_path': attachment.storage_path,
+                'status': status,
+                'detail': detail,
+            })
+
+
+def audit_attachments(
+    user: Optional[User] = None,
+    storage_config_id: Optional[str] = None,
+    deep: bool = False,
+    workers: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    巡检用户或存储配置下的附件
+
+    Args:
+        user: 只检查该用户的附件
+        storage_config_id: 只检查该存储配置下的附件，'' 表示本地存储
+        deep: 是否重新读取对象校验内容哈希
+    """
+    queryset = Attachment.objects.all()
+    if user is not None:
+        queryset = queryset.filter(owner_id=user.id)
+    if storage_config_id is not None:
+        if storage_config_id:
+            queryset = queryset.filter(storage_config_id=storage_config_id)
+        else:
+            queryset = queryset.filter(Q(storage_config_id='') | Q(storage_config_id__isnull=True))
+    return AttachmentAuditService(deep=deep, workers=workers).audit(queryset)
@@ -0,0 +1,149 @@
+"""
+S3 存储性能测试
+
+连接测试只能证明存储可访问，无法判断 MinIO/OSS 等端点是否够快。性能测试向存储桶写入并读取
+一组小对象和大对象，统计 PUT/GET 延迟分位数和吞吐量，结束后删除测试对象。
+
+结果保存在 UserStorageSettings.benchmark 上：迁移预览在没有实测迁移速率时用它估算耗时。
+"""
+import logging
+import math
+import os
+import time
+import uuid
+from typing import Dict, Any, List, Optional
+
+from django.utils import timezone
+
+from .models import UserStorageSettings
+from .s3_clients import get_s3_client
+
+logger = logging.getLogger(__name__)
+
+# 测试对象的前缀，不在附件路径规则（YYYY/MM/DD/、cas/）内，附件回收不会处理
+BENCHMARK_PREFIX = '.chewy-benchmark'
+
+# (名称, 对象大小, 对象数)：小对象衡量请求延迟，大对象衡量带宽
+BENCHMARK_PROFILES = (
+    ('small', 64 * 1024, 10),
+    ('large', 4 * 1024 * 1024, 3),
+)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """最近秩法计算分位数"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _latency_summary(seconds: List[float]) -> Dict[str, float]:
+    millis = [value * 1000 for value in seconds]
+    return {
+        'p50': round(percentile(millis, 50), 1),
+        'p90': round(percentile(millis, 90), 1),
+        'p99': round(percentile(millis, 99), 1),
+        'max': round(max(millis), 1),
+    }
+
+
+def _throughput(size: int, seconds: List[float]) -> int:
+    total = sum(seconds)
+    return int(size * len(seconds) / total) if total > 0 else 0
+
+
+class StorageBenchmark:
+    """对一个 S3 配置执行性能测试"""
+
+    def __init__(self, storage_settings: UserStorageSettings, profiles=BENCHMARK_PROFILES):
+        self.storage_settings = storage_settings
+        self.profiles = profiles
+        config = storage_settings.get_s3_config()
+        self.bucket = config['bucket_name']
+        self.client = self._build_client(config)
+
+    @staticmethod
+    def _build_client(config: Dict[str, Any]):
+        return get_s3_client(config)
+
+    def run(self) -> Dict[str, Any]:
+        """
+        执行测试并保存结果
+
+        Returns:
+            {'measured_at', 'small': {...}, 'large': {...}}，每组包含对象大小、数量、
+            put_ms/get_ms 延迟分位数和 put/get 吞吐量（字节/秒）
+        """
+        prefix = f"{BENCHMARK_PREFIX}/{uuid.uuid4().hex}"
+        written: List[str] = []
+        result: Dict[str, Any] = {}
+        try:
+            for name, size, count in self.profiles:
+                result[name] = self._run_profile(prefix, name, size, count, written)
+        finally:
+            self._cleanup(written)
+
+        result['measured_at'] = timezone.now().isoformat()
+        UserStorageSettings.objects.filter(id=self.storage_settings.id).update(benchmark=result)
+        self.storage_settings.benchmark = result
+        logger.info(
+            f"存储性能测试 {self.storage_settings.name}: "
+            + ', '.join(
+                f"{name} PUT p50 {result[name]['put_ms']['p50']}ms GET p50 {result[name]['get_ms']['p50']}ms"
+                for name, _, _ in self.profiles
+            )
+        )
+        return result
+
+    def _run_profile(self, prefix: str, name: str, size: int, count: int, written: List[str]) -> Dict[str, Any]:
+        payload = os.urandom(size)
+        put_seconds, get_seconds = [], []
+        for index in range(count):
+            key = f"{prefix}/{name}-{index}"
+            started = time.perf_counter()
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=payload)
+            put_seconds.append(time.perf_counter() - started)
+            written.append(key)
+
+            started = time.perf_counter()
+            body = self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+            received = len(body.read())
+            get_seconds.append(time.perf_counter() - started)
+            if received != size:
+                raise ValueError(f'读取的测试对象大小不一致: 期望 {size}，实际 {received}')
+        return {
+            'size': size,
+            'count': count,
+            'put_ms': _latency_summary(put_seconds),
+            'get_ms': _latency_summary(get_seconds),
+            'put_bytes_per_second': _throughput(size, put_seconds),
+            'get_bytes_per_second': _throughput(size, get_seconds),
+        }
+
+    def _cleanup(self, keys: List[str]) -> None:
+        if not keys:
+            return
+        try:
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+            )
+        except Exception as e:
+            # 部分 S3 兼容存储不支持批量删除，逐个删除
+            logger.warning(f"批量删除测试对象失败，逐个删除: {e}")
+            for key in keys:
+                try:
+                    self.client.delete_object(Bucket=self.bucket, Key=key)
+                except Exception as e:
+                    logger.warning(f"删除测试对象失败: {key}: {e}")
+
+
+def benchmark_rate(benchmark: Optional[Dict[str, Any]], direction: str) -> Optional[float]:
+    """
+    性能测试得到的单线程大对象吞吐量（字节/秒）
+
+    Args:
+        direction: 'put' 或 'get'
+    """
+    large = (benchmark or {}).get('large') or {}
+    return large.get(f'{direction}_bytes_per_second') or None
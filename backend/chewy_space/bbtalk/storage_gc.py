@@ -0,0 +1,312 @@
+"""
+附件垃圾回收
+
+BBTalk.attachments 只是 JSON，删除 BBTalk 不会删除附件；发布框里上传后放弃的附件也会一直留着。
+回收分两步：
+
+1. 孤立附件记录：超过宽限期、且没有被任何 BBTalk.attachments、BBTalk 正文、评论或用户头像引用的
+   Attachment，释放其存储文件（去重文件按引用计数）后删除记录
+2. 孤立存储对象：分页列出存储中的对象（S3 list_objects_v2 / 本地目录遍历），
+   与 Attachment、StorageBlob 和缩略图路径做集合比对，超过宽限期且无人引用的对象
+   按批删除（S3 DeleteObjects 每次 1000 个）
+
+只处理本应用生成的路径（YYYY/MM/DD/... 与 cas/...），不会触碰存储桶里的其他文件。
+默认宽限期 24 小时，避免删掉正在上传或刚上传还没发布的文件。
+"""
+import logging
+import os
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from chewy_attachment.core.storage import FileStorageEngine
+
+from .blob_storage import release_attachment_files
+from .models import Attachment, BBTalk, Comment, StorageBlob, User, UserStorageSettings
+from .storage_io import s3_backend
+from .storage_migration import StorageMigrationService
+from .storage_usage import record_attachment_removed
+
+logger = logging.getLogger(__name__)
+
+# 附件接口 URL 中的附件 ID
+ATTACHMENT_URL_RE = re.compile(
+    r'/attachments/files/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})',
+    re.IGNORECASE,
+)
+
+# 本应用写入的存储路径：库生成的 YYYY/MM/DD/<uuid>.<ext> 与去重存储的 cas/ab/cd/<hash>.<ext>
+APP_PATH_RE = re.compile(r'^(\d{4}/\d{2}/\d{2}/|cas/[0-9a-f]{2}/[0-9a-f]{2}/)[^/]+$')
+
+# 列举对象和删除对象的批大小（S3 DeleteObjects 单次上限 1000）
+GC_PAGE_SIZE = 1000
+
+# 报告中保留的样例路径数
+REPORT_SAMPLE_SIZE = 20
+
+
+@dataclass
+class StoredObject:
+    """存储中的一个对象"""
+    path: str
+    size: int
+    modified: datetime
+
+
+def _grace_hours() -> float:
+    return getattr(settings, 'CHEWY_ATTACHMENT', {}).get('GC_GRACE_HOURS', 24)
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def comment_attachment_ids() -> Set[str]:
+    """所有评论正文中引用的附件 ID（小写）"""
+    referenced: Set[str] = set()
+    rows = Comment.objects.filter(content__contains='/attachments/files/').values_list('content', flat=True)
+    for content in rows.iterator(chunk_size=2000):
+        referenced.update(match.lower() for match in ATTACHMENT_URL_RE.findall(content or ''))
+    return referenced
+
+
+def referenced_attachment_ids() -> Set[str]:
+    """所有被 BBTalk.attachments、BBTalk 正文、评论或用户头像引用的附件 ID"""
+    referenced: Set[str] = set()
+    rows = BBTalk.objects.values_list('attachments', 'content').iterator(chunk_size=2000)
+    for attachments, content in rows:
+        for item in attachments or []:
+            if not isinstance(item, dict):
+                continue
+            for key in ('uid', 'id'):
+                if item.get(key):
+                    referenced.add(str(item[key]).lower())
+            referenced.update(match.lower() for match in ATTACHMENT_URL_RE.findall(str(item.get('url') or '')))
+        referenced.update(match.lower() for match in ATTACHMENT_URL_RE.findall(content or ''))
+    referenced.update(comment_attachment_ids())
+    for avatar in User.objects.exclude(avatar='').values_list('avatar', flat=True).iterator():
+        referenced.update(match.lower() for match in ATTACHMENT_URL_RE.findall(avatar or ''))
+    return referenced
+
+
+def referenced_storage_paths() -> Dict[str, Set[str]]:
+    """
+    按存储配置汇总仍被引用的存储路径（附件原文件、缩略图、去重文件）
+
+    Returns:
+        {存储配置 ID（本地为 ''）: 路径集合}
+    """
+    paths: Dict[str, Set[str]] = {}
+    rows = Attachment.objects.values_list('storage_config_id', 'storage_path', 'media_info').iterator(chunk_size=2000)
+    for config_id, storage_path, media_info in rows:
+        config_paths = paths.setdefault(str(config_id or ''), set())
+        config_paths.add(storage_path)
+        for derivative in ((media_info or {}).get('derivatives') or {}).values():
+            if derivative.get('path'):
+                config_paths.add(derivative['path'])
+    for config_id, storage_path in StorageBlob.objects.values_list('storage_config_id', 'storage_path').iterator():
+        paths.setdefault(str(config_id or ''), set()).add(storage_path)
+    return paths
+
+
+class StorageGarbageCollector:
+    """附件垃圾回收器"""
+
+    def __init__(self, dry_run: bool = True, grace_hours: Optional[float] = None):
+        self.dry_run = dry_run
+        self.cutoff = timezone.now() - timedelta(hours=_grace_hours() if grace_hours is None else grace_hours)
+        self._services: Dict[int, StorageMigrationService] = {}
+        self.report = {
+            'dry_run': dry_run,
+            'orphan_attachments': 0,
+            'orphan_attachment_bytes': 0,
+            'deleted_attachments': 0,
+            'scanned_objects': 0,
+            'orphan_objects': 0,
+            'orphan_object_bytes': 0,
+            'deleted_objects': 0,
+            'samples': [],
+            'errors': [],
+        }
+
+    def _engine_for(self, owner_id: int, config_id: Optional[str]):
+        """按所有者获取存储引擎（复用迁移服务的引擎缓存，停用的配置也能访问）"""
+        service = self._services.get(owner_id)
+        if service is None:
+            service = StorageMigrationService(User(id=owner_id))
+            self._services[owner_id] = service
+        return service.get_engine(config_id or None)
+
+    def _sample(self, description: str) -> None:
+        if len(self.report['samples']) < REPORT_SAMPLE_SIZE:
+            self.report['samples'].append(description)
+
+    def _error(self, message: str) -> None:
+        logger.warning(f"附件回收: {message}")
+        self.report['errors'].append(message)
+
+    def run(self, attachments: bool = True, objects: bool = True) -> Dict[str, Any]:
+        """执行回收；先回收附件记录，释放出的文件在同一次运行中一并删除"""
+        if attachments:
+            self.collect_attachments()
+        if objects:
+            self.collect_objects()
+        logger.info(
+            f"附件回收{'（试运行）' if self.dry_run else ''}: "
+            f"孤立附件 {self.report['orphan_attachments']} 个, 孤立对象 {self.report['orphan_objects']} 个, "
+            f"已删除附件 {self.report['deleted_attachments']} 个, 已删除对象 {self.report['deleted_objects']} 个"
+        )
+        return self.report
+
+    # ---- 孤立附件记录 ----
+
+    def collect_attachments(self) -> None:
+        """回收没有被任何内容引用的附件记录"""
+        referenced = referenced_attachment_ids()
+        candidates = Attachment.objects.filter(created_at__lt=self.cutoff).values_list('id', flat=True).iterator()
+        orphan_ids = [attachment_id for attachment_id in candidates if str(attachment_id).lower() not in referenced]
+
+        for batch in _chunked(orphan_ids, GC_PAGE_SIZE):
+            for attachment in Attachment.objects.filter(id__in=batch):
+                self.report['orphan_attachments'] += 1
+                self.report['orphan_attachment_bytes'] += attachment.size
+                self._sample(f"attachment {attachment.id} {attachment.original_name} ({attachment.size} bytes)")
+                if self.dry_run:
+                    continue
+                try:
+                    engine = self._engine_for(attachment.owner_id, attachment.storage_config_id)
+                    with transaction.atomic():
+                        release_attachment_files(attachment, engine)
+                        attachment.delete()
+                        record_attachment_removed(attachment)
+                    self.report['deleted_attachments'] += 1
+                except Exception as e:
+                    self._error(f"删除附件 {attachment.id} 失败: {e}")
+
+    # ---- 孤立存储对象 ----
+
+    def _storage_groups(self) -> List[Tuple[str, Any, Set[str]]]:
+        """
+        需要扫描的存储：本地存储和每个 S3 存储桶
+
+        多个配置指向同一存储桶时合并为一组，引用路径取并集，避免把其他配置的文件当成孤立对象
+
+        Returns:
+            [(描述, 存储引擎, 配置 ID 集合)]
+        """
+        groups: Dict[tuple, Tuple[str, Any, Set[str]]] = {
+            ('local',): ('本地存储', self._engine_for(0, None), {''}),
+        }
+        for config in UserStorageSettings.objects.filter(storage_type='s3'):
+            if not config.is_s3_configured():
+                continue
+            try:
+                engine = self._engine_for(config.user_id, str(config.id))
+            except ValueError as e:
+                self._error(str(e))
+                continue
+            backend = s3_backend(engine)
+            key = ('s3', backend.endpoint_url or '', backend.bucket_name, backend.location or '')
+            if key in groups:
+                groups[key][2].add(str(config.id))
+            else:
+                groups[key] = (f"S3 {backend.bucket_name}", engine, {str(config.id)})
+        return list(groups.values())
+
+    def collect_objects(self) -> None:
+        """回收存储中无人引用的对象"""
+        referenced = referenced_storage_paths()
+        for description, engine, config_ids in self._storage_groups():
+            group_paths: Set[str] = set()
+            for config_id in config_ids:
+                group_paths |= referenced.get(config_id, set())
+            try:
+                self._collect_storage(description, engine, group_paths)
+            except Exception as e:
+                self._error(f"扫描 {description} 失败: {e}")
+
+    def _collect_storage(self, description: str, engine, referenced: Set[str]) -> None:
+        for page in self._list_objects(engine):
+            self.report['scanned_objects'] += len(page)
+            orphans = [
+                obj for obj in page
+                if APP_PATH_RE.match(obj.path) and obj.path not in referenced and obj.modified < self.cutoff
+            ]
+            if not orphans:
+                continue
+            self.report['orphan_objects'] += len(orphans)
+            self.report['orphan_object_bytes'] += sum(obj.size for obj in orphans)
+            for obj in orphans:
+                self._sample(f"{description}: {obj.path} ({obj.size} bytes)")
+            if not self.dry_run:
+                self.report['deleted_objects'] += self._delete_objects(engine, [obj.path for obj in orphans])
+
+    def _list_objects(self, engine) -> Iterator[List[StoredObject]]:
+        """分页列出存储中的对象"""
+        backend = s3_backend(engine)
+        if backend is not None:
+            yield from self._list_s3_objects(backend)
+        elif isinstance(engine, FileStorageEngine):
+            yield from _chunked(self._walk_local(engine), GC_PAGE_SIZE)
+
+    @staticmethod
+    def _list_s3_objects(backend) -> Iterator[List[StoredObject]]:
+        prefix = f"{backend.location.strip('/')}/" if backend.location else ''
+        paginator = backend.connection.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+            Bucket=backend.bucket_name,
+            Prefix=prefix,
+            PaginationConfig={'PageSize': GC_PAGE_SIZE},
+        ):
+            yield [
+                StoredObject(path=item['Key'][len(prefix):], size=item['Size'], modified=item['LastModified'])
+                for item in page.get('Contents', [])
+            ]
+
+    @staticmethod
+    def _walk_local(engine: FileStorageEngine) -> Iterator[StoredObject]:
+        root = str(engine.storage_root)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(full_path)
+                except FileNotFoundError:
+                    continue
+                yield StoredObject(
+                    path=os.path.relpath(full_path, root).replace(os.sep, '/'),
+                    size=stat.st_size,
+                    modified=datetime.fromtimestamp(stat.st_mtime, tz=dt_timezone.utc),
+                )
+
+    def _delete_objects(self, engine, paths: List[str]) -> int:
+        """批量删除对象，返回成功删除的数量"""
+        backend = s3_backend(engine)
+        if backend is None:
+            deleted = 0
+            for path in paths:
+                try:
+                    engine.delete_file(path)
+                    deleted += 1
+                except Exception as e:
+                    self._error(f"删除 {path} 失败: {e}")
+            return deleted
+
+        prefix = f"{backend.location.strip('/')}/" if backend.location else ''
+        response = backend.connection.meta.client.delete_objects(
+            Bucket=backend.bucket_name,
+            Delete={'Objects': [{'Key': prefix + path} for path in paths], 'Quiet': True},
+        )
+        for error in response.get('Errors', []):
+            self._error(f"删除 {error.get('Key')} 失败: {error.get('Message')}")
+        return len(paths) - len(response.get('Errors', []))
@@ -0,0 +1,243 @@
+"""
+用户 S3 存储的超时与熔断
+
+用户自己配置的 MinIO/OSS 端点可能不可达，boto 默认的超时和重试会让同步 gunicorn worker
+卡到请求超时。这里为每个存储配置：
+
+- 设置连接/读取超时和重试次数（配置上单独设置，未设置时使用 CHEWY_ATTACHMENT 中的默认值）；
+  重试次数即 botocore 的 max_attempts，按单个请求计算，不是多个请求共享的重试预算
+- 维护熔断状态：连续失败达到阈值后熔断，之后对该存储的请求直接抛出 StorageUnavailable；
+  冷却时间过后由后台线程用 head_bucket 探测，成功后恢复
+
+熔断状态保存在 Django 缓存中，多个 worker 共享；存储设置接口通过 get_health 展示健康状态。
+失败次数用 cache.add + cache.incr 计数（Redis、本地内存缓存中 incr 是原子的），并发失败不会丢失计数；
+熔断状态只在达到阈值和请求成功时写入，未达到阈值的失败不会覆盖其他 worker 写入的熔断状态。
+只有连接错误、超时和 5xx 计为失败，403/404 等业务错误不影响熔断。
+"""
+import logging
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = 'bbtalk:s3-health'
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+
+# 健康状态在缓存中保留的时间，长期没有访问的存储会回到默认的健康状态
+HEALTH_TTL = 24 * 3600
+
+
+class StorageUnavailable(Exception):
+    """存储处于熔断状态，暂时不可用"""
+    pass
+
+
+def find_storage_unavailable(exc: BaseException) -> Optional[StorageUnavailable]:
+    """在异常链中查找 StorageUnavailable（chewy_attachment 会把存储异常包装成 StorageException）"""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, StorageUnavailable):
+            return exc
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+def _health_settings() -> Dict[str, Any]:
+    chewy_settings = getattr(settings, 'CHEWY_ATTACHMENT', {})
+    return {
+        'connect_timeout': chewy_settings.get('S3_CONNECT_TIMEOUT', 3),
+        'read_timeout': chewy_settings.get('S3_READ_TIMEOUT', 10),
+        'max_attempts': chewy_settings.get('S3_MAX_ATTEMPTS', 2),
+        'failure_threshold': chewy_settings.get('S3_BREAKER_FAILURES', 5),
+        'cooldown': chewy_settings.get('S3_BREAKER_COOLDOWN', 30),
+    }
+
+
+def s3_client_config(config: Dict[str, Any]):
+    """
+    按存储配置构建 botocore Config（超时与重试）
+
+    Args:
+        config: UserStorageSettings.get_s3_config() 返回的字典
+    """
+    from botocore.config import Config
+
+    defaults = _health_settings()
+    return Config(
+        connect_timeout=config.get('connect_timeout') or defaults['connect_timeout'],
+        read_timeout=config.get('read_timeout') or defaults['read_timeout'],
+        retries={
+            'max_attempts': config.get('max_attempts') or defaults['max_attempts'],
+            'mode': 'standard',
+        },
+    )
+
+
+def _cache_key(config_id) -> str:
+    return f"{CACHE_KEY_PREFIX}:{config_id}"
+
+
+def _failures_key(config_id) -> str:
+    return f"{_cache_key(config_id)}:failures"
+
+
+def _error_key(config_id) -> str:
+    return f"{_cache_key(config_id)}:error"
+
+
+def _read(key: str, default):
+    try:
+        value = cache.get(key)
+    except Exception as e:
+        logger.warning(f"读取存储健康状态失败: {e}")
+        return default
+    return default if value is None else value
+
+
+def _write(key: str, value) -> None:
+    try:
+        cache.set(key, value, HEALTH_TTL)
+    except Exception as e:
+        logger.warning(f"写入存储健康状态失败: {e}")
+
+
+def _read_state(config_id) -> Dict[str, Any]:
+    return _read(_cache_key(config_id), {})
+
+
+def _increment_failures(config_id) -> int:
+    """失败次数加一并返回新值；add 只在计数器不存在时写入，incr 由缓存后端执行"""
+    key = _failures_key(config_id)
+    try:
+        cache.add(key, 0, HEALTH_TTL)
+        return cache.incr(key)
+    except ValueError:
+        # add 与 incr 之间计数器过期或被 record_success 清除
+        cache.add(key, 1, HEALTH_TTL)
+        return 1
+    except Exception as e:
+        logger.warning(f"更新存储失败次数失败: {e}")
+        return 0
+
+
+def record_success(config_id) -> None:
+    """请求成功：有失败记录时清零并关闭熔断（正常状态下不写缓存）"""
+    state = _read_state(config_id)
+    if _read(_failures_key(config_id), 0) or state.get('state') == STATE_OPEN:
+        if state.get('state') == STATE_OPEN:
+            logger.info(f"存储配置 {config_id} 已恢复")
+        try:
+            cache.delete(_failures_key(config_id))
+        except Exception as e:
+            logger.warning(f"清除存储失败次数失败: {e}")
+        _write(_cache_key(config_id), {'state': STATE_CLOSED, 'last_success_at': time.time()})
+
+
+def record_failure(config_id, error: str) -> None:
+    """请求失败：累计失败次数，达到阈值时熔断"""
+    failures = _increment_failures(config_id)
+    now = time.time()
+    _write(_error_key(config_id), {'last_error': error[:500], 'last_failure_at': now})
+
+    state = _read_state(config_id)
+    already_open = state.get('state') == STATE_OPEN
+    if already_open or failures >= _health_settings()['failure_threshold']:
+        if not already_open:
+            logger.warning(f"存储配置 {config_id} 连续失败 {failures} 次，熔断: {error}")
+        # 熔断中的失败（探测失败）重新开始冷却
+        _write(_cache_key(config_id), {**state, 'state': STATE_OPEN, 'opened_at': now, 'last_error': error[:500]})
+
+
+def reset_health(config_id) -> None:
+    """清除熔断状态（存储配置修改后）"""
+    try:
+        cache.delete_many([_cache_key(config_id), _failures_key(config_id), _error_key(config_id)])
+    except Exception as e:
+        logger.warning(f"清除存储健康状态失败: {e}")
+
+
+def get_health(config_id) -> Dict[str, Any]:
+    """存储配置的健康状态（供设置接口展示）"""
+    state = _read_state(config_id)
+    error = _read(_error_key(config_id), {})
+    opened_at = state.get('opened_at')
+    return {
+        'state': state.get('state', STATE_CLOSED),
+        'failures': _read(_failures_key(config_id), 0),
+        'last_error': error.get('last_error', ''),
+        'last_failure_at': error.get('last_failure_at'),
+        'last_success_at': state.get('last_success_at'),
+        'retry_at': opened_at + _health_settings()['cooldown'] if state.get('state') == STATE_OPEN and opened_at else None,
+    }
+
+
+def _probe(config_id, config: Dict[str, Any]) -> None:
+    """后台探测熔断中的存储，成功则恢复"""
+    from .s3_clients import get_s3_client
+
+    try:
+        # 不经过熔断检查的共享客户端，只尝试一次
+        get_s3_client(config, max_attempts=1).head_bucket(Bucket=config['bucket_name'])
+    except Exception as e:
+        logger.info(f"存储配置 {config_id} 探测失败: {e}")
+        record_failure(config_id, str(e))
+    else:
+        record_success(config_id)
+    finally:
+        try:
+            cache.delete(f"{_cache_key(config_id)}:probe")
+        except Exception:
+            pass
+
+
+def _maybe_start_probe(config_id, config: Dict[str, Any], state: Dict[str, Any]) -> None:
+    if time.time() - (state.get('opened_at') or 0) < _health_settings()['cooldown']:
+        return
+    try:
+        # 同一时间只有一个 worker 探测；锁过期时间兜底探测线程异常退出
+        if not cache.add(f"{_cache_key(config_id)}:probe", 1, 60):
+            return
+    except Exception:
+        return
+    threading.Thread(
+        target=_probe,
+        args=(config_id, config),
+        name=f'bbtalk-s3-probe-{config_id}',
+        daemon=True,
+    ).start()
+
+
+def instrument_session(session, config_id, config: Dict[str, Any]) -> None:
+    """
+    为 boto3 Session 注册熔断钩子，之后由该 Session 创建的客户端都会经过熔断检查
+
+    Args:
+        session: boto3.Session
+        config_id: 存储配置 ID
+        config: UserStorageSettings.get_s3_config() 返回的字典，用于后台探测
+    """
+    def before_call(**kwargs):
+        state = _read_state(config_id)
+        if state.get('state') == STATE_OPEN:
+            _maybe_start_probe(config_id, config, state)
+            raise StorageUnavailable(f"存储暂时不可用，请稍后重试（{state.get('last_error', '')}）")
+
+    def after_call(http_response=None, **kwargs):
+        if http_response is not None and http_response.status_code >= 500:
+            record_failure(config_id, f"HTTP {http_response.status_code}")
+        else:
+            record_success(config_id)
+
+    def after_call_error(exception=None, **kwargs):
+        record_failure(config_id, str(exception))
+
+    session.events.register('before-call.s3', before_call)
+    session.events.register('after-call.s3', after_call)
+    session.events.register('after-call-error.s3', after_call_error)
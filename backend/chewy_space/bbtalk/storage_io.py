@@ -0,0 +1,202 @@
+"""
+存储读写辅助
+
+存储迁移和附件巡检共用的流式读写与校验工具：
+- 以流的方式读写文件，不把整个文件读入内存
+- 读取的同时计算 SHA-256 和 MD5
+- 校验存储中的对象：先比较大小和 ETag（S3 非分片上传的 ETag 即内容 MD5），
+  无法通过 ETag 判断时重新读取对象计算哈希
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+from django.core.files import File
+from chewy_attachment.core.storage import BaseStorageEngine, DjangoStorageEngine, FileStorageEngine
+
+# 流式读写时每次读取的块大小
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class VerificationError(Exception):
+    """存储中的对象缺失或内容与预期不一致"""
+    pass
+
+
+@dataclass
+class ObjectInfo:
+    """存储对象的元信息"""
+    size: int
+    etag: str = ''
+
+
+def s3_backend(engine: BaseStorageEngine):
+    """返回引擎背后的 S3Boto3Storage，不是 S3 时返回 None"""
+    from storages.backends.s3boto3 import S3Boto3Storage
+
+    if isinstance(engine, DjangoStorageEngine) and isinstance(engine.storage, S3Boto3Storage):
+        return engine.storage
+    return None
+
+
+def s3_key(backend, storage_path: str) -> str:
+    from storages.utils import clean_name
+
+    return backend._normalize_name(clean_name(storage_path))
+
+
+class HashingReader:
+    """包装文件流，统计读取的字节数并同时计算 SHA-256 和 MD5"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        self._sha256.update(data)
+        self._md5.update(data)
+        return data
+
+    def seekable(self) -> bool:
+        # 不支持回退，storages 上传时不会再 seek(0)
+        return False
+
+    @property
+    def closed(self) -> bool:
+        return getattr(self.stream, 'closed', False)
+
+    def close(self):
+        self.stream.close()
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+
+def open_stream(engine: BaseStorageEngine, storage_path: str):
+    """以流的方式打开存储中的文件"""
+    backend = s3_backend(engine)
+    if backend is not None:
+        # get_object 的 Body 按需从网络读取；storage.open 会先把整个对象下载到临时文件
+        return backend.connection.meta.client.get_object(
+            Bucket=backend.bucket_name,
+            Key=s3_key(backend, storage_path),
+        )['Body']
+    if isinstance(engine, FileStorageEngine):
+        return open(engine.get_file_path(storage_path), 'rb')
+    return engine.storage.open(storage_path, 'rb')
+
+
+def write_stream(engine: BaseStorageEngine, storage_path: str, stream) -> str:
+    """把流写入存储，返回实际保存的路径"""
+    if isinstance(engine, FileStorageEngine):
+        full_path = engine._get_full_path(storage_path)
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        # 临时文件名唯一，并发写入同一路径（如相同内容同时上传）时互不干扰，读者只会看到完整文件
+        fd, temp_path = tempfile.mkstemp(prefix=f".{full_path.name}.", suffix='.part', dir=full_path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f, COPY_CHUNK_SIZE)
+            os.replace(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return storage_path
+    # S3Boto3Storage 内部用 upload_fileobj 分片上传，按块读取流
+    return engine.storage.save(storage_path, File(stream, name=os.path.basename(storage_path)))
+
+
+def stat_object(engine: BaseStorageEngine, storage_path: str) -> Optional[ObjectInfo]:
+    """获取对象大小和 ETag，对象不存在时返回 None"""
+    backend = s3_backend(engine)
+    if backend is not None:
+        from botocore.exceptions import ClientError
+
+        try:
+            head = backend.connection.meta.client.head_object(
+                Bucket=backend.bucket_name,
+                Key=s3_key(backend, storage_path),
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return ObjectInfo(size=head['ContentLength'], etag=head.get('ETag', '').strip('"'))
+    if isinstance(engine, FileStorageEngine):
+        try:
+            return ObjectInfo(size=os.stat(engine._get_full_path(storage_path)).st_size)
+        except FileNotFoundError:
+            return None
+    if not engine.storage.exists(storage_path):
+        return None
+    return ObjectInfo(size=engine.storage.size(storage_path))
+
+
+def hash_object(engine: BaseStorageEngine, storage_path: str) -> HashingReader:
+    """流式读取整个对象，返回读完的 HashingReader（含 sha256、md5、bytes_read）"""
+    reader = HashingReader(open_stream(engine, storage_path))
+    try:
+        while reader.read(COPY_CHUNK_SIZE):
+            pass
+    finally:
+        reader.close()
+    return reader
+
+
+def is_md5_etag(etag: str) -> bool:
+    """分片上传的 ETag 形如 <hex>-<分片数>，不是内容 MD5"""
+    return len(etag) == 32 and '-' not in etag
+
+
+def verify_object(
+    engine: BaseStorageEngine,
+    storage_path: str,
+    size: int,
+    sha256: Optional[str] = None,
+    md5: Optional[str] = None,
+    deep: bool = True,
+) -> str:
+    """
+    校验存储中的对象
+
+    Args:
+        size: 期望大小
+        sha256: 期望的 SHA-256，重新读取对象时比较
+        md5: 期望的 MD5，与 S3 非分片上传的 ETag 比较
+        deep: ETag 无法判断时是否重新读取对象计算哈希
+
+    Returns:
+        使用的校验方式：'etag'、'rehash' 或 'size'
+
+    Raises:
+        VerificationError: 对象缺失、大小或内容不一致
+    """
+    info = stat_object(engine, storage_path)
+    if info is None:
+        raise VerificationError(f"对象不存在: {storage_path}")
+    if info.size != size:
+        raise VerificationError(f"大小不一致: {storage_path} 期望 {size}，实际 {info.size}")
+
+    if md5 and is_md5_etag(info.etag):
+        if info.etag != md5:
+            raise VerificationError(f"ETag 与内容 MD5 不一致: {storage_path}")
+        return 'etag'
+
+    if deep and (sha256 or md5):
+        reader = hash_object(engine, storage_path)
+        if (sha256 and reader.sha256 != sha256) or (not sha256 and reader.md5 != md5):
+            raise VerificationError(f"内容哈希不一致: {storage_path}")
+        return 'rehash'
+    return 'size'
@@ -3,17 +3,54 @@
 
 支持将附件从一个存储后端迁移到另一个存储后端
 场景：本地存储 → S3、S3 → 本地、S3(A) → S3(B)
+
+附件在有限大小的线程池中并行迁移，每个存储配置只构建一次存储引擎；
+文件以流的方式从源存储复制到目标存储，不整体读入内存。
+源和目标是同一 S3 服务、同一账号时直接使用服务端复制（CopyObject），数据不经过本机。
+
+复制时同时计算源文件哈希，写入后校验目标对象（ETag 或重新读取计算哈希），
+不一致时删除目标对象并记为失败，附件仍指向源存储。
 """
 import logging
-from typing import Optional, Dict, Any
+import math
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional, Dict, Any
 
-from django.core.files.storage import default_storage
-from chewy_attachment.core.storage import DjangoStorageEngine
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count, Sum
+from chewy_attachment.core.schemas import FileUploadResult
+from chewy_attachment.core.storage import BaseStorageEngine, DjangoStorageEngine
+from chewy_attachment.django_app.storage import get_storage_engine_for_attachment
 
-from .models import User, Attachment, UserStorageSettings
+from .blob_storage import BlobStorageService
+from .storage_io import (
+    HashingReader, VerificationError, hash_object, is_md5_etag, open_stream, s3_backend, s3_key,
+    stat_object, verify_object, write_stream,
+)
+from .models import User, Attachment, UserStorageSettings, StorageMigrationJob
+from .public_attachments import try_publish_attachment, unpublish_attachment
+from .storage_benchmark import benchmark_rate
+from .storage_usage import record_attachment_moved
 
 logger = logging.getLogger(__name__)
 
+# 估算迁移耗时时参考的最近迁移任务数
+MEASURED_JOBS_LIMIT = 20
+
+# 等待附件完成时检查 should_stop 的最长间隔（秒），单个大文件复制期间也能及时响应取消
+PROGRESS_POLL_SECONDS = 5
+
+
+def migration_workers() -> int:
+    return max(1, getattr(settings, 'CHEWY_ATTACHMENT', {}).get('MIGRATION_WORKERS', 4))
+
+
+def _verify_enabled() -> bool:
+    return getattr(settings, 'CHEWY_ATTACHMENT', {}).get('MIGRATION_VERIFY', True)
+
 
 class StorageMigrationService:
     """存储迁移服务"""
@@ -26,124 +63,409 @@ class StorageMigrationService:
             'skipped': 0,
             'failed': 0,
             'errors': [],
+            'bytes': 0,
+            'server_side_copies': 0,
+            'elapsed_seconds': 0.0,
+            'throughput_bytes_per_second': 0,
+            'stopped': False,
+            # 按源存储配置统计的单线程复制字节数和耗时，用于估算之后迁移的耗时
+            'transfer': {},
         }
+        self._stats_lock = threading.Lock()
+        self._engines: Dict[str, BaseStorageEngine] = {}
 
     def _build_s3_storage(self, settings_obj: UserStorageSettings):
-        """根据配置构建 S3 storage backend"""
-        from storages.backends.s3boto3 import S3Boto3Storage
-
-        config = settings_obj.get_s3_config()
-        kwargs = {
-            'access_key': config['access_key_id'],
-            'secret_key': config['secret_access_key'],
-            'bucket_name': config['bucket_name'],
-            'region_name': config.get('region_name', 'us-east-1'),
-            'default_acl': 'private',
-            'file_overwrite': False,
-            'querystring_auth': True,
-            'querystring_expire': 3600,
-        }
-        if config.get('endpoint_url'):
-            kwargs['endpoint_url'] = config['endpoint_url']
-        if config.get('custom_domain'):
-            kwargs['custom_domain'] = config['custom_domain']
-        return S3Boto3Storage(**kwargs)
+        """根据配置构建 S3 storage backend（带超时与熔断）"""
+        from .storage import UserS3Storage
 
-    def _get_engine(self, config_id: Optional[str]) -> DjangoStorageEngine:
+        return UserS3Storage(user_settings=settings_obj)
+
+    def get_engine(self, config_id: Optional[str]) -> BaseStorageEngine:
         """
-        获取存储引擎
+        获取存储引擎（同一配置只构建一次）
 
-        config_id=None → 本地默认存储
-        config_id=str  → 对应的 S3 配置
+        config_id=None → 本地附件存储（CHEWY_ATTACHMENT['STORAGE_ROOT']）
+        config_id=str  → 当前用户对应的 S3 配置（不要求启用，便于从旧配置迁出）
         """
+        key = str(config_id) if config_id else ''
+        engine = self._engines.get(key)
+        if engine is not None:
+            return engine
+
         if config_id:
             settings_obj = UserStorageSettings.objects.filter(
                 id=config_id,
+                user=self.user,
             ).first()
-            if settings_obj and settings_obj.is_s3_configured():
-                return DjangoStorageEngine(self._build_s3_storage(settings_obj))
-            raise ValueError(f"存储配置 {config_id} 不存在或未配置完整")
-        return DjangoStorageEngine(default_storage)
+            if not settings_obj or not settings_obj.is_s3_configured():
+                raise ValueError(f"存储配置 {config_id} 不存在或未配置完整")
+            engine = DjangoStorageEngine(self._build_s3_storage(settings_obj))
+        else:
+            engine = get_storage_engine_for_attachment(None)
+
+        self._engines[key] = engine
+        return engine
 
     def get_migration_preview(self, target_config_id: Optional[str]) -> Dict[str, Any]:
         """
-        预览迁移信息：统计需要迁移的附件数量
+        预览迁移信息：按源存储配置分组统计附件数和字节数，并估算迁移耗时
 
         Args:
             target_config_id: 目标存储配置 ID，None 表示本地存储
         """
-        attachments = Attachment.objects.filter(owner_id=self.user.id)
-        total = attachments.count()
-
-        # 找出 storage_config_id 不等于目标的附件（即需要迁移的）
         target_str = str(target_config_id) if target_config_id else ''
-        need_migrate = 0
-        already_on_target = 0
 
-        for att in attachments:
-            att_cfg = att.storage_config_id or ''
-            if str(att_cfg) == target_str:
-                already_on_target += 1
-            else:
-                need_migrate += 1
+        # 本地存储的 storage_config_id 可能是 NULL 或空字符串，分组后合并
+        groups: Dict[str, Dict[str, int]] = {}
+        rows = Attachment.objects.filter(owner_id=self.user.id).values('storage_config_id').annotate(
+            count=Count('id'),
+            bytes=Sum('size'),
+        ).order_by()
+        for row in rows:
+            group = groups.setdefault(str(row['storage_config_id'] or ''), {'count': 0, 'bytes': 0})
+            group['count'] += row['count']
+            group['bytes'] += row['bytes'] or 0
+
+        configs = UserStorageSettings.objects.filter(
+            user=self.user,
+            id__in=[int(key) for key in (*groups, target_str) if key.isdigit()],
+        ).values_list('id', 'name', 'benchmark')
+        names = {config_id: name for config_id, name, _ in configs}
+        benchmarks = {str(config_id): benchmark for config_id, _, benchmark in configs}
+        rates = self._measured_rates()
+        workers = migration_workers()
+
+        sources = []
+        estimated_seconds = 0
+        for source, group in sorted(groups.items()):
+            if source == target_str:
+                continue
+            rate = self._estimate_rate(rates, source, target_str) or self._benchmark_rate(benchmarks, source, target_str)
+            seconds = math.ceil(group['bytes'] / (rate * workers)) if rate else None
+            if seconds is None:
+                estimated_seconds = None
+            elif estimated_seconds is not None:
+                estimated_seconds += seconds
+            sources.append({
+                'storage_config_id': source or None,
+                'name': names.get(int(source), source) if source.isdigit() else ('服务器存储' if not source else source),
+                'count': group['count'],
+                'bytes': group['bytes'],
+                'estimated_seconds': seconds,
+            })
 
+        on_target = groups.get(target_str, {'count': 0, 'bytes': 0})
         return {
-            'total': total,
-            'need_migrate': need_migrate,
-            'already_on_target': already_on_target,
+            'total': sum(group['count'] for group in groups.values()),
+            'need_migrate': sum(source['count'] for source in sources),
+            'already_on_target': on_target['count'],
+            'need_migrate_bytes': sum(source['bytes'] for source in sources),
+            'sources': sources,
+            # 任一来源没有测量数据时无法估算，返回 None
+            'estimated_seconds': estimated_seconds if sources else 0,
         }
 
-    def migrate(self, target_config_id: Optional[str]) -> Dict[str, Any]:
+    def _measured_rates(self) -> Dict[tuple, Dict[str, float]]:
+        """
+        汇总最近迁移任务记录的复制速率
+
+        Returns:
+            {(源配置, 目标配置): {'bytes': 字节数, 'seconds': 单线程耗时}}
+        """
+        rates: Dict[tuple, Dict[str, float]] = {}
+        jobs = StorageMigrationJob.objects.filter(user=self.user).exclude(transfer_stats={}).only(
+            'target_config_id', 'transfer_stats',
+        )[:MEASURED_JOBS_LIMIT]
+        for job in jobs:
+            for source, transfer in job.transfer_stats.items():
+                entry = rates.setdefault((source, job.target_config_id), {'bytes': 0, 'seconds': 0.0})
+                entry['bytes'] += transfer.get('bytes', 0)
+                entry['seconds'] += transfer.get('seconds', 0.0)
+        return rates
+
+    @staticmethod
+    def _estimate_rate(rates: Dict[tuple, Dict[str, float]], source: str, target: str) -> Optional[float]:
+        """
+        估算单线程复制速率（字节/秒）
+
+        优先使用同一 (源, 目标) 的测量值；没有时分别取涉及源配置、涉及目标配置（无论方向）
+        的传输速率，以较慢的一方为准；都没有测量过时返回 None
+        """
+        def rate_of(entries):
+            total_bytes = sum(entry['bytes'] for entry in entries)
+            total_seconds = sum(entry['seconds'] for entry in entries)
+            return total_bytes / total_seconds if total_bytes and total_seconds > 0 else None
+
+        exact = rate_of([rates[(source, target)]] if (source, target) in rates else [])
+        if exact:
+            return exact
+        source_rate = rate_of([entry for pair, entry in rates.items() if source in pair])
+        target_rate = rate_of([entry for pair, entry in rates.items() if target in pair])
+        known = [rate for rate in (source_rate, target_rate) if rate]
+        return min(known) if known else None
+
+    @staticmethod
+    def _benchmark_rate(benchmarks: Dict[str, Dict[str, Any]], source: str, target: str) -> Optional[float]:
+        """
+        没有实测迁移速率时，用存储性能测试的大对象吞吐量估算：源存储下载与目标存储上传取较慢者，
+        本地存储不计
+        """
+        known = []
+        if source:
+            known.append(benchmark_rate(benchmarks.get(source), 'get'))
+        if target:
+            known.append(benchmark_rate(benchmarks.get(target), 'put'))
+        known = [rate for rate in known if rate]
+        return min(known) if known else None
+
+    def migrate(
+        self,
+        target_config_id: Optional[str],
+        on_progress: Optional[Callable[[Attachment, int, Optional[str]], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> Dict[str, Any]:
         """
         执行迁移
 
         Args:
             target_config_id: 目标存储配置 ID，None 表示迁移到本地存储
+            on_progress: 每个附件处理完后在调用线程中回调 (附件, 复制字节数, 错误信息)
+            should_stop: 在调用线程中定期调用（至少每 PROGRESS_POLL_SECONDS 秒一次），
+                返回 True 时不再开始新的附件，等待进行中的附件完成后返回
         """
+        started = time.monotonic()
         target_str = str(target_config_id) if target_config_id else ''
-        target_engine = self._get_engine(target_config_id)
+        target_engine = self.get_engine(target_config_id)
 
         attachments = Attachment.objects.filter(owner_id=self.user.id)
         self.stats['total'] = attachments.count()
 
-        for att in attachments:
-            att_cfg = att.storage_config_id or ''
-            if str(att_cfg) == target_str:
+        pending = []
+        for att in attachments.iterator():
+            if str(att.storage_config_id or '') == target_str:
                 self.stats['skipped'] += 1
-                continue
+            else:
+                pending.append(att)
 
+        # 在主线程里预先构建所有源存储引擎，工作线程只读缓存
+        for config_id in {att.storage_config_id or '' for att in pending}:
             try:
-                self._migrate_one(att, target_engine, target_config_id)
-                self.stats['migrated'] += 1
-            except Exception as e:
-                err_msg = f"{att.original_name} ({att.id}): {e}"
-                logger.error(f"迁移附件失败: {err_msg}")
+                self.get_engine(config_id or None)
+            except ValueError as e:
+                logger.warning(f"源存储不可用: {e}")
+
+        stop_event = threading.Event()
+        with ThreadPoolExecutor(max_workers=migration_workers(), thread_name_prefix='bbtalk-migrate') as executor:
+            # 源配置在提交前记下：工作线程迁移完成后会改写 att.storage_config_id
+            futures = {
+                executor.submit(self._migrate_in_worker, att, target_engine, target_config_id, stop_event):
+                    (att, str(att.storage_config_id or ''))
+                for att in pending
+            }
+            not_done = set(futures)
+            while not_done:
+                done, not_done = wait(not_done, timeout=PROGRESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._record_result(*futures[future], future, on_progress)
+                if should_stop is not None and not stop_event.is_set() and should_stop():
+                    logger.info("迁移已请求停止，等待进行中的附件完成")
+                    stop_event.set()
+                    for future in not_done:
+                        future.cancel()
+
+        elapsed = time.monotonic() - started
+        self.stats['stopped'] = stop_event.is_set()
+        self.stats['elapsed_seconds'] = round(elapsed, 3)
+        self.stats['throughput_bytes_per_second'] = int(self.stats['bytes'] / elapsed) if elapsed > 0 else 0
+        logger.info(
+            f"迁移{'中止' if stop_event.is_set() else '完成'}: {self.stats['migrated']} 个文件, {self.stats['bytes']} bytes, "
+            f"{self.stats['elapsed_seconds']}s, {self.stats['throughput_bytes_per_second']} B/s"
+        )
+        return self.stats
+
+    def _record_result(self, att: Attachment, source_key: str, future, on_progress) -> None:
+        """汇总单个附件的迁移结果；被取消或因停止而未执行的附件不计入"""
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            err_msg = f"{att.original_name} ({att.id}): {e}"
+            logger.error(f"迁移附件失败: {err_msg}")
+            with self._stats_lock:
                 self.stats['failed'] += 1
                 self.stats['errors'].append(err_msg)
+            if on_progress is not None:
+                on_progress(att, 0, err_msg)
+            return
+        if result is None:
+            return
+        size, server_side, seconds = result
+        with self._stats_lock:
+            self.stats['migrated'] += 1
+            self.stats['bytes'] += size
+            if server_side:
+                self.stats['server_side_copies'] += 1
+            if size:
+                transfer = self.stats['transfer'].setdefault(source_key, {'bytes': 0, 'seconds': 0.0})
+                transfer['bytes'] += size
+                transfer['seconds'] += seconds
+        if on_progress is not None:
+            on_progress(att, size, None)
 
-        return self.stats
+    def _migrate_in_worker(
+        self,
+        att: Attachment,
+        target_engine: BaseStorageEngine,
+        target_config_id: Optional[str],
+        stop_event: threading.Event,
+    ):
+        """线程池任务：迁移单个附件后释放本线程的数据库连接；已请求停止时直接返回 None"""
+        if stop_event.is_set():
+            return None
+        try:
+            return self._migrate_one(att, target_engine, target_config_id)
+        finally:
+            close_old_connections()
 
     def _migrate_one(
         self,
         att: Attachment,
-        target_engine: DjangoStorageEngine,
+        target_engine: BaseStorageEngine,
         target_config_id: Optional[str],
     ):
-        """迁移单个附件"""
-        # 1. 从源存储读取文件
-        source_engine = self._get_engine(att.storage_config_id or None)
-        content = source_engine.get_file(att.storage_path)
-        logger.info(f"读取附件: {att.storage_path} ({len(content)} bytes)")
-
-        # 2. 写入目标存储（保持原路径）
-        result = target_engine.save_file(
-            content=content,
-            original_name=att.original_name,
-            storage_path=att.storage_path,
-        )
-        logger.info(f"写入附件: {result.storage_path}")
+        """
+        迁移单个附件
+
+        Returns:
+            (复制的字节数, 是否为服务端复制, 复制耗时秒数)
+        """
+        source_engine = self.get_engine(att.storage_config_id or None)
+        copied = {'size': 0, 'server_side': False, 'seconds': 0.0}
+
+        def copy_to(storage_path: str) -> FileUploadResult:
+            started = time.monotonic()
+            result, server_side = self._copy_object(att, source_engine, target_engine, storage_path)
+            copied['size'], copied['server_side'] = result.size, server_side
+            copied['seconds'] = time.monotonic() - started
+            return result
 
-        # 3. 更新数据库记录
+        if att.content_hash:
+            # 去重存储的附件：目标存储已有相同内容时直接引用，否则复制一份，并释放源存储的引用
+            blob, created = BlobStorageService(target_engine, target_config_id).acquire(
+                att.content_hash,
+                att.original_name,
+                copy_to,
+            )
+            BlobStorageService(source_engine, att.storage_config_id).release(att.content_hash)
+            storage_path = blob.storage_path
+            logger.info(f"迁移去重附件: {storage_path} ({'写入' if created else '复用'})")
+        else:
+            # 复制到目标存储（保持原路径）
+            storage_path = copy_to(att.storage_path).storage_path
+            logger.info(f"写入附件: {storage_path} ({copied['size']} bytes)")
+
+        # 更新数据库记录；缩略图留在源存储，清空后在目标存储按需重新生成
+        source_config_id, source_path = att.storage_config_id, att.storage_path
         att.storage_config_id = str(target_config_id) if target_config_id else ''
-        att.storage_path = result.storage_path
-        att.save(update_fields=['storage_config_id', 'storage_path'])
+        att.storage_path = storage_path
+        att.media_info = {k: v for k, v in (att.media_info or {}).items() if k != 'derivatives'}
+        att.save(update_fields=['storage_config_id', 'storage_path', 'media_info'])
+        record_attachment_moved(att, source_config_id)
+        if att.public_url:
+            # 公开副本随附件移到目标存储
+            unpublish_attachment(att, source_engine, source_config_id, source_path)
+            try_publish_attachment(att, target_engine)
+        return copied['size'], copied['server_side'], copied['seconds']
+
+    def _copy_object(
+        self,
+        att: Attachment,
+        source_engine: BaseStorageEngine,
+        target_engine: BaseStorageEngine,
+        target_path: str,
+    ):
+        """
+        把附件从源存储复制到目标存储的 target_path，并校验目标对象
+
+        Returns:
+            (FileUploadResult, 是否为服务端复制)
+
+        Raises:
+            VerificationError: 源文件与记录不符，或写入的目标对象校验失败（目标对象已删除）
+        """
+        source_s3 = s3_backend(source_engine)
+        target_s3 = s3_backend(target_engine)
+
+        # 同一 S3 服务、同一账号：服务端复制，数据不经过本机
+        if (
+            source_s3 is not None and target_s3 is not None
+            and source_s3.endpoint_url == target_s3.endpoint_url
+            and source_s3.access_key == target_s3.access_key
+        ):
+            source_key = s3_key(source_s3, att.storage_path)
+            target_key = s3_key(target_s3, target_path)
+            if (source_s3.bucket_name, source_key) != (target_s3.bucket_name, target_key):
+                target_s3.connection.meta.client.copy(
+                    {'Bucket': source_s3.bucket_name, 'Key': source_key},
+                    target_s3.bucket_name,
+                    target_key,
+                )
+                if _verify_enabled():
+                    self._verify_or_delete(target_engine, target_path, lambda: self._verify_server_side_copy(
+                        att, source_engine, target_engine, target_path,
+                    ))
+            return FileUploadResult(storage_path=target_path, size=att.size, mime_type=att.mime_type), True
+
+        reader = HashingReader(open_stream(source_engine, att.storage_path))
+        try:
+            saved_path = write_stream(target_engine, target_path, reader)
+        finally:
+            reader.close()
+
+        if _verify_enabled():
+            def verify():
+                # 先确认读到的源文件就是上传时的内容，再校验目标对象
+                if reader.bytes_read != att.size or (att.content_hash and reader.sha256 != att.content_hash):
+                    raise VerificationError(f"源文件与附件记录不一致: {att.storage_path}")
+                verify_object(target_engine, saved_path, reader.bytes_read, sha256=reader.sha256, md5=reader.md5)
+
+            self._verify_or_delete(target_engine, saved_path, verify)
+        return FileUploadResult(storage_path=saved_path, size=reader.bytes_read, mime_type=att.mime_type), False
+
+    @staticmethod
+    def _verify_or_delete(engine: BaseStorageEngine, storage_path: str, verify: Callable[[], Any]) -> None:
+        """执行校验，失败时删除刚写入的目标对象后抛出"""
+        try:
+            verify()
+        except VerificationError:
+            try:
+                engine.delete_file(storage_path)
+            except Exception as e:
+                logger.warning(f"删除校验失败的对象出错: {storage_path}: {e}")
+            raise
+
+    @staticmethod
+    def _verify_server_side_copy(
+        att: Attachment,
+        source_engine: BaseStorageEngine,
+        target_engine: BaseStorageEngine,
+        target_path: str,
+    ) -> None:
+        """
+        校验服务端复制的结果
+
+        两端 ETag 相同（或源 ETag 是内容 MD5）时直接通过；
+        否则按记录的内容哈希（或重新读取源对象）重新读取目标对象比较
+        """
+        source_info = stat_object(source_engine, att.storage_path)
+        if source_info is None:
+            raise VerificationError(f"源对象不存在: {att.storage_path}")
+        target_info = stat_object(target_engine, target_path)
+        if target_info is not None and source_info.etag and (target_info.etag, target_info.size) == (source_info.etag, source_info.size):
+            return
+        md5 = source_info.etag if is_md5_etag(source_info.etag) else None
+        sha256 = att.content_hash or None
+        if md5 is None and sha256 is None:
+            sha256 = hash_object(source_engine, att.storage_path).sha256
+        verify_object(target_engine, target_path, source_info.size, sha256=sha256, md5=md5)
@@ -0,0 +1,154 @@
+"""
+存储用量统计与配额
+
+每个用户在每个存储配置下一行 StorageUsage，附件上传、删除、迁移时用 F() 表达式增量更新，
+读取用量和上传时检查配额都只需要读一行，不再对 Attachment.size 求和。
+计数出现偏差时可以用 manage.py recalculate_storage_usage 按附件表重新统计。
+"""
+import logging
+from typing import Dict, Any, Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import Attachment, StorageUsage, User
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """上传后会超过存储配额"""
+    pass
+
+
+def _config_key(storage_config_id) -> str:
+    return str(storage_config_id) if storage_config_id else ''
+
+
+def local_quota_bytes() -> Optional[int]:
+    """本地存储的默认配额，未配置时不限制"""
+    return getattr(settings, 'CHEWY_ATTACHMENT', {}).get('LOCAL_QUOTA_BYTES') or None
+
+
+def effective_quota(storage_config_id, quota_bytes: Optional[int]) -> Optional[int]:
+    """用量行上单独设置的配额优先；本地存储默认使用 LOCAL_QUOTA_BYTES，S3 存储默认不限制"""
+    if quota_bytes is not None:
+        return quota_bytes
+    return None if _config_key(storage_config_id) else local_quota_bytes()
+
+
+def adjust_usage(user_id, storage_config_id, files: int, size: int) -> None:
+    """增减用户在某个存储配置下的附件数和字节数"""
+    user_id = int(user_id)
+    config_key = _config_key(storage_config_id)
+    changes = {
+        'file_count': F('file_count') + files,
+        'bytes_used': F('bytes_used') + size,
+        'updated_at': timezone.now(),
+    }
+    if StorageUsage.objects.filter(user_id=user_id, storage_config_id=config_key).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            StorageUsage.objects.create(
+                user_id=user_id, storage_config_id=config_key, file_count=files, bytes_used=size,
+            )
+    except IntegrityError:
+        # 并发请求已经创建了这一行
+        StorageUsage.objects.filter(user_id=user_id, storage_config_id=config_key).update(**changes)
+
+
+def record_attachment_added(attachment: Attachment) -> None:
+    adjust_usage(attachment.owner_id, attachment.storage_config_id, 1, attachment.size)
+
+
+def record_attachment_removed(attachment: Attachment) -> None:
+    adjust_usage(attachment.owner_id, attachment.storage_config_id, -1, -attachment.size)
+
+
+def record_attachment_moved(attachment: Attachment, source_config_id) -> None:
+    """附件从 source_config_id 迁移到了 attachment.storage_config_id"""
+    adjust_usage(attachment.owner_id, source_config_id, -1, -attachment.size)
+    record_attachment_added(attachment)
+
+
+def check_quota(user_id, storage_config_id, size: int) -> None:
+    """
+    检查上传 size 字节后是否超过配额，只读取一行用量
+
+    Raises:
+        QuotaExceeded: 超过配额
+    """
+    config_key = _config_key(storage_config_id)
+    row = StorageUsage.objects.filter(
+        user_id=int(user_id), storage_config_id=config_key,
+    ).values_list('bytes_used', 'quota_bytes').first()
+    bytes_used, quota_bytes = row or (0, None)
+    quota = effective_quota(config_key, quota_bytes)
+    if quota is not None and bytes_used + size > quota:
+        raise QuotaExceeded(f'存储空间不足：已用 {bytes_used} 字节，配额 {quota} 字节，本次上传 {size} 字节')
+
+
+def usage_entry(storage_config_id, usage: Optional[StorageUsage]) -> Dict[str, Any]:
+    return {
+        'storage_config_id': _config_key(storage_config_id) or None,
+        'file_count': usage.file_count if usage else 0,
+        'bytes_used': usage.bytes_used if usage else 0,
+        'quota_bytes': effective_quota(storage_config_id, usage.quota_bytes if usage else None),
+    }
+
+
+def get_usage_map(user: User) -> Dict[str, StorageUsage]:
+    """{存储配置 ID（本地为 ''）: 用量}"""
+    return {usage.storage_config_id: usage for usage in StorageUsage.objects.filter(user=user)}
+
+
+def get_user_usage(user: User) -> Dict[str, Any]:
+    """用户各存储的用量和总计，本地存储始终列出"""
+    usage_map = get_usage_map(user)
+    usage_map.setdefault('', None)
+    storages = [usage_entry(config_id, usage) for config_id, usage in sorted(usage_map.items())]
+    return {
+        'file_count': sum(entry['file_count'] for entry in storages),
+        'bytes_used': sum(entry['bytes_used'] for entry in storages),
+        'storages': storages,
+    }
+
+
+def recalculate_usage(user: Optional[User] = None) -> int:
+    """
+    按附件表重新统计用量（保留已设置的配额），返回更新的用量行数
+    """
+    queryset = Attachment.objects.all()
+    usages = StorageUsage.objects.all()
+    if user is not None:
+        queryset = queryset.filter(owner_id=str(user.id))
+        usages = usages.filter(user=user)
+
+    totals = {}
+    for row in queryset.values('owner_id', 'storage_config_id').annotate(count=Count('id'), size=Sum('size')):
+        if not str(row['owner_id']).isdigit():
+            continue
+        key = (int(row['owner_id']), _config_key(row['storage_config_id']))
+        count, size = totals.get(key, (0, 0))
+        totals[key] = (count + row['count'], size + (row['size'] or 0))
+
+    with transaction.atomic():
+        existing = {(usage.user_id, usage.storage_config_id): usage for usage in usages.select_for_update()}
+        for key, usage in existing.items():
+            if key not in totals:
+                usage.file_count, usage.bytes_used = 0, 0
+                usage.save(update_fields=['file_count', 'bytes_used', 'updated_at'])
+        for (user_id, config_key), (count, size) in totals.items():
+            usage = existing.get((user_id, config_key))
+            if usage is None:
+                StorageUsage.objects.create(
+                    user_id=user_id, storage_config_id=config_key, file_count=count, bytes_used=size,
+                )
+            else:
+                usage.file_count, usage.bytes_used = count, size
+                usage.save(update_fields=['file_count', 'bytes_used', 'updated_at'])
+    logger.info(f"重新统计存储用量: {len(totals)} 行")
+    return len(totals)
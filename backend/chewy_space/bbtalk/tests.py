@@ -1,6 +1,6 @@
 from django.test import TestCase, override_settings, TransactionTestCase
 from django.db import transaction, IntegrityError
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.test import APITestCase, APITransactionTestCase, APIClient
 from rest_framework import status
 from .models import User, Tag, BBTalk
 import json
@@ -196,6 +196,56 @@ class BBTalkModelTest(TestCase):
 
 from rest_framework_simplejwt.tokens import RefreshToken
 
+
+class AuthenticatedClientMixin:
+    """创建用户并让 self.client 以该用户的 JWT 登录"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = self.create_user()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def create_user(self):
+        return User.objects.create(username='testuser')
+
+
+class AuthenticatedAPITestCase(AuthenticatedClientMixin, APITestCase):
+    """已登录用户的 API 测试基类"""
+    pass
+
+
+class TemporaryMediaMixin:
+    """把 MEDIA_ROOT 和本地附件存储目录指向临时目录，测试类结束后删除，避免上传的文件留在仓库中"""
+
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+        from pathlib import Path
+        from django.conf import settings as django_settings
+        from chewy_attachment.core.storage import StorageManager
+
+        cls.media_root = tempfile.mkdtemp(prefix='bbtalk-test-media-')
+        cls._media_override = override_settings(
+            MEDIA_ROOT=cls.media_root,
+            CHEWY_ATTACHMENT={**django_settings.CHEWY_ATTACHMENT, 'STORAGE_ROOT': Path(cls.media_root) / 'attachments'},
+        )
+        cls._media_override.enable()
+        # StorageManager 单例会缓存首次读取的本地存储目录
+        StorageManager.reset_instance()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        from chewy_attachment.core.storage import StorageManager
+
+        super().tearDownClass()
+        cls._media_override.disable()
+        StorageManager.reset_instance()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
 @override_settings(DEBUG=True)
 class BBTalkAPITest(APITestCase):
     """BBTalk API 测试"""
@@ -531,3 +581,1426 @@ class UserAPITest(APITestCase):
     
     # 移除首次请求自动创建用户的测试，因为现在不再支持该逻辑
 
+
+@override_settings(DEBUG=True)
+class DirectUploadAPITest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """S3 直传接口测试"""
+
+    def test_presign_requires_login(self):
+        """测试未登录不能签发直传地址"""
+        response = APIClient().post('/api/v1/attachments/files/presign/', {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_presign_without_s3_config(self):
+        """测试未启用 S3 存储时拒绝直传"""
+        response = self.client.post('/api/v1/attachments/files/presign/', {
+            'original_name': 'a.png',
+            'size': 100,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_confirm_with_invalid_token(self):
+        """测试无效上传凭证"""
+        response = self.client.post('/api/v1/attachments/files/confirm/', {
+            'upload_token': 'invalid',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _stub_s3(self):
+        """创建 S3 存储配置，并在直传服务使用的共享客户端上打桩"""
+        from botocore.stub import Stubber
+        from .models import UserStorageSettings
+        from .s3_clients import clear_clients
+        from .storage import UserS3Storage
+
+        clear_clients()
+        self.addCleanup(clear_clients)
+        config = UserStorageSettings.objects.create(
+            user=self.user, name='s3', s3_access_key_id='k', s3_secret_access_key='s', s3_bucket_name='b',
+            s3_endpoint_url='http://127.0.0.1:1', is_active=True,
+        )
+        stubber = Stubber(UserS3Storage(user_settings=config).connection.meta.client)
+        stubber.activate()
+        self.addCleanup(stubber.deactivate)
+        return stubber
+
+    def _presign(self, size):
+        response = self.client.post('/api/v1/attachments/files/presign/', {
+            'original_name': 'a.txt', 'size': size, 'content_type': 'text/plain',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_presign_post_and_confirm(self):
+        """测试预签名 POST 限定声明的大小，确认后登记附件"""
+        import base64
+        from .models import Attachment
+
+        stubber = self._stub_s3()
+        data = self._presign(5)
+        self.assertEqual(data['method'], 'post')
+        policy = json.loads(base64.b64decode(data['fields']['policy']))
+        self.assertIn(['content-length-range', 5, 5], policy['conditions'])
+
+        stubber.add_response('head_object', {'ContentLength': 5, 'ContentType': 'text/plain'})
+        response = self.client.post('/api/v1/attachments/files/confirm/', {
+            'upload_token': data['upload_token'],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        attachment = Attachment.objects.get(id=response.data['id'])
+        self.assertEqual((attachment.storage_path, attachment.size), (data['storage_path'], 5))
+        stubber.assert_no_pending_responses()
+
+    def test_confirm_rejects_size_mismatch(self):
+        """测试实际大小与声明不一致时删除对象并拒绝，避免绕过配额"""
+        from .models import Attachment
+
+        stubber = self._stub_s3()
+        data = self._presign(1)
+        stubber.add_response('head_object', {'ContentLength': 1024, 'ContentType': 'text/plain'})
+        stubber.add_response('delete_object', {}, {'Bucket': 'b', 'Key': data['storage_path']})
+        response = self.client.post('/api/v1/attachments/files/confirm/', {
+            'upload_token': data['upload_token'],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Attachment.objects.exists())
+        stubber.assert_no_pending_responses()
+
+    def test_multipart_upload(self):
+        """测试超过分片阈值时签发分片地址，确认时合并分片；合并失败且取消也失败时返回 400"""
+        from django.conf import settings as django_settings
+        from .models import Attachment
+
+        stubber = self._stub_s3()
+        size = 6 * 1024 * 1024
+        with self.settings(CHEWY_ATTACHMENT={**django_settings.CHEWY_ATTACHMENT, 'DIRECT_UPLOAD_MULTIPART_THRESHOLD': 1024}):
+            stubber.add_response('create_multipart_upload', {'UploadId': 'u1'})
+            data = self._presign(size)
+            self.assertEqual(data['method'], 'multipart')
+            self.assertEqual(len(data['parts']), 1)
+
+            parts = [{'part_number': 1, 'etag': '"e1"'}]
+            stubber.add_response('complete_multipart_upload', {}, {
+                'Bucket': 'b', 'Key': data['storage_path'], 'UploadId': 'u1',
+                'MultipartUpload': {'Parts': [{'PartNumber': 1, 'ETag': '"e1"'}]},
+            })
+            stubber.add_response('head_object', {'ContentLength': size, 'ContentType': 'text/plain'})
+            response = self.client.post('/api/v1/attachments/files/confirm/', {
+                'upload_token': data['upload_token'], 'parts': parts,
+            }, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(Attachment.objects.get(id=response.data['id']).size, size)
+
+            stubber.add_response('create_multipart_upload', {'UploadId': 'u2'})
+            data = self._presign(size)
+            stubber.add_client_error('complete_multipart_upload', 'InvalidPart')
+            stubber.add_client_error('abort_multipart_upload', 'NoSuchUpload')
+            response = self.client.post('/api/v1/attachments/files/confirm/', {
+                'upload_token': data['upload_token'], 'parts': parts,
+            }, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        stubber.assert_no_pending_responses()
+
+
+@override_settings(DEBUG=True)
+class AttachmentPreviewTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """本地存储附件预览测试"""
+
+    def setUp(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        super().setUp()
+
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile('hello.txt', b'hello world', content_type='text/plain'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.attachment_id = response.data['id']
+        self.preview_url = f'/api/v1/attachments/files/{self.attachment_id}/preview/'
+
+    def tearDown(self):
+        self.client.delete(f'/api/v1/attachments/files/{self.attachment_id}/')
+
+    def test_preview_full_file(self):
+        """测试无 Range 头返回完整文件"""
+        response = self.client.get(self.preview_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), b'hello world')
+
+    def test_preview_range(self):
+        """测试 Range 请求只返回指定范围"""
+        response = self.client.get(self.preview_url, HTTP_RANGE='bytes=6-')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 6-10/11')
+        self.assertEqual(response['Content-Length'], '5')
+        self.assertEqual(b''.join(response.streaming_content), b'world')
+
+    def test_preview_range_not_satisfiable(self):
+        """测试超出文件大小的 Range 返回 416"""
+        response = self.client.get(self.preview_url, HTTP_RANGE='bytes=100-200')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], 'bytes */11')
+
+    def test_preview_multi_range(self):
+        """测试多段 Range 返回 multipart/byteranges"""
+        response = self.client.get(self.preview_url, HTTP_RANGE='bytes=0-1, 6-7')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b'Content-Range: bytes 0-1/11\r\n\r\nhe\r\n', body)
+        self.assertIn(b'Content-Range: bytes 6-7/11\r\n\r\nwo\r\n', body)
+
+    def test_preview_multi_range_coalesced(self):
+        """测试重叠的多段 Range 合并为单段"""
+        response = self.client.get(self.preview_url, HTTP_RANGE='bytes=4-8,0-5,100-')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 0-8/11')
+        self.assertEqual(b''.join(response.streaming_content), b'hello wor')
+
+    def test_preview_if_range(self):
+        """测试 If-Range 与 ETag 不匹配时返回完整文件"""
+        etag = self.client.get(self.preview_url)['ETag']
+
+        response = self.client.get(self.preview_url, HTTP_RANGE='bytes=6-', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+
+        response = self.client.get(self.preview_url, HTTP_RANGE='bytes=6-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), b'hello world')
+
+    def test_preview_conditional_get(self):
+        """测试预览响应带长期缓存头，If-None-Match 命中时返回 304"""
+        response = self.client.get(self.preview_url, HTTP_RANGE='bytes=0-4')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(response['Cache-Control'].startswith('private'))
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        response = self.client.get(self.preview_url, HTTP_IF_NONE_MATCH=f'"other", W/{etag}')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(self.preview_url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get(self.preview_url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_preview_x_accel_redirect(self):
+        """测试配置 X-Accel-Redirect 后交给 nginx 输出"""
+        from django.conf import settings as django_settings
+
+        chewy_settings = {**django_settings.CHEWY_ATTACHMENT, 'X_ACCEL_REDIRECT_PREFIX': '/_protected/attachments/'}
+        with self.settings(CHEWY_ATTACHMENT=chewy_settings):
+            response = self.client.get(self.preview_url, HTTP_RANGE='bytes=0-4')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['X-Accel-Redirect'].startswith('/_protected/attachments/'))
+        self.assertEqual(response.content, b'')
+
+
+@override_settings(DEBUG=True)
+class AttachmentDerivativeTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """图片缩略图测试"""
+
+    def setUp(self):
+        import io
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        super().setUp()
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 400), (200, 80, 40)).save(buffer, format='PNG')
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile('photo.png', buffer.getvalue(), content_type='image/png'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn('media_info', response.data)
+        self.attachment_id = response.data['id']
+        self.preview_url = f'/api/v1/attachments/files/{self.attachment_id}/preview/'
+
+    def tearDown(self):
+        self.client.delete(f'/api/v1/attachments/files/{self.attachment_id}/')
+
+    def test_preview_size_generates_derivative(self):
+        """测试 ?size= 按需生成缩略图并记录到 media_info"""
+        import io
+        from PIL import Image
+        from .models import Attachment
+
+        response = self.client.get(self.preview_url, {'size': 300})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual(image.size, (320, 160))
+
+        media_info = Attachment.objects.get(id=self.attachment_id).media_info
+        self.assertEqual(media_info['image'], {'width': 800, 'height': 400})
+        # 原图只有 800 宽，1280 档不生成
+        self.assertEqual(sorted(media_info['derivatives']), ['320', '640'])
+
+    def test_preview_size_larger_than_original(self):
+        """测试请求宽度超过原图时返回原图"""
+        response = self.client.get(self.preview_url, {'size': 1000})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+
+class UploadImageOptimizeTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """上传压缩测试"""
+
+    def _upload(self, name, content, content_type):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile(name, content, content_type=content_type),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.addCleanup(self.client.delete, f"/api/v1/attachments/files/{response.data['id']}/")
+        return response
+
+    def _enable(self):
+        from django.conf import settings as django_settings
+
+        chewy_settings = {**django_settings.CHEWY_ATTACHMENT, 'IMAGE_UPLOAD_MAX_DIMENSION': 300}
+        override = self.settings(CHEWY_ATTACHMENT=chewy_settings)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _photo(self, size):
+        import io
+        import random
+        from PIL import Image
+
+        # 随机噪点让 JPEG 体积接近真实照片
+        rng = random.Random(0)
+        image = Image.frombytes('RGB', size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 3)))
+        exif = Image.Exif()
+        exif[0x0112] = 6  # 需要旋转 90° 的方向标记
+        exif[0x010F] = 'PhoneMaker'
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=95, exif=exif)
+        return buffer.getvalue()
+
+    def test_disabled_by_default(self):
+        """测试默认不开启：原样保存"""
+        content = self._photo((600, 400))
+        response = self._upload('photo.jpg', content, 'image/jpeg')
+        self.assertEqual(response.data['size'], len(content))
+        self.assertIsNone(response.data['original_size'])
+
+    def test_downscale_and_strip_metadata(self):
+        """测试开启后缩小、摆正方向、去掉 EXIF，并记录原始大小"""
+        import io
+        from PIL import Image
+        from .models import Attachment
+        from .blob_storage import compute_content_hash
+
+        self._enable()
+        content = self._photo((600, 400))
+        response = self._upload('photo.jpg', content, 'image/jpeg')
+        attachment = Attachment.objects.get(id=response.data['id'])
+        self.assertEqual(attachment.original_size, len(content))
+        self.assertLess(attachment.size, len(content))
+
+        preview = self.client.get(f'/api/v1/attachments/files/{attachment.id}/preview/')
+        stored = b''.join(preview.streaming_content)
+        self.assertEqual(len(stored), attachment.size)
+        # 内容哈希按实际存储的内容计算，审计和迁移校验不会误报
+        self.assertEqual(compute_content_hash([stored]), attachment.content_hash)
+        with Image.open(io.BytesIO(stored)) as image:
+            self.assertEqual(image.size, (200, 300))
+            self.assertEqual(len(image.getexif()), 0)
+
+    def test_keep_original_when_not_smaller(self):
+        """测试压缩后不更小时（或非图片）保存原文件"""
+        import io
+        from PIL import Image
+
+        self._enable()
+        buffer = io.BytesIO()
+        Image.new('RGB', (100, 100), (10, 20, 30)).save(buffer, format='PNG', optimize=True)
+        response = self._upload('small.png', buffer.getvalue(), 'image/png')
+        self.assertIsNone(response.data['original_size'])
+        self.assertEqual(response.data['size'], len(buffer.getvalue()))
+
+        response = self._upload('note.txt', b'hello', 'text/plain')
+        self.assertIsNone(response.data['original_size'])
+
+
+@override_settings(DEBUG=True)
+class AttachmentDedupTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """附件内容去重存储测试"""
+
+    def _upload(self, name, content):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile(name, content, content_type='text/plain'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def test_same_content_stored_once(self):
+        """测试相同内容只存一份，最后一个引用删除时才删除文件"""
+        import os
+        from .models import Attachment, StorageBlob
+
+        first_id = self._upload('a.txt', b'same content')
+        second_id = self._upload('b.txt', b'same content')
+        first = Attachment.objects.get(id=first_id)
+        second = Attachment.objects.get(id=second_id)
+        self.assertEqual(first.storage_path, second.storage_path)
+        self.assertTrue(first.storage_path.startswith('cas/'))
+        blob = StorageBlob.objects.get(content_hash=first.content_hash)
+        self.assertEqual(blob.ref_count, 2)
+
+        self.client.delete(f'/api/v1/attachments/files/{first_id}/')
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        response = self.client.get(f'/api/v1/attachments/files/{second_id}/preview/')
+        self.assertEqual(b''.join(response.streaming_content), b'same content')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/v1/attachments/files/{second_id}/')
+        self.assertFalse(StorageBlob.objects.filter(content_hash=first.content_hash).exists())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'attachments', first.storage_path)))
+
+    def test_upload_streams_to_storage(self):
+        """测试上传按流写入临时文件后替换，不经过 save_file 整块写入，也不留下临时文件"""
+        import os
+        from unittest import mock
+        from chewy_attachment.core.storage import FileStorageEngine
+        from .models import Attachment
+
+        with mock.patch.object(FileStorageEngine, 'save_file', side_effect=AssertionError('save_file')):
+            attachment_id = self._upload('a.txt', b'streamed content')
+        attachment = Attachment.objects.get(id=attachment_id)
+        full_path = os.path.join(self.media_root, 'attachments', attachment.storage_path)
+        with open(full_path, 'rb') as f:
+            self.assertEqual(f.read(), b'streamed content')
+        self.assertEqual(os.listdir(os.path.dirname(full_path)), [os.path.basename(full_path)])
+        self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+
+    def test_failed_register_rolls_back_reference(self):
+        """测试附件记录登记失败时 blob 引用计数一起回滚"""
+        from unittest import mock
+        from .models import Attachment, StorageBlob
+
+        attachment_id = self._upload('a.txt', b'rollback content')
+        content_hash = Attachment.objects.get(id=attachment_id).content_hash
+        with mock.patch('bbtalk.attachment_views.record_attachment_added', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self._upload('b.txt', b'rollback content')
+        self.assertEqual(StorageBlob.objects.get(content_hash=content_hash).ref_count, 1)
+        self.assertEqual(Attachment.objects.filter(content_hash=content_hash).count(), 1)
+        self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+
+    def test_pending_reference_keeps_file(self):
+        """测试 blob 已增加引用、附件记录还没创建时，删除最后一个共享附件不删除文件"""
+        import os
+        from .blob_storage import BlobStorageService
+        from .models import Attachment, StorageBlob
+
+        attachment_id = self._upload('a.txt', b'pending content')
+        attachment = Attachment.objects.get(id=attachment_id)
+        # 模拟另一个上传已经 acquire、还没登记附件
+        blob = StorageBlob.objects.get(content_hash=attachment.content_hash)
+        blob.ref_count += 1
+        blob.save(update_fields=['ref_count'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'attachments', blob.storage_path)))
+        BlobStorageService(None, '').release(attachment.content_hash)
+
+    def test_different_content_not_shared(self):
+        """测试不同内容分别存储"""
+        from .models import Attachment
+
+        first_id = self._upload('a.txt', b'content one')
+        second_id = self._upload('a.txt', b'content two')
+        paths = set(Attachment.objects.filter(id__in=[first_id, second_id]).values_list('storage_path', flat=True))
+        self.assertEqual(len(paths), 2)
+        for attachment_id in (first_id, second_id):
+            self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+
+    def test_hash_preflight(self):
+        """测试哈希预检：自己上传过的内容直接登记新附件，其他用户的内容和未知内容需要上传"""
+        import hashlib
+        from .models import Attachment, StorageBlob
+
+        content = b'preflight content'
+        content_hash = hashlib.sha256(content).hexdigest()
+        url = '/api/v1/attachments/files/preflight/'
+        payload = {'content_hash': content_hash, 'size': len(content), 'original_name': 'copy.txt'}
+
+        self.assertEqual(self.client.post(url, payload).data, {'exists': False})
+        self.assertEqual(APIClient().post(url, payload).status_code, status.HTTP_401_UNAUTHORIZED)
+        first_id = self._upload('a.txt', content)
+
+        other = APIClient()
+        other.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(User.objects.create(username="other")).access_token}')
+        self.assertEqual(other.post(url, payload).data, {'exists': False})
+        self.assertEqual(self.client.post(url, {**payload, 'size': 1}).data, {'exists': False})
+        self.assertEqual(self.client.post(url, {**payload, 'content_hash': 'xyz'}).status_code, 400)
+
+        response = self.client.post(url, payload)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['exists'])
+        second = Attachment.objects.get(id=response.data['attachment']['id'])
+        self.assertEqual(second.original_name, 'copy.txt')
+        self.assertEqual(second.storage_path, Attachment.objects.get(id=first_id).storage_path)
+        self.assertEqual(StorageBlob.objects.get(content_hash=content_hash).ref_count, 2)
+
+        preview = self.client.get(f'/api/v1/attachments/files/{second.id}/preview/')
+        self.assertEqual(b''.join(preview.streaming_content), content)
+        for attachment_id in (first_id, second.id):
+            self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+        self.assertFalse(StorageBlob.objects.filter(content_hash=content_hash).exists())
+
+    def test_hash_preflight_ignores_other_users_config(self):
+        """测试哈希预检指定其他用户的存储配置时按自己的默认存储处理"""
+        import hashlib
+        from .models import Attachment, StorageBlob, UserStorageSettings
+
+        content = b'preflight config'
+        content_hash = hashlib.sha256(content).hexdigest()
+        first_id = self._upload('a.txt', content)
+        other_config = UserStorageSettings.objects.create(
+            user=User.objects.create(username='other'), name='s3', s3_access_key_id='k',
+            s3_secret_access_key='s', s3_bucket_name='b', s3_endpoint_url='http://127.0.0.1:1',
+        )
+        response = self.client.post('/api/v1/attachments/files/preflight/', {
+            'content_hash': content_hash, 'size': len(content), 'original_name': 'copy.txt',
+            'storage_config_id': other_config.id,
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        second = Attachment.objects.get(id=response.data['attachment']['id'])
+        self.assertIsNone(second.storage_config_id)
+        self.assertEqual(StorageBlob.objects.get(content_hash=content_hash).ref_count, 2)
+        for attachment_id in (first_id, second.id):
+            self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+
+
+class BatchUploadTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """多文件批量上传测试"""
+
+    def tearDown(self):
+        from .models import Attachment
+
+        for attachment_id in Attachment.objects.filter(owner_id=str(self.user.id)).values_list('id', flat=True):
+            self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+
+    def test_batch_upload_per_file_results(self):
+        """测试一次上传多个文件：逐个返回结果，相同内容只写一次，失败的文件不影响其他文件"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .models import Attachment, StorageBlob, StorageUsage
+
+        response = self.client.post('/api/v1/attachments/files/batch/', {
+            'files': [
+                SimpleUploadedFile('a.txt', b'batch one', content_type='text/plain'),
+                SimpleUploadedFile('b.txt', b'batch two', content_type='text/plain'),
+                SimpleUploadedFile('c.exe', b'not allowed', content_type='application/octet-stream'),
+                SimpleUploadedFile('d.txt', b'batch one', content_type='text/plain'),
+            ],
+            'is_public': 'true',
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.data['results']
+        self.assertEqual([item['status'] for item in results], [201, 201, 400, 201])
+        self.assertEqual(results[2]['name'], 'c.exe')
+        self.assertEqual(results[3]['attachment']['original_name'], 'd.txt')
+        self.assertTrue(results[0]['attachment']['is_public'])
+
+        first, last = (Attachment.objects.get(id=results[i]['attachment']['id']) for i in (0, 3))
+        self.assertEqual(first.storage_path, last.storage_path)
+        self.assertEqual(StorageBlob.objects.get(content_hash=first.content_hash).ref_count, 2)
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.file_count, usage.bytes_used), (3, 27))
+
+        preview = self.client.get(f"/api/v1/attachments/files/{results[1]['attachment']['id']}/preview/")
+        self.assertEqual(b''.join(preview.streaming_content), b'batch two')
+
+    def test_batch_upload_requires_login(self):
+        """测试未登录不能批量上传"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = APIClient().post('/api/v1/attachments/files/batch/', {
+            'files': [SimpleUploadedFile('a.txt', b'anonymous')],
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_batch_upload_limits(self):
+        """测试没有文件或超过数量上限时拒绝"""
+        from django.conf import settings as django_settings
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        self.assertEqual(self.client.post('/api/v1/attachments/files/batch/', {}, format='multipart').status_code, 400)
+        with self.settings(CHEWY_ATTACHMENT={**django_settings.CHEWY_ATTACHMENT, 'BATCH_UPLOAD_MAX_FILES': 1}):
+            response = self.client.post('/api/v1/attachments/files/batch/', {
+                'files': [SimpleUploadedFile(f'{i}.txt', b'x') for i in range(2)],
+            }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_upload_ignores_other_users_config(self):
+        """测试指定其他用户的存储配置时不会写入该存储，也不计入该配置的用量"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .models import Attachment, StorageUsage, UserStorageSettings
+
+        other_config = UserStorageSettings.objects.create(
+            user=User.objects.create(username='other'), name='s3', s3_access_key_id='k',
+            s3_secret_access_key='s', s3_bucket_name='b', s3_endpoint_url='http://127.0.0.1:1',
+        )
+        response = self.client.post('/api/v1/attachments/files/batch/', {
+            'files': [SimpleUploadedFile('a.txt', b'not yours')],
+            'storage_config_id': other_config.id,
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        attachment = Attachment.objects.get(id=response.data['results'][0]['attachment']['id'])
+        self.assertIsNone(attachment.storage_config_id)
+        self.assertFalse(StorageUsage.objects.filter(storage_config_id=str(other_config.id)).exists())
+
+
+class AttachmentDeletionTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """批量删除 BBTalk、注销账号时的附件删除测试"""
+
+    def create_user(self):
+        from .authentication import create_user_with_password
+
+        return create_user_with_password('deleter', 'secret-pass')
+
+    def _upload(self, name, content):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .models import Attachment
+
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile(name, content, content_type='text/plain'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return Attachment.objects.get(id=response.data['id'])
+
+    def _engine(self):
+        from .storage_migration import StorageMigrationService
+
+        return StorageMigrationService(self.user).get_engine(None)
+
+    def _wait_for_deletion(self):
+        from .attachment_deletion import _get_executor
+
+        # 删除任务在单线程池中依次执行，排在其后的空任务完成即表示删除已结束
+        _get_executor().submit(lambda: None).result(timeout=10)
+
+    def test_batch_delete_bbtalks(self):
+        """测试批量删除 BBTalk：只删除不再被 BBTalk 或评论引用的附件，存储对象在提交后删除"""
+        from .models import Attachment, Comment, StorageBlob
+
+        only_first = self._upload('a.txt', b'only in deleted notes')
+        shared = self._upload('b.txt', b'also in a kept note')
+        copy = self._upload('c.txt', b'only in deleted notes')
+        first = BBTalk.objects.create(user=self.user, content='one', attachments=[{'uid': str(only_first.id)}])
+        second = BBTalk.objects.create(
+            user=self.user, content=f'see /api/v1/attachments/files/{shared.id}/preview/',
+            attachments=[{'uid': str(copy.id)}],
+        )
+        kept = BBTalk.objects.create(user=self.user, content='kept', attachments=[{'uid': str(shared.id)}])
+        commented = self._upload('d.txt', b'linked from a comment')
+        first.attachments.append({'uid': str(commented.id)})
+        first.save()
+        Comment.objects.create(user=self.user, bbtalk=kept, content=f'/api/v1/attachments/files/{commented.id}/')
+        other_note = BBTalk.objects.create(user=User.objects.create(username='other'), content='other')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/bbtalk/batch-delete/', {
+                'uids': [first.uid, second.uid, other_note.uid],
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'deleted': 2, 'deleted_attachments': 2})
+        self._wait_for_deletion()
+
+        self.assertEqual(set(BBTalk.objects.values_list('id', flat=True)), {kept.id, other_note.id})
+        self.assertEqual(set(Attachment.objects.values_list('id', flat=True)), {shared.id, commented.id})
+        self.assertFalse(StorageBlob.objects.filter(content_hash=only_first.content_hash).exists())
+        self.assertFalse(self._engine().file_exists(only_first.storage_path))
+        self.assertTrue(self._engine().file_exists(shared.storage_path))
+
+        self.assertEqual(self.client.post('/api/v1/bbtalk/batch-delete/', {'uids': []}, format='json').status_code, 400)
+
+    def test_delete_account_removes_attachments(self):
+        """测试注销账号时删除附件记录和文件"""
+        from .models import Attachment, StorageUsage
+
+        attachments = [self._upload(f'{i}.txt', f'account file {i}'.encode()) for i in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/bbtalk/user/delete-account/', {'password': 'secret-pass'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self._wait_for_deletion()
+
+        self.assertFalse(User.objects.filter(username='deleter').exists())
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(StorageUsage.objects.exists())
+        engine = self._engine()
+        for attachment in attachments:
+            self.assertFalse(engine.file_exists(attachment.storage_path))
+
+
+class StorageMigrationTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """存储迁移服务测试"""
+
+    def setUp(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        super().setUp()
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile('a.txt', b'migrate me' * 1000, content_type='text/plain'),
+        }, format='multipart')
+        self.attachment_id = response.data['id']
+
+    def tearDown(self):
+        self.client.delete(f'/api/v1/attachments/files/{self.attachment_id}/')
+
+    def test_skip_attachments_already_on_target(self):
+        """测试已在目标存储的附件直接跳过"""
+        from .storage_migration import StorageMigrationService
+
+        stats = StorageMigrationService(self.user).migrate(None)
+        self.assertEqual(stats['total'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['migrated'], 0)
+
+    def test_stream_copy_between_local_engines(self):
+        """测试在两个本地存储之间流式复制"""
+        import tempfile
+        from chewy_attachment.core.storage import FileStorageEngine
+        from .models import Attachment
+        from .storage_migration import StorageMigrationService
+
+        attachment = Attachment.objects.get(id=self.attachment_id)
+        service = StorageMigrationService(self.user)
+        with tempfile.TemporaryDirectory() as root:
+            target = FileStorageEngine(root)
+            result, server_side = service._copy_object(
+                attachment, service.get_engine(None), target, attachment.storage_path,
+            )
+            self.assertFalse(server_side)
+            self.assertEqual(result.size, 10000)
+            self.assertEqual(target.get_file(attachment.storage_path), b'migrate me' * 1000)
+
+    def test_copy_verification_rejects_mismatched_source(self):
+        """测试源文件与记录的内容哈希不一致时复制失败，且不留下目标文件"""
+        import os
+        import tempfile
+        from chewy_attachment.core.storage import FileStorageEngine
+        from .models import Attachment
+        from .storage_io import VerificationError
+        from .storage_migration import StorageMigrationService
+
+        attachment = Attachment.objects.get(id=self.attachment_id)
+        attachment.content_hash = '0' * 64
+        service = StorageMigrationService(self.user)
+        with tempfile.TemporaryDirectory() as root:
+            target = FileStorageEngine(root)
+            with self.assertRaises(VerificationError):
+                service._copy_object(attachment, service.get_engine(None), target, attachment.storage_path)
+            self.assertFalse(os.path.exists(os.path.join(root, attachment.storage_path)))
+
+    def test_audit_reports_missing_and_corrupt(self):
+        """测试巡检发现缺失和内容损坏的附件"""
+        from .models import Attachment
+        from .storage_audit import audit_attachments
+        from .storage_migration import StorageMigrationService
+
+        report = audit_attachments(user=self.user, deep=True)
+        self.assertEqual((report['total'], report['ok']), (1, 1))
+
+        attachment = Attachment.objects.get(id=self.attachment_id)
+        path = StorageMigrationService(self.user).get_engine(None)._get_full_path(attachment.storage_path)
+        original = path.read_bytes()
+        try:
+            path.write_bytes(b'x' * len(original))
+            report = audit_attachments(user=self.user, deep=True)
+            self.assertEqual(report['corrupt'], 1)
+            self.assertEqual(audit_attachments(user=self.user)['ok'], 1)
+
+            path.unlink()
+            report = audit_attachments(storage_config_id='')
+            self.assertEqual(report['missing'], 1)
+            self.assertEqual(report['problems'][0]['id'], str(attachment.id))
+        finally:
+            path.write_bytes(original)
+
+    def test_preview_aggregates_and_estimates(self):
+        """测试预览按源存储分组统计，并根据以往任务的实测速率估算耗时"""
+        from .models import StorageMigrationJob, UserStorageSettings
+
+        config = UserStorageSettings.objects.create(
+            user=self.user, name='s3', s3_access_key_id='k', s3_secret_access_key='s', s3_bucket_name='b',
+        )
+        response = self.client.post('/api/v1/bbtalk/storage/migration/preview/', {
+            'target_config_id': config.id,
+        }, format='json')
+        self.assertEqual(response.data['need_migrate'], 1)
+        self.assertEqual(response.data['need_migrate_bytes'], 10000)
+        self.assertEqual(response.data['sources'][0]['name'], '服务器存储')
+        self.assertIsNone(response.data['estimated_seconds'])
+
+        StorageMigrationJob.objects.create(
+            user=self.user,
+            target_config_id=str(config.id),
+            status=StorageMigrationJob.STATUS_COMPLETED,
+            transfer_stats={'': {'bytes': 1000, 'seconds': 1.0}},
+        )
+        with self.settings(CHEWY_ATTACHMENT={'MIGRATION_WORKERS': 2}):
+            response = self.client.post('/api/v1/bbtalk/storage/migration/preview/', {
+                'target_config_id': config.id,
+            }, format='json')
+        self.assertEqual(response.data['estimated_seconds'], 5)
+
+    def test_preview_falls_back_to_benchmark(self):
+        """测试没有实测迁移速率时，用目标存储的性能测试结果估算耗时"""
+        from .models import UserStorageSettings
+        from .storage_benchmark import percentile
+
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 99), 5)
+
+        config = UserStorageSettings.objects.create(
+            user=self.user, name='s3', s3_access_key_id='k', s3_secret_access_key='s', s3_bucket_name='b',
+            benchmark={'large': {'put_bytes_per_second': 2500, 'get_bytes_per_second': 10000}},
+        )
+        with self.settings(CHEWY_ATTACHMENT={'MIGRATION_WORKERS': 2}):
+            response = self.client.post('/api/v1/bbtalk/storage/migration/preview/', {
+                'target_config_id': config.id,
+            }, format='json')
+        self.assertEqual(response.data['estimated_seconds'], 2)
+
+    def test_execute_creates_background_job(self):
+        """测试执行迁移只返回任务 ID，任务执行后可查询进度"""
+        from .migration_jobs import run_migration_job
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.client.post('/api/v1/bbtalk/storage/migration/execute/', {
+                'target_config_id': None,
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(list(response.data.keys()), ['job_id'])
+        self.assertEqual(len(callbacks), 1)
+
+        job_id = response.data['job_id']
+        run_migration_job(job_id)
+        response = self.client.get(f'/api/v1/bbtalk/storage/migration/jobs/{job_id}/')
+        self.assertEqual(response.data['status'], 'completed')
+        self.assertEqual(response.data['done'], response.data['total'])
+
+    def test_cancel_pending_job(self):
+        """测试取消尚未开始的任务，之后可以恢复"""
+        with self.captureOnCommitCallbacks(execute=False):
+            job_id = self.client.post('/api/v1/bbtalk/storage/migration/execute/', {
+                'target_config_id': None,
+            }, format='json').data['job_id']
+        response = self.client.post(f'/api/v1/bbtalk/storage/migration/jobs/{job_id}/cancel/')
+        self.assertEqual(response.data['status'], 'cancelled')
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.client.post(f'/api/v1/bbtalk/storage/migration/jobs/{job_id}/resume/')
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(len(callbacks), 1)
+
+    def test_concurrent_execute_creates_one_job(self):
+        """测试并发执行迁移（检查后另一请求已建任务）时返回已有任务，不会创建第二个"""
+        from unittest import mock
+        from .migration_jobs import start_migration_job
+        from .models import StorageMigrationJob
+
+        with self.captureOnCommitCallbacks(execute=False):
+            first = start_migration_job(self.user, None)
+            with mock.patch('bbtalk.migration_jobs.get_active_job', side_effect=[None, first]):
+                second = start_migration_job(self.user, None)
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(StorageMigrationJob.objects.filter(user=self.user).count(), 1)
+
+
+class AttachmentGarbageCollectionTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """附件垃圾回收测试"""
+
+    def setUp(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        super().setUp()
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile('a.txt', b'orphan' * 100, content_type='text/plain'),
+        }, format='multipart')
+        self.attachment_id = response.data['id']
+
+    def tearDown(self):
+        self.client.delete(f'/api/v1/attachments/files/{self.attachment_id}/')
+
+    def test_collect_unreferenced_attachments(self):
+        """测试回收没有被 BBTalk 引用的附件，试运行不删除"""
+        from .models import Attachment, Comment
+        from .storage_gc import StorageGarbageCollector
+
+        bbtalk = BBTalk.objects.create(
+            user=self.user,
+            content='引用附件',
+            attachments=[{'uid': self.attachment_id, 'url': f'/api/v1/attachments/files/{self.attachment_id}/'}],
+        )
+        report = StorageGarbageCollector(dry_run=True, grace_hours=0).run(objects=False)
+        self.assertEqual(report['orphan_attachments'], 0)
+
+        # 正文里的附件链接同样算作引用
+        bbtalk.attachments = []
+        bbtalk.content = f'![](/api/v1/attachments/files/{self.attachment_id}/preview/)'
+        bbtalk.save()
+        report = StorageGarbageCollector(dry_run=True, grace_hours=0).run(objects=False)
+        self.assertEqual(report['orphan_attachments'], 0)
+
+        bbtalk.delete()
+        self.assertEqual(StorageGarbageCollector(dry_run=True).run(objects=False)['orphan_attachments'], 0)
+
+        # 只被评论引用的附件也不回收
+        comment = Comment.objects.create(
+            user=self.user,
+            bbtalk=BBTalk.objects.create(user=self.user, content='其他'),
+            content=f'见 /api/v1/attachments/files/{self.attachment_id}/preview/',
+        )
+        report = StorageGarbageCollector(dry_run=True, grace_hours=0).run(objects=False)
+        self.assertEqual(report['orphan_attachments'], 0)
+        comment.delete()
+
+        report = StorageGarbageCollector(dry_run=True, grace_hours=0).run(objects=False)
+        self.assertEqual(report['orphan_attachments'], 1)
+        self.assertTrue(Attachment.objects.filter(id=self.attachment_id).exists())
+
+        attachment = Attachment.objects.get(id=self.attachment_id)
+        path = StorageGarbageCollector()._engine_for(self.user.id, None)._get_full_path(attachment.storage_path)
+        with self.captureOnCommitCallbacks(execute=True):
+            report = StorageGarbageCollector(dry_run=False, grace_hours=0).run(objects=False)
+        self.assertEqual(report['deleted_attachments'], 1)
+        self.assertFalse(Attachment.objects.filter(id=self.attachment_id).exists())
+        self.assertFalse(path.exists())
+
+    def test_collect_orphan_objects(self):
+        """测试只删除超过宽限期、无人引用且由本应用生成的存储对象"""
+        import os
+        import tempfile
+        import time
+        from chewy_attachment.core.storage import FileStorageEngine
+        from .storage_gc import StorageGarbageCollector
+
+        with tempfile.TemporaryDirectory() as root:
+            engine = FileStorageEngine(root)
+            old = time.time() - 3 * 86400
+            for path in ('2020/01/01/orphan.txt', '2020/01/01/kept.txt', 'backup/other.txt', '2020/01/02/new.txt'):
+                engine.save_file(b'x', os.path.basename(path), storage_path=path)
+                if 'new' not in path:
+                    os.utime(engine._get_full_path(path), (old, old))
+
+            collector = StorageGarbageCollector(dry_run=True)
+            collector._collect_storage('local', engine, {'2020/01/01/kept.txt'})
+            self.assertEqual(collector.report['orphan_objects'], 1)
+            self.assertTrue(engine.file_exists('2020/01/01/orphan.txt'))
+
+            collector = StorageGarbageCollector(dry_run=False)
+            collector._collect_storage('local', engine, {'2020/01/01/kept.txt'})
+            self.assertEqual(collector.report['deleted_objects'], 1)
+            self.assertFalse(engine.file_exists('2020/01/01/orphan.txt'))
+            self.assertTrue(engine.file_exists('2020/01/01/kept.txt'))
+            self.assertTrue(engine.file_exists('backup/other.txt'))
+            self.assertTrue(engine.file_exists('2020/01/02/new.txt'))
+
+
+class StorageUsageTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """存储用量与配额测试"""
+
+    def tearDown(self):
+        from .models import Attachment
+
+        for attachment_id in Attachment.objects.filter(owner_id=str(self.user.id)).values_list('id', flat=True):
+            self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+
+    def _upload(self, content):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        return self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile('u.txt', content, content_type='text/plain'),
+        }, format='multipart')
+
+    def test_usage_counters_and_quota(self):
+        """测试上传和删除时更新用量，超过配额时拒绝上传"""
+        from .models import StorageUsage
+        from .storage_usage import recalculate_usage
+
+        attachment_id = self._upload(b'a' * 300).data['id']
+        self._upload(b'b' * 200)
+        usage = self.client.get('/api/v1/bbtalk/user/me/').data['storage_usage']
+        self.assertEqual(usage['file_count'], 2)
+        self.assertEqual(usage['bytes_used'], 500)
+        self.assertIsNone(usage['storages'][0]['storage_config_id'])
+
+        StorageUsage.objects.filter(user=self.user).update(quota_bytes=600)
+        response = self._upload(b'c' * 200)
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.file_count, usage.bytes_used), (1, 200))
+        self.assertEqual(self._upload(b'c' * 200).status_code, status.HTTP_201_CREATED)
+
+        StorageUsage.objects.filter(user=self.user).update(file_count=0, bytes_used=0)
+        recalculate_usage(self.user)
+        usage = StorageUsage.objects.get(user=self.user)
+        self.assertEqual((usage.file_count, usage.bytes_used, usage.quota_bytes), (2, 400, 600))
+
+
+class StorageHealthTest(AuthenticatedAPITestCase):
+    """用户 S3 存储熔断测试"""
+
+    def setUp(self):
+        from .models import UserStorageSettings
+
+        super().setUp()
+        # 本机 1 端口没有服务，连接会立即被拒绝
+        self.config = UserStorageSettings.objects.create(
+            user=self.user, name='s3', s3_access_key_id='k', s3_secret_access_key='s', s3_bucket_name='b',
+            s3_endpoint_url='http://127.0.0.1:1', s3_max_attempts=1,
+        )
+
+    def tearDown(self):
+        from .storage_health import reset_health
+
+        reset_health(self.config.id)
+
+    def test_breaker_opens_after_failures(self):
+        """测试连续失败达到阈值后熔断，之后的请求直接失败，设置接口展示熔断状态"""
+        from .storage import UserS3Storage
+        from .storage_health import StorageUnavailable, record_success
+
+        with self.settings(CHEWY_ATTACHMENT={'S3_BREAKER_FAILURES': 2, 'S3_BREAKER_COOLDOWN': 300}):
+            storage = UserS3Storage(user_settings=self.config)
+            self.assertEqual(storage.client_config.retries['max_attempts'], 1)
+            for _ in range(2):
+                with self.assertRaises(Exception) as raised:
+                    storage.exists('2020/01/01/a.txt')
+                self.assertNotIsInstance(raised.exception, StorageUnavailable)
+            with self.assertRaises(StorageUnavailable):
+                UserS3Storage(user_settings=self.config).exists('2020/01/01/a.txt')
+
+            health = self.client.get('/api/v1/bbtalk/settings/storage/').data[0]['health']
+            self.assertEqual(health['state'], 'open')
+            self.assertEqual(health['failures'], 2)
+            self.assertIsNotNone(health['retry_at'])
+
+        record_success(self.config.id)
+        health = self.client.get('/api/v1/bbtalk/settings/storage/').data[0]['health']
+        self.assertEqual((health['state'], health['failures']), ('closed', 0))
+
+    def test_concurrent_failures_are_counted(self):
+        """测试并发失败不丢失计数，未达到阈值的失败不会覆盖熔断状态"""
+        from concurrent.futures import ThreadPoolExecutor
+        from .storage_health import get_health, record_failure
+
+        with self.settings(CHEWY_ATTACHMENT={'S3_BREAKER_FAILURES': 1000}):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(lambda i: record_failure(self.config.id, f'error {i}'), range(200)))
+            health = get_health(self.config.id)
+            self.assertEqual((health['state'], health['failures']), ('closed', 200))
+
+        with self.settings(CHEWY_ATTACHMENT={'S3_BREAKER_FAILURES': 201}):
+            record_failure(self.config.id, 'open')
+        with self.settings(CHEWY_ATTACHMENT={'S3_BREAKER_FAILURES': 1000}):
+            record_failure(self.config.id, 'late')
+            self.assertEqual(get_health(self.config.id)['state'], 'open')
+
+
+class S3ClientPoolTest(AuthenticatedAPITestCase):
+    """共享 S3 客户端测试"""
+
+    def setUp(self):
+        from .models import UserStorageSettings
+        from .s3_clients import clear_clients
+
+        clear_clients()
+        super().setUp()
+        self.config = UserStorageSettings.objects.create(
+            user=self.user, name='s3', s3_access_key_id='k', s3_secret_access_key='s', s3_bucket_name='b',
+            s3_endpoint_url='http://127.0.0.1:1',
+        )
+
+    def test_storages_share_client(self):
+        """测试同一配置的存储实例共享客户端，凭证变化后使用新客户端，连接池状态只对管理员开放"""
+        from .s3_clients import get_s3_client
+        from .storage import UserS3Storage
+
+        first = UserS3Storage(user_settings=self.config).connection.meta.client
+        second = UserS3Storage(user_settings=self.config).connection.meta.client
+        self.assertIs(first, second)
+        self.assertEqual(first.meta.config.max_pool_connections, 20)
+        # 不经过熔断的客户端与带熔断钩子的客户端分开缓存
+        self.assertIsNot(get_s3_client(self.config.get_s3_config()), first)
+
+        self.config.s3_secret_access_key = 'rotated'
+        self.assertIsNot(UserS3Storage(user_settings=self.config).connection.meta.client, first)
+
+        self.assertEqual(self.client.get('/api/v1/bbtalk/storage/pool-stats/').status_code, status.HTTP_403_FORBIDDEN)
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        stats = self.client.get('/api/v1/bbtalk/storage/pool-stats/').data
+        self.assertEqual(len(stats['clients']), 3)
+        self.assertEqual(stats['clients'][0]['config_id'], str(self.config.id))
+
+    def test_evicted_client_not_closed(self):
+        """测试超出缓存数量淘汰客户端时不关闭它，其他线程仍可继续使用"""
+        from unittest import mock
+        from django.conf import settings as django_settings
+        from .s3_clients import get_s3_client
+
+        with self.settings(CHEWY_ATTACHMENT={**django_settings.CHEWY_ATTACHMENT, 'S3_CLIENT_CACHE_SIZE': 1}):
+            first = get_s3_client(self.config.get_s3_config())
+            with mock.patch.object(first, 'close') as close:
+                second = get_s3_client({**self.config.get_s3_config(), 'secret_access_key': 'rotated'})
+                self.assertIsNot(second, first)
+                self.assertIsNot(get_s3_client(self.config.get_s3_config()), first)
+            close.assert_not_called()
+
+
+class S3ProxyDownloadTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """S3 附件服务器转发测试"""
+
+    def setUp(self):
+        from botocore.stub import Stubber
+        from .models import Attachment, UserStorageSettings
+        from .s3_clients import clear_clients
+        from .storage import UserS3Storage
+
+        clear_clients()
+        self.addCleanup(clear_clients)
+        super().setUp()
+        self.config = UserStorageSettings.objects.create(
+            user=self.user, name='s3', s3_access_key_id='k', s3_secret_access_key='s', s3_bucket_name='b',
+            s3_endpoint_url='http://127.0.0.1:1', s3_proxy_downloads=True, is_active=True,
+        )
+        self.attachment = Attachment.objects.create(
+            original_name='a.txt', storage_path='2020/01/01/a.txt', mime_type='text/plain', size=10,
+            owner_id=str(self.user.id), storage_config_id=str(self.config.id),
+        )
+        self.url = f'/api/v1/attachments/files/{self.attachment.id}/preview/'
+        # 视图中的存储实例使用同一个共享客户端，在它上面打桩
+        self.stubber = Stubber(UserS3Storage(user_settings=self.config).connection.meta.client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def _expect(self, data, byte_range=None):
+        import io
+        from botocore.response import StreamingBody
+
+        stream = io.BytesIO(data)
+        response = {'Body': StreamingBody(stream, len(data)), 'ContentLength': len(data)}
+        params = {'Bucket': 'b', 'Key': '2020/01/01/a.txt'}
+        if byte_range:
+            response['ContentRange'] = f'bytes {byte_range}/10'
+            params['Range'] = f'bytes={byte_range}'
+        self.stubber.add_response('get_object', response, params)
+        return stream
+
+    def test_range_is_forwarded(self):
+        """测试 Range 转成 GetObject 的 Range，单段与多段都返回 206"""
+        self._expect(b'cdef', '2-5')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(response['Content-Length'], '4')
+        self.assertEqual(b''.join(response.streaming_content), b'cdef')
+
+        self._expect(b'ab', '0-1')
+        self._expect(b'ij', '8-9')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,8-9')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(b'Content-Range: bytes 0-1/10\r\n\r\nab', body)
+        self.assertIn(b'Content-Range: bytes 8-9/10\r\n\r\nij', body)
+
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=20-30').status_code, 416)
+        self.stubber.assert_no_pending_responses()
+
+    def test_closing_response_releases_upstream(self):
+        """测试客户端断开（响应关闭）时关闭上游响应体，文件地址指向服务器"""
+        stream = self._expect(b'abcdefghij')
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Length'], '10')
+        next(iter(response.streaming_content))
+        response.close()
+        self.assertTrue(stream.closed)
+
+    def test_evicted_cache_file_falls_back_to_proxy(self):
+        """测试磁盘缓存文件在输出前被淘汰时退回服务器转发"""
+        import os
+        import tempfile
+        from django.conf import settings as django_settings
+        from . import disk_cache
+
+        class EvictingCache(disk_cache.AttachmentDiskCache):
+            """写入缓存后立即删除，模拟 fetch 返回后被其他 worker 淘汰"""
+
+            def fetch(self, *args, **kwargs):
+                path = super().fetch(*args, **kwargs)
+                os.remove(path)
+                return path
+
+        with tempfile.TemporaryDirectory() as cache_root, self.settings(CHEWY_ATTACHMENT={
+            **django_settings.CHEWY_ATTACHMENT, 'S3_DISK_CACHE_BYTES': 1000, 'S3_DISK_CACHE_ROOT': cache_root,
+        }):
+            disk_cache._disk_cache = EvictingCache(cache_root, 1000, django_settings.CHEWY_ATTACHMENT['S3_DISK_CACHE_MAX_OBJECT_BYTES'])
+            self.addCleanup(setattr, disk_cache, '_disk_cache', None)
+            self._expect(b'abcdefghij')
+            self._expect(b'abcdefghij')
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), b'abcdefghij')
+        self.stubber.assert_no_pending_responses()
+
+        data = self.client.get(f'/api/v1/attachments/files/{self.attachment.id}/').data
+        self.assertIn('/api/v1/attachments/files/', data['file_url'])
+
+
+class PublicAttachmentUrlTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """公开附件无签名地址测试"""
+
+    def test_public_bbtalk_embeds_public_url(self):
+        """测试公开附件发布到公开目录，公开接口返回无签名地址，删除附件时删除公开副本"""
+        import os
+        import tempfile
+        from django.conf import settings
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .models import Attachment
+
+        with tempfile.TemporaryDirectory() as public_root, self.settings(CHEWY_ATTACHMENT={
+            **settings.CHEWY_ATTACHMENT, 'PUBLIC_LOCAL_URL': '/media/public/', 'PUBLIC_LOCAL_ROOT': public_root,
+        }):
+            response = self.client.post('/api/v1/attachments/files/', {
+                'file': SimpleUploadedFile('p.txt', b'public content', content_type='text/plain'),
+                'is_public': True,
+            }, format='multipart')
+            attachment = response.data
+            storage_path = Attachment.objects.get(id=attachment['id']).storage_path
+            self.assertEqual(attachment['public_url'], f"/media/public/{storage_path}")
+            public_file = os.path.join(public_root, storage_path)
+            with open(public_file, 'rb') as f:
+                self.assertEqual(f.read(), b'public content')
+
+            BBTalk.objects.create(user=self.user, content='hi', visibility='public', attachments=[
+                {'uid': attachment['id'], 'url': '/api/v1/attachments/files/x/preview/', 'type': 'file'},
+                {'uid': 'not-a-uuid', 'url': '/keep/'},
+            ])
+            self.client.credentials()
+            items = self.client.get('/api/v1/bbtalk/public/').data['results'][0]['attachments']
+            self.assertEqual(items[0]['url'], f"http://testserver/media/public/{storage_path}")
+            self.assertEqual(items[1]['url'], '/keep/')
+
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete(f"/api/v1/attachments/files/{attachment['id']}/")
+            self.assertFalse(os.path.exists(public_file))
+
+
+@override_settings(DEBUG=True)
+class AttachmentResolveTest(TemporaryMediaMixin, AuthenticatedAPITestCase):
+    """批量解析附件地址测试"""
+
+    def setUp(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        super().setUp()
+        self.other = User.objects.create(username='other')
+        self.attachment_ids = []
+        for user, is_public, content in ((self.user, False, b'mine'), (self.other, False, b'private'), (self.other, True, b'public')):
+            refresh = RefreshToken.for_user(user)
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+            response = self.client.post('/api/v1/attachments/files/', {
+                'file': SimpleUploadedFile('note.txt', content, content_type='text/plain'),
+                'is_public': is_public,
+            }, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.attachment_ids.append(response.data['id'])
+        self.owners = (self.user, self.other, self.other)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def tearDown(self):
+        for user, attachment_id in zip(self.owners, self.attachment_ids):
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+            self.client.delete(f'/api/v1/attachments/files/{attachment_id}/')
+
+    def test_resolve(self):
+        """测试一次返回可访问附件的地址，其他 ID 归入 missing"""
+        mine, private, public = self.attachment_ids
+        response = self.client.post('/api/v1/attachments/files/resolve/', {
+            'ids': [mine, private, public, 'not-a-uuid'],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results']), {mine, public})
+        self.assertEqual(set(response.data['missing']), {private, 'not-a-uuid'})
+        self.assertTrue(response.data['results'][mine]['url'].endswith(f'/files/{mine}/preview/'))
+
+    def test_resolve_requires_list(self):
+        """测试 ids 不是列表时返回 400"""
+        response = self.client.post('/api/v1/attachments/files/resolve/', {'ids': 'abc'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SignedUrlCacheTest(TestCase):
+    """签名 URL 缓存测试"""
+
+    class CountingEngine:
+        def __init__(self):
+            self.calls = 0
+
+        def get_file_url(self, storage_path):
+            self.calls += 1
+            return f'https://bucket.example.com/{storage_path}?sig={self.calls}'
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_same_url_within_bucket(self):
+        """测试同一时间桶内只签名一次并返回相同 URL"""
+        from .signed_urls import get_cached_file_url
+
+        engine = self.CountingEngine()
+        first_url, ttl = get_cached_file_url(engine, '1', 'a/b.png')
+        second_url, _ = get_cached_file_url(engine, '1', 'a/b.png')
+        self.assertEqual(first_url, second_url)
+        self.assertEqual(engine.calls, 1)
+        self.assertTrue(0 < ttl <= 1800)
+
+        # 不同存储配置下的同名路径分别签名
+        other_url, _ = get_cached_file_url(engine, '2', 'a/b.png')
+        self.assertNotEqual(first_url, other_url)
+
+
+class DiskCacheTest(TestCase):
+    """S3 附件本地磁盘缓存测试"""
+
+    def _source(self, root):
+        import threading
+        import time
+        from chewy_attachment.core.storage import FileStorageEngine
+
+        class CountingEngine(FileStorageEngine):
+            """记录回源次数的存储，读取时稍作停顿以制造并发未命中"""
+            reads = 0
+            guard = threading.Lock()
+
+            def get_file_path(self, storage_path):
+                with self.guard:
+                    CountingEngine.reads += 1
+                time.sleep(0.05)
+                return super().get_file_path(storage_path)
+
+        engine = CountingEngine(root)
+        for name in ('a', 'b', 'c'):
+            engine.save_file(name.encode() * 400, f'{name}.txt', storage_path=f'2020/01/01/{name}.txt')
+        return engine
+
+    def test_fill_coalesce_and_evict(self):
+        """测试并发未命中只回源一次，命中后不再回源，超过容量时淘汰最久未访问的文件"""
+        import os
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        from .disk_cache import LOCK_STRIPES, AttachmentDiskCache
+
+        with tempfile.TemporaryDirectory() as source_root, tempfile.TemporaryDirectory() as cache_root:
+            engine = self._source(source_root)
+            disk_cache = AttachmentDiskCache(cache_root, max_bytes=1000, max_object_bytes=500)
+
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                paths = list(pool.map(lambda _: disk_cache.fetch('1', engine, '2020/01/01/a.txt', 400), range(4)))
+            self.assertEqual(len(set(paths)), 1)
+            self.assertEqual(engine.reads, 1)
+            with open(paths[0], 'rb') as f:
+                self.assertEqual(f.read(), b'a' * 400)
+
+            # 过大的对象不缓存，大小不一致的对象不写入
+            self.assertIsNone(disk_cache.fetch('1', engine, '2020/01/01/b.txt', 600))
+            self.assertIsNone(disk_cache.fetch('1', engine, '2020/01/01/b.txt', 300))
+
+            b_path = disk_cache.fetch('1', engine, '2020/01/01/b.txt', 400)
+            os.utime(paths[0], (1, 1))
+            disk_cache.fetch('1', engine, '2020/01/01/c.txt', 400)
+            self.assertFalse(os.path.exists(paths[0]))
+            self.assertTrue(os.path.exists(b_path))
+            self.assertEqual(disk_cache.fetch('1', engine, '2020/01/01/b.txt', 400), b_path)
+            self.assertEqual(
+                [name for _, _, names in os.walk(cache_root) for name in names if '.tmp-' in name], [],
+            )
+            # 合并未命中的线程锁数量固定，不随缓存文件增长
+            self.assertEqual(len(disk_cache._locks), LOCK_STRIPES)
+
+
+class WaveformPeaksTest(TestCase):
+    """音频波形峰值计算测试"""
+
+    def test_compute_waveform_peaks(self):
+        import array
+        from .media_processing import compute_waveform_peaks
+
+        samples = array.array('h', [0, 100, -32767, 50, 16384, -10, 0, 0])
+        self.assertEqual(compute_waveform_peaks(samples, 4), bytes([0, 255, 127, 0]))
+        # 采样数少于点数时按实际采样数输出
+        self.assertEqual(len(compute_waveform_peaks(samples, 100)), len(samples))
+        self.assertEqual(compute_waveform_peaks(array.array('h'), 100), b'')
+
+
+class AudioMetadataTest(TemporaryMediaMixin, AuthenticatedClientMixin, APITransactionTestCase):
+    """音频上传后的后台处理测试（ffmpeg 用输出固定 PCM 的脚本代替）"""
+
+    def setUp(self):
+        import os
+        import shutil
+        import sys
+        import tempfile
+
+        super().setUp()
+
+        # 1 秒 8kHz 采样：前半段振幅 16384，后半段静音
+        bin_dir = tempfile.mkdtemp(prefix='bbtalk-test-ffmpeg-')
+        ffmpeg = os.path.join(bin_dir, 'ffmpeg')
+        with open(ffmpeg, 'w') as f:
+            f.write(
+                f'#!{sys.executable}\n'
+                'import array, sys\n'
+                "samples = array.array('h', [16384, -16384] * 2000 + [0] * 4000)\n"
+                "if sys.byteorder == 'big':\n"
+                '    samples.byteswap()\n'
+                'sys.stdout.buffer.write(samples.tobytes())\n'
+            )
+        os.chmod(ffmpeg, 0o755)
+        original_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = bin_dir + os.pathsep + original_path
+        self.addCleanup(os.environ.__setitem__, 'PATH', original_path)
+        self.addCleanup(shutil.rmtree, bin_dir, ignore_errors=True)
+
+    def test_upload_extracts_duration_and_peaks(self):
+        """测试上传音频后后台提取时长和波形峰值写入 media_info"""
+        import base64
+        import time
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from .models import Attachment
+
+        response = self.client.post('/api/v1/attachments/files/', {
+            'file': SimpleUploadedFile('voice.mp3', b'ID3 not really audio', content_type='audio/mpeg'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            media_info = Attachment.objects.get(id=response.data['id']).media_info or {}
+            if 'audio' in media_info:
+                break
+            time.sleep(0.05)
+        self.assertEqual(media_info['audio']['duration'], 1.0)
+        peaks = base64.b64decode(media_info['audio']['peaks'])
+        self.assertEqual(len(peaks), 100)
+        self.assertEqual(set(peaks[:50]), {127})
+        self.assertEqual(set(peaks[50:]), {0})
@@ -10,6 +10,8 @@ from .views import (
     deactivate_all_storage, test_storage_connection, test_storage_connection_by_id,
     export_data, import_data, validate_import,
     storage_migration_preview, storage_migration_execute,
+    storage_migration_job_detail, storage_migration_job_cancel, storage_migration_job_resume,
+    storage_pool_stats,
     delete_account,
 )
 
@@ -47,6 +49,10 @@ urlpatterns = [
     # 存储迁移接口
     path('storage/migration/preview/', storage_migration_preview, name='storage_migration_preview'),
     path('storage/migration/execute/', storage_migration_execute, name='storage_migration_execute'),
+    path('storage/migration/jobs/<int:pk>/', storage_migration_job_detail, name='storage_migration_job_detail'),
+    path('storage/migration/jobs/<int:pk>/cancel/', storage_migration_job_cancel, name='storage_migration_job_cancel'),
+    path('storage/migration/jobs/<int:pk>/resume/', storage_migration_job_resume, name='storage_migration_job_resume'),
+    path('storage/pool-stats/', storage_pool_stats, name='storage_pool_stats'),
     # BBTalk 和 Tag 路由
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -5,14 +5,21 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from django_filters.rest_framework import DjangoFilterBackend
 import django_filters
 from django.http import HttpResponse
-from .models import BBTalk, Tag, generate_tag_color, User, UserStorageSettings, Comment
-from .serializers import BBTalkSerializer, TagSerializer, UserSerializer, UserStorageSettingsSerializer, CommentSerializer
+from .models import Attachment, BBTalk, Tag, generate_tag_color, User, UserStorageSettings, Comment, StorageMigrationJob
+from .serializers import BBTalkSerializer, TagSerializer, UserSerializer, CurrentUserSerializer, UserStorageSettingsSerializer, CommentSerializer, StorageMigrationJobSerializer
 from .authentication import authenticate_with_password, create_user_with_password
 from .data_export import DataExporter
 from .data_import import DataImporter, validate_import_file, ImportError
 from .storage_migration import StorageMigrationService
+from .migration_jobs import start_migration_job, cancel_migration_job, resume_migration_job
+from .public_attachments import public_attachment_urls
+from .attachment_deletion import AttachmentDeletionService, delete_bbtalks
+from .s3_clients import pool_stats
+from .storage_usage import get_usage_map
+from .storage_benchmark import StorageBenchmark
 from drf_spectacular.utils import extend_schema
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from django.db.models import Count
 from django.db.models.functions import TruncDate
 from django.contrib.auth import login as django_login, logout as django_logout
@@ -230,19 +237,19 @@ def register_view(request):
 @extend_schema(
     tags=['User'],
     responses={
-        200: UserSerializer
+        200: CurrentUserSerializer
     }
 )
 @api_view(['GET', 'PATCH'])
 @permission_classes_decorator([permissions.IsAuthenticated])
 def get_current_user(request):
-    """获取/更新当前登录用户信息"""
+    """获取/更新当前登录用户信息（含存储用量）"""
     if request.method == 'PATCH':
-        serializer = UserSerializer(request.user, data=request.data, partial=True)
+        serializer = CurrentUserSerializer(request.user, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
         serializer.save()
         return Response(serializer.data)
-    serializer = UserSerializer(request.user)
+    serializer = CurrentUserSerializer(request.user)
     return Response(serializer.data)
 
 
@@ -277,13 +284,22 @@ def delete_account(request):
         return Response({'error': '密码错误，请重新输入'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        # 删除用户（关联数据通过 CASCADE 自动删除）
-        user.delete()
+        with transaction.atomic():
+            # 附件按 owner_id 关联，不会随用户级联删除；存储对象在提交后批量删除
+            AttachmentDeletionService(user).delete_attachments(
+                Attachment.objects.filter(owner_id=str(user.id))
+            )
+            # 删除用户（关联数据通过 CASCADE 自动删除）
+            user.delete()
         return Response({'message': '账号已成功删除'})
     except Exception as e:
         return Response({'error': f'删除失败: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+# 批量删除 BBTalk 一次最多的条数
+BATCH_DELETE_MAX = 500
+
+
 class BBTalkFilter(django_filters.FilterSet):
     create_time__date = django_filters.DateFilter(field_name='create_time', lookup_expr='date')
     create_time__gte = django_filters.DateTimeFilter(field_name='create_time', lookup_expr='gte')
@@ -327,6 +343,19 @@ class BBTalkViewSet(viewsets.ModelViewSet):
         bbtalk.save(update_fields=['is_pinned'])
         return Response(BBTalkSerializer(bbtalk).data)
 
+    @action(detail=False, methods=['post'], url_path='batch-delete')
+    def batch_delete(self, request):
+        """批量删除 BBTalk，同时删除只被这些 BBTalk 引用的附件"""
+        uids = request.data.get('uids')
+        if not isinstance(uids, list) or not uids:
+            return Response({'error': '请提供要删除的 uids 列表'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(uids) > BATCH_DELETE_MAX:
+            return Response({'error': f'一次最多删除 {BATCH_DELETE_MAX} 条'}, status=status.HTTP_400_BAD_REQUEST)
+        deleted, deleted_attachments = delete_bbtalks(
+            request.user, BBTalk.objects.filter(user=request.user, uid__in=[str(uid) for uid in uids])
+        )
+        return Response({'deleted': deleted, 'deleted_attachments': deleted_attachments})
+
     @action(detail=False, methods=['get'], url_path='date-counts')
     def date_counts(self, request):
         """按日期聚合 BBTalk 数量，用于日历展示"""
@@ -427,13 +456,12 @@ class TagViewSet(viewsets.ModelViewSet):
     def destroy(self, request, *args, **kwargs):
         """删除标签，可选同时删除关联的 BBTalk"""
         instance = self.get_object()
-        delete_bbtalks = request.query_params.get('delete_bbtalks', 'false').lower() == 'true'
-        if delete_bbtalks:
-            # 删除只属于这个标签的 BBTalk（没有其他标签的）
+        with_bbtalks = request.query_params.get('delete_bbtalks', 'false').lower() == 'true'
+        if with_bbtalks:
+            # 删除只属于这个标签的 BBTalk（没有其他标签的），以及只被它们引用的附件
             from django.db.models import Count as DjCount
             bbtalks = instance.bbtalks.annotate(tag_count=DjCount('tags')).filter(tag_count=1)
-            deleted_count = bbtalks.count()
-            bbtalks.delete()
+            deleted_count, _ = delete_bbtalks(request.user, bbtalks)
         else:
             deleted_count = 0
         instance.delete()
@@ -468,6 +496,15 @@ class PublicBBTalkViewSet(viewsets.ReadOnlyModelViewSet):
             visibility='public'
         ).prefetch_related('tags').order_by('-update_time')
 
+    def get_serializer(self, *args, **kwargs):
+        # 附件地址替换为公开附件的无签名地址，公开页面的附件请求不再经过后端
+        if args:
+            bbtalks = args[0] if kwargs.get('many') else [args[0]]
+            context = self.get_serializer_context()
+            context['public_attachment_urls'] = public_attachment_urls(bbtalks)
+            kwargs['context'] = context
+        return super().get_serializer(*args, **kwargs)
+
 
 @extend_schema(
     tags=['Settings'],
@@ -478,7 +515,7 @@ class PublicBBTalkViewSet(viewsets.ReadOnlyModelViewSet):
 def list_storage_settings(request):
     """获取当前用户的所有存储配置"""
     settings = UserStorageSettings.objects.filter(user=request.user).order_by('-is_active', '-update_time')
-    serializer = UserStorageSettingsSerializer(settings, many=True)
+    serializer = UserStorageSettingsSerializer(settings, many=True, context={'usage_map': get_usage_map(request.user)})
     return Response(serializer.data)
 
 
@@ -606,27 +643,20 @@ def _test_s3_config(storage_settings):
             'message': 'S3 配置不完整，请先完成配置'
         }, status=status.HTTP_400_BAD_REQUEST)
     
+    from .s3_clients import get_s3_client
+    from .storage_health import record_failure, record_success
+
     try:
-        import boto3
         from botocore.exceptions import ClientError, NoCredentialsError
         
         config = storage_settings.get_s3_config()
         
-        session_kwargs = {
-            'aws_access_key_id': config['access_key_id'],
-            'aws_secret_access_key': config['secret_access_key'],
-            'region_name': config['region_name'],
-        }
-        
-        client_kwargs = {}
-        if config.get('endpoint_url'):
-            client_kwargs['endpoint_url'] = config['endpoint_url']
-        
-        session = boto3.Session(**session_kwargs)
-        s3_client = session.client('s3', **client_kwargs)
+        # 使用配置的超时，但不经过熔断检查：熔断中也可以手动测试，成功后立即恢复
+        s3_client = get_s3_client(config)
         
         # 尝试列出存储桶内容（只获取1个对象来测试连接）
         s3_client.list_objects_v2(Bucket=config['bucket_name'], MaxKeys=1)
+        record_success(storage_settings.id)
         
         return Response({
             'success': True,
@@ -646,6 +676,7 @@ def _test_s3_config(storage_settings):
             'message': f'S3 错误 ({error_code}): {error_message}'
         }, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
+        record_failure(storage_settings.id, str(e))
         return Response({
             'success': False,
             'message': f'连接失败: {str(e)}'
@@ -686,6 +717,14 @@ def test_storage_connection(request):
 
 @extend_schema(
     tags=['Settings'],
+    request={
+        'application/json': {
+            'type': 'object',
+            'properties': {
+                'benchmark': {'type': 'boolean', 'description': '连接成功后执行性能测试（PUT/GET 延迟与吞吐量）'},
+            }
+        }
+    },
     responses={
         200: {
             'description': '连接测试结果',
@@ -696,6 +735,7 @@ def test_storage_connection(request):
                         'properties': {
                             'success': {'type': 'boolean'},
                             'message': {'type': 'string'},
+                            'benchmark': {'type': 'object', 'description': '性能测试结果（仅 benchmark=true 时返回）'},
                         }
                     }
                 }
@@ -706,7 +746,7 @@ def test_storage_connection(request):
 @api_view(['POST'])
 @permission_classes_decorator([permissions.IsAuthenticated])
 def test_storage_connection_by_id(request, pk):
-    """测试指定 S3 配置的连接"""
+    """测试指定 S3 配置的连接，可选执行性能测试"""
     try:
         settings = UserStorageSettings.objects.get(pk=pk, user=request.user)
     except UserStorageSettings.DoesNotExist:
@@ -714,7 +754,27 @@ def test_storage_connection_by_id(request, pk):
             'success': False,
             'message': '配置不存在'
         }, status=status.HTTP_404_NOT_FOUND)
-    return _test_s3_config(settings)
+    response = _test_s3_config(settings)
+    if not response.data.get('success') or str(request.data.get('benchmark', '')).lower() not in ('true', '1'):
+        return response
+
+    try:
+        result = StorageBenchmark(settings).run()
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': f'性能测试失败: {str(e)}'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    large = result['large']
+    return Response({
+        'success': True,
+        'message': (
+            f"连接成功！小文件上传延迟 {result['small']['put_ms']['p50']}ms，"
+            f"大文件上传 {large['put_bytes_per_second'] / 1024 / 1024:.1f} MB/s，"
+            f"下载 {large['get_bytes_per_second'] / 1024 / 1024:.1f} MB/s"
+        ),
+        'benchmark': result,
+    })
 
 
 @extend_schema(
@@ -957,6 +1017,25 @@ def validate_import(request):
                             'total': {'type': 'integer'},
                             'need_migrate': {'type': 'integer'},
                             'already_on_target': {'type': 'integer'},
+                            'need_migrate_bytes': {'type': 'integer'},
+                            'sources': {
+                                'type': 'array',
+                                'items': {
+                                    'type': 'object',
+                                    'properties': {
+                                        'storage_config_id': {'type': 'string', 'nullable': True},
+                                        'name': {'type': 'string'},
+                                        'count': {'type': 'integer'},
+                                        'bytes': {'type': 'integer'},
+                                        'estimated_seconds': {'type': 'integer', 'nullable': True},
+                                    }
+                                }
+                            },
+                            'estimated_seconds': {
+                                'type': 'integer',
+                                'nullable': True,
+                                'description': '根据以往迁移实测速率估算的耗时，没有测量数据时为 null'
+                            },
                         }
                     }
                 }
@@ -993,24 +1072,14 @@ def storage_migration_preview(request):
         }
     },
     responses={
-        200: {
-            'description': '迁移结果',
+        202: {
+            'description': '已创建后台迁移任务（已有未结束的任务时返回该任务）',
             'content': {
                 'application/json': {
                     'schema': {
                         'type': 'object',
                         'properties': {
-                            'success': {'type': 'boolean'},
-                            'stats': {
-                                'type': 'object',
-                                'properties': {
-                                    'total': {'type': 'integer'},
-                                    'migrated': {'type': 'integer'},
-                                    'skipped': {'type': 'integer'},
-                                    'failed': {'type': 'integer'},
-                                    'errors': {'type': 'array', 'items': {'type': 'string'}}
-                                }
-                            }
+                            'job_id': {'type': 'integer'},
                         }
                     }
                 }
@@ -1021,19 +1090,62 @@ def storage_migration_preview(request):
 @api_view(['POST'])
 @permission_classes_decorator([permissions.IsAuthenticated])
 def storage_migration_execute(request):
-    """执行存储迁移：将附件从旧存储迁移到新存储"""
+    """执行存储迁移：创建后台迁移任务，通过任务接口查询进度"""
     target_config_id = request.data.get('target_config_id')
-    
+
     try:
-        service = StorageMigrationService(request.user)
-        stats = service.migrate(target_config_id)
-        
-        return Response({
-            'success': stats['failed'] == 0,
-            'stats': stats
-        })
-    except Exception as e:
-        return Response({
-            'success': False,
-            'error': str(e)
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        job = start_migration_job(request.user, target_config_id)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'job_id': job.id}, status=status.HTTP_202_ACCEPTED)
+
+
+@extend_schema(
+    tags=['Storage'],
+    responses={200: StorageMigrationJobSerializer}
+)
+@api_view(['GET'])
+@permission_classes_decorator([permissions.IsAuthenticated])
+def storage_migration_job_detail(request, pk):
+    """查询迁移任务进度：完成数/总数、字节数、速率和预计剩余时间"""
+    job = get_object_or_404(StorageMigrationJob, pk=pk, user=request.user)
+    return Response(StorageMigrationJobSerializer(job).data)
+
+
+@extend_schema(
+    tags=['Storage'],
+    request=None,
+    responses={200: StorageMigrationJobSerializer}
+)
+@api_view(['POST'])
+@permission_classes_decorator([permissions.IsAuthenticated])
+def storage_migration_job_cancel(request, pk):
+    """取消迁移任务：进行中的附件完成后停止，已迁移的附件保留在目标存储"""
+    job = get_object_or_404(StorageMigrationJob, pk=pk, user=request.user)
+    job = cancel_migration_job(job)
+    return Response(StorageMigrationJobSerializer(job).data)
+
+
+@extend_schema(
+    tags=['Storage'],
+    request=None,
+    responses={200: StorageMigrationJobSerializer}
+)
+@api_view(['POST'])
+@permission_classes_decorator([permissions.IsAuthenticated])
+def storage_migration_job_resume(request, pk):
+    """恢复中断、失败或已取消的迁移任务，已迁移的附件不会重复复制"""
+    job = get_object_or_404(StorageMigrationJob, pk=pk, user=request.user)
+    job = resume_migration_job(job)
+    return Response(StorageMigrationJobSerializer(job).data)
+
+
+@extend_schema(
+    tags=['Storage'],
+    responses={200: dict}
+)
+@api_view(['GET'])
+@permission_classes_decorator([permissions.IsAdminUser])
+def storage_pool_stats(request):
+    """共享 S3 客户端的请求数和连接池状态（管理员）"""
+    return Response(pool_stats())
@@ -128,6 +128,12 @@ def _parse_database_url(url: str) -> dict:
         return {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / db_path if not db_path.startswith('/') else db_path,
+            # 后台线程（媒体处理、存储迁移）会并发写库：事务开始即获取写锁并等待，
+            # 避免 DEFERRED 事务升级写锁时直接报 database is locked
+            'OPTIONS': {
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
         }
     elif url.startswith(('postgresql://', 'postgres://')):
         from urllib.parse import urlparse
@@ -162,6 +168,31 @@ DATABASES = {
 }
 
 
+# Cache
+# CACHE_URL 为空时使用进程内缓存；多 worker 部署需要共享缓存（如签名 URL 缓存），
+# 可设置为 file:///app/data/cache 或 redis://host:6379/0
+
+def _parse_cache_url(url: str) -> dict:
+    """解析 CACHE_URL 环境变量"""
+    if url.startswith('file://'):
+        return {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': url.replace('file://', '', 1),
+        }
+    elif url.startswith(('redis://', 'rediss://')):
+        return {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': url,
+        }
+    return {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+
+CACHES = {
+    'default': _parse_cache_url(os.getenv('CACHE_URL', ''))
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -356,6 +387,96 @@ CHEWY_ATTACHMENT = {
         ".mp3", ".mp4", ".mov", ".avi",
         ".m4a", ".aac", ".wav", ".ogg", ".webm", ".3gp", ".caf", ".flac",
     ],
+
+    # 本地附件交给 nginx 输出：设置为 nginx 中 internal location 的前缀（如 /_protected/attachments/），
+    # Django 只做权限校验并返回 X-Accel-Redirect 头；留空则由 gunicorn sendfile 输出
+    "X_ACCEL_REDIRECT_PREFIX": os.getenv('ATTACHMENT_X_ACCEL_REDIRECT_PREFIX', ''),
+
+    # 多段 Range 请求合并后最多允许的段数，超过则忽略 Range 返回完整文件
+    "MAX_RANGE_PARTS": 16,
+
+    # 附件内容上传后不再变化：预览/下载响应允许浏览器缓存的秒数（Cache-Control: private, immutable）
+    "BROWSER_CACHE_MAX_AGE": 365 * 24 * 3600,
+
+    # S3 签名 URL 缓存的时间分桶（秒）：同一桶内的请求返回完全相同的 URL，便于浏览器/CDN 缓存；
+    # 不超过签名有效期的一半，保证返回的 URL 至少还有一半有效期
+    "SIGNED_URL_CACHE_BUCKET": 1800,
+
+    # 批量解析附件地址接口（files/resolve/）一次最多接受的 ID 数
+    "RESOLVE_MAX_IDS": 200,
+
+    # S3 直传：预签名地址有效期（秒）、超过多大改用分片上传、分片大小
+    # 分片阈值默认 64MB，大于默认的 MAX_FILE_SIZE（10MB），只有调大 MAX_FILE_SIZE 后才会用到分片上传
+    "DIRECT_UPLOAD_EXPIRE": int(os.getenv('ATTACHMENT_DIRECT_UPLOAD_EXPIRE', '3600')),
+    "DIRECT_UPLOAD_MULTIPART_THRESHOLD": int(os.getenv('ATTACHMENT_DIRECT_UPLOAD_MULTIPART_THRESHOLD', str(64 * 1024 * 1024))),
+    "DIRECT_UPLOAD_PART_SIZE": int(os.getenv('ATTACHMENT_DIRECT_UPLOAD_PART_SIZE', str(8 * 1024 * 1024))),
+
+    # 批量上传（files/batch/）：并发写入存储的线程数、一次最多接受的文件数
+    "UPLOAD_WORKERS": int(os.getenv('ATTACHMENT_UPLOAD_WORKERS', '4')),
+    "BATCH_UPLOAD_MAX_FILES": 20,
+
+    # 批量删除附件（注销账号、批量删除 BBTalk）：后台并行删除本地文件的线程数、删除失败的最多尝试次数
+    "DELETION_WORKERS": 4,
+    "DELETION_MAX_ATTEMPTS": 3,
+
+    # 后台媒体处理线程数（缩略图等），每个 gunicorn worker 各自一个线程池
+    "MEDIA_WORKERS": int(os.getenv('ATTACHMENT_MEDIA_WORKERS', '2')),
+
+    # 图片缩略图：生成的宽度档位、格式（webp/jpeg）和压缩质量，通过 preview?size= 访问
+    "IMAGE_DERIVATIVE_WIDTHS": [320, 640, 1280],
+    "IMAGE_DERIVATIVE_FORMAT": os.getenv('ATTACHMENT_IMAGE_DERIVATIVE_FORMAT', 'webp'),
+    "IMAGE_DERIVATIVE_QUALITY": 80,
+
+    # 上传压缩：图片最长边上限（像素，0 表示不开启）、重新编码质量和处理线程数；只处理普通上传的 JPEG/PNG/WebP，
+    # 去掉 EXIF 等元数据，压缩后不更小时保存原图
+    "IMAGE_UPLOAD_MAX_DIMENSION": int(os.getenv('ATTACHMENT_IMAGE_UPLOAD_MAX_DIMENSION', '0')),
+    "IMAGE_UPLOAD_QUALITY": int(os.getenv('ATTACHMENT_IMAGE_UPLOAD_QUALITY', '85')),
+    "IMAGE_UPLOAD_WORKERS": 2,
+
+    # 音频：波形峰值点数和 ffmpeg 解码超时（秒），需要系统安装 ffmpeg
+    "AUDIO_WAVEFORM_POINTS": 100,
+    "FFMPEG_TIMEOUT": 60,
+
+    # 存储迁移并行复制的线程数；迁移任务心跳超过该秒数未更新视为中断，可被恢复
+    "MIGRATION_WORKERS": int(os.getenv('ATTACHMENT_MIGRATION_WORKERS', '4')),
+    "MIGRATION_JOB_STALE_SECONDS": 60,
+
+    # 存储迁移写入后校验目标对象（ETag 或重新读取计算哈希），不一致时记为失败
+    "MIGRATION_VERIFY": True,
+
+    # 每个用户本地存储的默认配额（字节），0 表示不限制；S3 存储默认不限制，可在后台为单个用户设置配额
+    "LOCAL_QUOTA_BYTES": int(float(os.getenv('ATTACHMENT_LOCAL_QUOTA_MB', '0')) * 1024 * 1024),
+
+    # 公开附件的无签名地址：本地存储的公开副本放在 MEDIA_ROOT/public，由 nginx 以该 URL 前缀输出（如 /media/public/），
+    # 留空则本地存储不生成公开地址；S3 存储在存储配置上设置公开前缀
+    "PUBLIC_LOCAL_URL": os.getenv('ATTACHMENT_PUBLIC_LOCAL_URL', ''),
+
+    # S3 附件改由服务器转发（Range 转给 GetObject 流式输出），不重定向到签名地址；
+    # 关闭时仍可在单个存储配置上开启（端点只能从服务器访问时）
+    "S3_PROXY_DOWNLOADS": os.getenv('ATTACHMENT_S3_PROXY_DOWNLOADS', 'False').lower() in ('true', '1', 'yes'),
+
+    # S3 附件的本地磁盘缓存：总容量上限（字节，0 表示不开启）、单个对象上限，缓存目录默认 MEDIA_ROOT/s3-cache；
+    # 缓存文件交给 nginx 输出时设置 internal location 前缀（指向缓存目录），留空则由 gunicorn sendfile 输出
+    "S3_DISK_CACHE_BYTES": int(float(os.getenv('ATTACHMENT_S3_DISK_CACHE_MB', '0')) * 1024 * 1024),
+    "S3_DISK_CACHE_MAX_OBJECT_BYTES": 32 * 1024 * 1024,
+    "S3_DISK_CACHE_X_ACCEL_PREFIX": os.getenv('ATTACHMENT_S3_DISK_CACHE_X_ACCEL_PREFIX', ''),
+
+    # 用户 S3 存储的默认连接/读取超时（秒）和最大尝试次数（含首次），可在存储配置上单独设置
+    "S3_CONNECT_TIMEOUT": float(os.getenv('ATTACHMENT_S3_CONNECT_TIMEOUT', '3')),
+    "S3_READ_TIMEOUT": float(os.getenv('ATTACHMENT_S3_READ_TIMEOUT', '10')),
+    "S3_MAX_ATTEMPTS": 2,
+
+    # 共享 S3 客户端：每个客户端的连接池大小（不小于迁移线程数加并发预览数）、进程内缓存的客户端数
+    "S3_MAX_POOL_CONNECTIONS": int(os.getenv('ATTACHMENT_S3_MAX_POOL_CONNECTIONS', '20')),
+    "S3_CLIENT_CACHE_SIZE": 32,
+
+    # 熔断：同一存储连续失败该次数后暂停访问，冷却秒数过后由后台探测恢复（状态保存在 CACHES 中）
+    "S3_BREAKER_FAILURES": 5,
+    "S3_BREAKER_COOLDOWN": 30,
+
+    # 附件回收：只回收创建/修改超过该小时数的附件和存储对象；定时回收间隔（小时），0 表示不定时运行
+    "GC_GRACE_HOURS": 24,
+    "GC_INTERVAL_HOURS": float(os.getenv('ATTACHMENT_GC_INTERVAL_HOURS', '0')),
 }
 
 # 使用自定义的 Attachment 模型
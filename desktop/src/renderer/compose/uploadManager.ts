@@ -29,8 +29,57 @@ export function removeFileFromList(files: UploadedFile[], uid: string): Uploaded
   return files.filter((f) => f.uid !== uid);
 }
 
+/**
+ * Compute the hex SHA-256 of a file's content.
+ */
+export async function sha256Hex(file: Blob): Promise<string> {
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest))
+    .map((b) => b.toString(16).padStart(2, '0'))
+    .join('');
+}
+
+/**
+ * Ask the server whether it already has this content for the current user.
+ * Returns the created attachment on a hit, or null when the file must be uploaded
+ * (including any preflight error — the regular upload is always the fallback).
+ */
+export async function preflightUpload(
+  file: File,
+  apiUrl: string,
+  token: string | null,
+): Promise<any | null> {
+  if (!file.size || typeof crypto === 'undefined' || !crypto.subtle) {
+    return null;
+  }
+  try {
+    const headers: Record<string, string> = { 'Content-Type': 'application/json' };
+    if (token) {
+      headers['Authorization'] = `Bearer ${token}`;
+    }
+    const response = await fetch(`${apiUrl}/api/v1/attachments/files/preflight/`, {
+      method: 'POST',
+      headers,
+      body: JSON.stringify({
+        content_hash: await sha256Hex(file),
+        size: file.size,
+        original_name: file.name || 'upload',
+        is_public: true,
+      }),
+    });
+    if (!response.ok) {
+      return null;
+    }
+    const data = await response.json();
+    return data.exists ? data.attachment : null;
+  } catch {
+    return null;
+  }
+}
+
 /**
  * Upload a single file to the Attachment API.
+ * Skips the transfer when the hash preflight finds the same content on the server.
  * Returns the uploaded file metadata.
  */
 export async function uploadFile(
@@ -38,6 +87,22 @@ export async function uploadFile(
   apiUrl: string,
   token: string | null,
   mediaType?: 'image' | 'auto',
+): Promise<UploadedFile> {
+  const existing = await preflightUpload(file, apiUrl, token);
+  if (existing) {
+    return toUploadedFile(existing, file);
+  }
+  return transferFile(file, apiUrl, token, mediaType);
+}
+
+/**
+ * Send a single file to files/ without the hash preflight.
+ */
+async function transferFile(
+  file: File,
+  apiUrl: string,
+  token: string | null,
+  mediaType?: 'image' | 'auto',
 ): Promise<UploadedFile> {
   const formData = new FormData();
   formData.append('file', file, file.name || 'upload');
@@ -70,8 +135,10 @@ export async function uploadFile(
     throw new Error(message);
   }
 
-  const data = await response.json();
+  return toUploadedFile(await response.json(), file);
+}
 
+function toUploadedFile(data: any, file: File): UploadedFile {
   // Determine file type from response
   let fileType: UploadedFile['type'] = 'file';
   const mime = data.mime_type || '';
@@ -93,8 +160,13 @@ export async function uploadFile(
   };
 }
 
+/** Maximum files per files/batch/ request (backend BATCH_UPLOAD_MAX_FILES). */
+export const BATCH_UPLOAD_MAX_FILES = 20;
+
 /**
  * Upload multiple files. Returns all successfully uploaded files.
+ * Files the server already has are registered through the hash preflight; the rest
+ * go up in batch requests of at most BATCH_UPLOAD_MAX_FILES files.
  * Throws on first failure (caller should handle).
  */
 export async function uploadFiles(
@@ -103,8 +175,49 @@ export async function uploadFiles(
   token: string | null,
   mediaType?: 'image' | 'auto',
 ): Promise<UploadedFile[]> {
-  const results = await Promise.all(
-    files.map((file) => uploadFile(file, apiUrl, token, mediaType)),
-  );
-  return results;
+  const existing = await Promise.all(files.map((file) => preflightUpload(file, apiUrl, token)));
+  const pending = files.filter((_, i) => !existing[i]);
+  const uploaded: UploadedFile[] = [];
+  if (pending.length === 1) {
+    uploaded.push(await transferFile(pending[0], apiUrl, token, mediaType));
+  } else {
+    for (let start = 0; start < pending.length; start += BATCH_UPLOAD_MAX_FILES) {
+      uploaded.push(...(await uploadBatch(pending.slice(start, start + BATCH_UPLOAD_MAX_FILES), apiUrl, token)));
+    }
+  }
+
+  let next = 0;
+  return files.map((file, i) => (existing[i] ? toUploadedFile(existing[i], file) : uploaded[next++]));
+}
+
+/**
+ * Upload several files in one multipart request (files/batch/).
+ */
+async function uploadBatch(files: File[], apiUrl: string, token: string | null): Promise<UploadedFile[]> {
+  const formData = new FormData();
+  for (const file of files) {
+    formData.append('files', file, file.name || 'upload');
+  }
+  formData.append('is_public', 'true');
+
+  const headers: Record<string, string> = {};
+  if (token) {
+    headers['Authorization'] = `Bearer ${token}`;
+  }
+
+  const response = await fetch(`${apiUrl}/api/v1/attachments/files/batch/`, {
+    method: 'POST',
+    headers,
+    body: formData,
+  });
+  const data = await response.json().catch(() => ({}));
+  if (!response.ok || !Array.isArray(data.results)) {
+    throw new Error(data.detail || '上传失败');
+  }
+
+  const failed = data.results.find((item: any) => item.status !== 201);
+  if (failed) {
+    throw new Error(failed.status === 413 ? '文件太大，请压缩后重试' : `${failed.name}: ${failed.detail}`);
+  }
+  return data.results.map((item: any, i: number) => toUploadedFile(item.attachment, files[i]));
 }
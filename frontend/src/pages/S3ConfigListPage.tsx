@@ -24,11 +24,14 @@ export default function S3ConfigListPage() {
     s3_region_name: 'us-east-1',
     s3_endpoint_url: '',
     s3_custom_domain: '',
+    s3_public_prefix: '',
+    s3_proxy_downloads: false,
     is_active: false,
   });
   
   const [saving, setSaving] = useState(false);
   const [testingId, setTestingId] = useState<number | null>(null);
+  const [benchmarkingId, setBenchmarkingId] = useState<number | null>(null);
 
   useEffect(() => {
     loadConfigs();
@@ -59,6 +62,8 @@ export default function S3ConfigListPage() {
       s3_region_name: 'us-east-1',
       s3_endpoint_url: '',
       s3_custom_domain: '',
+      s3_public_prefix: '',
+      s3_proxy_downloads: false,
       is_active: configList.length === 0,
     });
     setShowEditModal(true);
@@ -76,6 +81,8 @@ export default function S3ConfigListPage() {
       s3_region_name: config.s3_region_name,
       s3_endpoint_url: config.s3_endpoint_url,
       s3_custom_domain: config.s3_custom_domain,
+      s3_public_prefix: config.s3_public_prefix || '',
+      s3_proxy_downloads: config.s3_proxy_downloads || false,
       is_active: config.is_active,
     });
     setShowEditModal(true);
@@ -159,6 +166,26 @@ export default function S3ConfigListPage() {
     }
   };
 
+  const handleBenchmark = async (config: StorageSettings) => {
+    try {
+      setBenchmarkingId(config.id);
+      setError(null);
+      const result = await settingsApi.testStorageConnectionById(config.id, true);
+      if (result.success) {
+        setSuccess(result.message);
+        await loadConfigs();
+      } else {
+        setError(result.message);
+      }
+    } catch (err: any) {
+      setError(err.message || '性能测试失败');
+    } finally {
+      setBenchmarkingId(null);
+    }
+  };
+
+  const formatSpeed = (bytesPerSecond: number) => `${(bytesPerSecond / 1024 / 1024).toFixed(1)} MB/s`;
+
   if (loading) {
     return (
       <div className="min-h-screen flex items-center justify-center bg-gray-50">
@@ -254,6 +281,14 @@ export default function S3ConfigListPage() {
                             未完成
                           </span>
                         )}
+                        {config.health?.state === 'open' && (
+                          <span
+                            className="px-1.5 py-0.5 bg-red-100 text-red-700 text-[10px] sm:text-xs font-medium rounded-full whitespace-nowrap"
+                            title={config.health.last_error}
+                          >
+                            暂不可用
+                          </span>
+                        )}
                       </div>
                       
                       <div className="mt-1 text-xs sm:text-sm text-gray-500">
@@ -262,6 +297,13 @@ export default function S3ConfigListPage() {
                           <span className="ml-1.5 truncate"> · {config.s3_endpoint_url}</span>
                         )}
                       </div>
+                      {config.benchmark && 'large' in config.benchmark && (
+                        <div className="mt-0.5 text-[10px] sm:text-xs text-gray-400">
+                          上传 {formatSpeed(config.benchmark.large.put_bytes_per_second)}
+                          {' · '}下载 {formatSpeed(config.benchmark.large.get_bytes_per_second)}
+                          {' · '}延迟 {config.benchmark.small.put_ms.p50}ms
+                        </div>
+                      )}
                     </div>
                   </div>
 
@@ -297,6 +339,15 @@ export default function S3ConfigListPage() {
                         {testingId === config.id ? '测试中...' : '测试'}
                       </button>
                     )}
+                    {config.is_s3_configured && (
+                      <button
+                        onClick={() => handleBenchmark(config)}
+                        disabled={benchmarkingId === config.id}
+                        className="flex-1 flex items-center justify-center gap-1.5 px-3 py-2 bg-indigo-50 text-indigo-600 rounded-lg hover:bg-indigo-100 active:bg-indigo-200 transition-colors text-xs sm:text-sm font-medium disabled:opacity-50"
+                      >
+                        {benchmarkingId === config.id ? '测速中...' : '测速'}
+                      </button>
+                    )}
                     <button
                       onClick={() => handleEdit(config)}
                       className="flex-1 flex items-center justify-center gap-1.5 px-3 py-2 bg-blue-50 text-blue-600 rounded-lg hover:bg-blue-100 active:bg-blue-200 transition-colors text-xs sm:text-sm font-medium"
@@ -441,6 +492,28 @@ export default function S3ConfigListPage() {
                     className="w-full px-3 py-2.5 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent text-sm"
                   />
                 </div>
+                <div>
+                  <label className="block text-sm font-medium text-gray-700 mb-1.5">公开前缀</label>
+                  <input
+                    type="text"
+                    value={formData.s3_public_prefix || ''}
+                    onChange={(e) => setFormData({ ...formData, s3_public_prefix: e.target.value })}
+                    placeholder="public（可选，需在存储桶策略中允许匿名读取）"
+                    className="w-full px-3 py-2.5 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500 focus:border-transparent text-sm"
+                  />
+                </div>
+                <div className="flex items-center gap-2">
+                  <input
+                    type="checkbox"
+                    id="s3_proxy_downloads"
+                    checked={formData.s3_proxy_downloads || false}
+                    onChange={(e) => setFormData({ ...formData, s3_proxy_downloads: e.target.checked })}
+                    className="w-4 h-4 text-blue-600 border-gray-300 rounded focus:ring-blue-500"
+                  />
+                  <label htmlFor="s3_proxy_downloads" className="text-sm font-medium text-gray-700">
+                    经服务器转发文件（端点只能从服务器访问时开启）
+                  </label>
+                </div>
                 <div className="flex items-center gap-2">
                   <input
                     type="checkbox"
@@ -1,7 +1,7 @@
 import { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { settingsApi } from '../services/api/settingsApi';
-import type { StorageSettings } from '../types';
+import type { StorageSettings, StorageMigrationJob, StorageMigrationPreview, StorageUsage } from '../types';
 import Toast from '../components/ui/Toast';
 import Modal from '../components/ui/Modal';
 
@@ -21,22 +21,35 @@ export default function StorageSettingsPage() {
   const [showMigrationModal, setShowMigrationModal] = useState(false);
   const [migrationTarget, setMigrationTarget] = useState<number | null>(null);
   const [migrationTargetName, setMigrationTargetName] = useState('服务器存储');
-  const [migrationPreview, setMigrationPreview] = useState<{
-    total: number;
-    need_migrate: number;
-    already_on_target: number;
-  } | null>(null);
+  const [migrationPreview, setMigrationPreview] = useState<StorageMigrationPreview | null>(null);
   const [migrationLoading, setMigrationLoading] = useState(false);
   const [migrating, setMigrating] = useState(false);
-  const [migrationResult, setMigrationResult] = useState<{
-    success: boolean;
-    stats: { total: number; migrated: number; skipped: number; failed: number; errors: string[] };
-  } | null>(null);
+  const [migrationJob, setMigrationJob] = useState<StorageMigrationJob | null>(null);
+
+  const isJobActive = migrationJob !== null && (migrationJob.status === 'pending' || migrationJob.status === 'running');
+  const isJobFinished = migrationJob !== null && !isJobActive;
 
   useEffect(() => {
     loadStatus();
   }, []);
 
+  // 迁移在后台进行，轮询任务进度直到结束
+  useEffect(() => {
+    if (!migrationJob || !isJobActive || !showMigrationModal) return;
+    const timer = setTimeout(async () => {
+      try {
+        const job = await settingsApi.migrationJob(migrationJob.id);
+        setMigrationJob(job);
+        if (job.status === 'completed' && job.failed === 0) {
+          setSuccess(`迁移完成！成功迁移 ${job.migrated} 个文件`);
+        }
+      } catch (err: any) {
+        setError(err.message || '获取迁移进度失败');
+      }
+    }, 1500);
+    return () => clearTimeout(timer);
+  }, [migrationJob, isJobActive, showMigrationModal]);
+
   const loadStatus = async () => {
     try {
       setLoading(true);
@@ -59,7 +72,7 @@ export default function StorageSettingsPage() {
   const handleOpenMigration = async (targetId: number | null, targetName: string) => {
     setMigrationTarget(targetId);
     setMigrationTargetName(targetName);
-    setMigrationResult(null);
+    setMigrationJob(null);
     setMigrationPreview(null);
     setShowMigrationModal(true);
 
@@ -75,15 +88,12 @@ export default function StorageSettingsPage() {
     }
   };
 
-  // 执行迁移
+  // 执行迁移：创建后台任务后轮询进度
   const handleExecuteMigration = async () => {
     try {
       setMigrating(true);
-      const result = await settingsApi.migrationExecute(migrationTarget);
-      setMigrationResult(result);
-      if (result.success) {
-        setSuccess(`迁移完成！成功迁移 ${result.stats.migrated} 个文件`);
-      }
+      const { job_id } = await settingsApi.migrationExecute(migrationTarget);
+      setMigrationJob(await settingsApi.migrationJob(job_id));
     } catch (err: any) {
       setError(err.message || '迁移失败');
     } finally {
@@ -91,6 +101,43 @@ export default function StorageSettingsPage() {
     }
   };
 
+  const handleCancelMigration = async () => {
+    if (!migrationJob) return;
+    try {
+      setMigrationJob(await settingsApi.migrationCancel(migrationJob.id));
+    } catch (err: any) {
+      setError(err.message || '取消迁移失败');
+    }
+  };
+
+  const handleResumeMigration = async () => {
+    if (!migrationJob) return;
+    try {
+      setMigrationJob(await settingsApi.migrationResume(migrationJob.id));
+    } catch (err: any) {
+      setError(err.message || '恢复迁移失败');
+    }
+  };
+
+  const formatBytes = (bytes: number) => {
+    if (bytes < 1024) return `${bytes} B`;
+    if (bytes < 1024 * 1024) return `${(bytes / 1024).toFixed(1)} KB`;
+    if (bytes < 1024 * 1024 * 1024) return `${(bytes / 1024 / 1024).toFixed(1)} MB`;
+    return `${(bytes / 1024 / 1024 / 1024).toFixed(2)} GB`;
+  };
+
+  const formatUsage = (usage?: StorageUsage) => {
+    if (!usage) return '';
+    const used = `${usage.file_count} 个文件，${formatBytes(usage.bytes_used)}`;
+    return usage.quota_bytes !== null ? `${used} / ${formatBytes(usage.quota_bytes)}` : used;
+  };
+
+  const formatDuration = (seconds: number) => {
+    if (seconds < 60) return `${seconds} 秒`;
+    if (seconds < 3600) return `${Math.ceil(seconds / 60)} 分钟`;
+    return `${(seconds / 3600).toFixed(1)} 小时`;
+  };
+
   const handleSwitchToServer = async () => {
     if (isServerStorage) return;
     try {
@@ -206,6 +253,9 @@ export default function StorageSettingsPage() {
                   : `AWS S3 / 阿里云 OSS / MinIO 等`}
                 {s3Count > 0 && ` (${s3Count} 个配置)`}
               </p>
+              {activeConfig?.usage && (
+                <p className="text-xs text-gray-400 mt-0.5">已用 {formatUsage(activeConfig.usage)}</p>
+              )}
             </div>
             <svg className="w-5 h-5 text-gray-400 flex-shrink-0" fill="none" stroke="currentColor" viewBox="0 0 24 24">
               <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M9 5l7 7-7 7" />
@@ -255,7 +305,9 @@ export default function StorageSettingsPage() {
                 </div>
                 <div className="flex-1">
                   <span className="text-sm font-medium text-gray-900">迁移到 {config.name}</span>
-                  <p className="text-xs text-gray-500 mt-0.5">将其他存储中的附件迁移到此配置</p>
+                  <p className="text-xs text-gray-500 mt-0.5">
+                    将其他存储中的附件迁移到此配置{config.usage && `（已用 ${formatUsage(config.usage)}）`}
+                  </p>
                 </div>
                 <svg className="w-5 h-5 text-gray-400 flex-shrink-0" fill="none" stroke="currentColor" viewBox="0 0 24 24">
                   <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M9 5l7 7-7 7" />
@@ -297,7 +349,7 @@ export default function StorageSettingsPage() {
               <div className="text-center py-6 text-gray-500">正在分析附件数据...</div>
             )}
 
-            {migrationPreview && !migrationResult && (
+            {migrationPreview && !migrationJob && (
               <>
                 <div className="bg-gray-50 rounded-xl p-4 space-y-2">
                   <div className="flex justify-between text-sm">
@@ -312,6 +364,22 @@ export default function StorageSettingsPage() {
                     <span className="text-gray-500">已在目标存储</span>
                     <span className="font-medium text-green-600">{migrationPreview.already_on_target}</span>
                   </div>
+                  {migrationPreview.need_migrate > 0 && (
+                    <>
+                      <div className="flex justify-between text-sm">
+                        <span className="text-gray-500">迁移数据量</span>
+                        <span className="font-medium text-gray-900">{formatBytes(migrationPreview.need_migrate_bytes)}</span>
+                      </div>
+                      <div className="flex justify-between text-sm">
+                        <span className="text-gray-500">预计耗时</span>
+                        <span className="font-medium text-gray-900">
+                          {migrationPreview.estimated_seconds !== null
+                            ? `约 ${formatDuration(migrationPreview.estimated_seconds)}`
+                            : '暂无测速数据'}
+                        </span>
+                      </div>
+                    </>
+                  )}
                 </div>
 
                 {migrationPreview.need_migrate === 0 ? (
@@ -319,7 +387,7 @@ export default function StorageSettingsPage() {
                 ) : (
                   <>
                     <div className="bg-amber-50 border border-amber-200 rounded-lg p-3 text-sm text-amber-800">
-                      将会把 {migrationPreview.need_migrate} 个附件从旧存储复制到「{migrationTargetName}」，过程中请勿关闭页面。
+                      将会把 {migrationPreview.need_migrate} 个附件从旧存储复制到「{migrationTargetName}」，迁移在后台进行，关闭此窗口不会中断。
                     </div>
                     <button
                       onClick={handleExecuteMigration}
@@ -343,46 +411,106 @@ export default function StorageSettingsPage() {
               </>
             )}
 
-            {migrationResult && (
+            {migrationJob && isJobActive && (
               <div className="space-y-3">
-                <div className={`rounded-xl p-4 ${migrationResult.success ? 'bg-green-50 border border-green-200' : 'bg-red-50 border border-red-200'}`}>
-                  <div className="flex items-center gap-2 mb-2">
-                    {migrationResult.success ? (
-                      <svg className="w-5 h-5 text-green-600" fill="none" stroke="currentColor" viewBox="0 0 24 24">
-                        <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M5 13l4 4L19 7" />
-                      </svg>
-                    ) : (
-                      <svg className="w-5 h-5 text-red-600" fill="none" stroke="currentColor" viewBox="0 0 24 24">
-                        <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M6 18L18 6M6 6l12 12" />
-                      </svg>
-                    )}
-                    <span className={`font-medium ${migrationResult.success ? 'text-green-800' : 'text-red-800'}`}>
-                      {migrationResult.success ? '迁移成功' : '迁移完成（部分失败）'}
+                <div className="bg-gray-50 rounded-xl p-4 space-y-2">
+                  <div className="flex justify-between text-sm">
+                    <span className="text-gray-500">
+                      {migrationJob.stale ? '任务已中断' : migrationJob.status === 'pending' ? '等待开始...' : '迁移中...'}
                     </span>
+                    <span className="font-medium text-gray-900">{migrationJob.done} / {migrationJob.total}</span>
                   </div>
-                  <div className="text-sm space-y-1">
-                    <div>成功迁移: {migrationResult.stats.migrated}</div>
-                    <div>跳过 (已在目标): {migrationResult.stats.skipped}</div>
-                    {migrationResult.stats.failed > 0 && (
-                      <div className="text-red-600">失败: {migrationResult.stats.failed}</div>
-                    )}
+                  <div className="w-full h-2 bg-gray-200 rounded-full overflow-hidden">
+                    <div
+                      className="h-full bg-indigo-600 transition-all"
+                      style={{ width: `${migrationJob.total ? Math.round(migrationJob.done * 100 / migrationJob.total) : 0}%` }}
+                    />
                   </div>
-                </div>
-                {migrationResult.stats.errors.length > 0 && (
-                  <div className="bg-red-50 rounded-lg p-3 text-xs text-red-700 max-h-32 overflow-y-auto">
-                    {migrationResult.stats.errors.map((err, i) => (
-                      <div key={i}>{err}</div>
-                    ))}
+                  <div className="flex justify-between text-xs text-gray-500">
+                    <span>{formatBytes(migrationJob.bytes_done)} / {formatBytes(migrationJob.bytes_total)}</span>
+                    <span>
+                      {migrationJob.rate_bytes_per_second > 0 && `${formatBytes(migrationJob.rate_bytes_per_second)}/s`}
+                      {migrationJob.eta_seconds !== null && ` · 剩余约 ${formatDuration(migrationJob.eta_seconds)}`}
+                    </span>
                   </div>
+                </div>
+                {migrationJob.stale ? (
+                  <button
+                    onClick={handleResumeMigration}
+                    className="w-full py-2 bg-indigo-600 text-white rounded-xl text-sm hover:bg-indigo-700 transition-colors"
+                  >
+                    继续迁移
+                  </button>
+                ) : (
+                  <button
+                    onClick={handleCancelMigration}
+                    disabled={migrationJob.cancel_requested}
+                    className="w-full py-2 bg-gray-100 text-gray-700 rounded-xl text-sm hover:bg-gray-200 transition-colors disabled:opacity-50 disabled:cursor-not-allowed"
+                  >
+                    {migrationJob.cancel_requested ? '正在取消...' : '取消迁移'}
+                  </button>
                 )}
-                <button
-                  onClick={() => setShowMigrationModal(false)}
-                  className="w-full py-2 bg-gray-100 text-gray-700 rounded-xl text-sm hover:bg-gray-200 transition-colors"
-                >
-                  关闭
-                </button>
               </div>
             )}
+
+            {migrationJob && isJobFinished && (() => {
+              const succeeded = migrationJob.status === 'completed' && migrationJob.failed === 0;
+              const title = succeeded
+                ? '迁移成功'
+                : migrationJob.status === 'cancelled'
+                  ? '迁移已取消'
+                  : migrationJob.status === 'failed'
+                    ? '迁移失败'
+                    : '迁移完成（部分失败）';
+              return (
+                <div className="space-y-3">
+                  <div className={`rounded-xl p-4 ${succeeded ? 'bg-green-50 border border-green-200' : 'bg-red-50 border border-red-200'}`}>
+                    <div className="flex items-center gap-2 mb-2">
+                      {succeeded ? (
+                        <svg className="w-5 h-5 text-green-600" fill="none" stroke="currentColor" viewBox="0 0 24 24">
+                          <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M5 13l4 4L19 7" />
+                        </svg>
+                      ) : (
+                        <svg className="w-5 h-5 text-red-600" fill="none" stroke="currentColor" viewBox="0 0 24 24">
+                          <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2} d="M6 18L18 6M6 6l12 12" />
+                        </svg>
+                      )}
+                      <span className={`font-medium ${succeeded ? 'text-green-800' : 'text-red-800'}`}>{title}</span>
+                    </div>
+                    <div className="text-sm space-y-1">
+                      <div>成功迁移: {migrationJob.migrated} / {migrationJob.total}</div>
+                      {migrationJob.failed > 0 && (
+                        <div className="text-red-600">失败: {migrationJob.failed}</div>
+                      )}
+                      {migrationJob.error && (
+                        <div className="text-red-600">{migrationJob.error}</div>
+                      )}
+                    </div>
+                  </div>
+                  {migrationJob.errors.length > 0 && (
+                    <div className="bg-red-50 rounded-lg p-3 text-xs text-red-700 max-h-32 overflow-y-auto">
+                      {migrationJob.errors.map((err, i) => (
+                        <div key={i}>{err}</div>
+                      ))}
+                    </div>
+                  )}
+                  {!succeeded && (
+                    <button
+                      onClick={handleResumeMigration}
+                      className="w-full py-2 bg-indigo-600 text-white rounded-xl text-sm hover:bg-indigo-700 transition-colors"
+                    >
+                      继续迁移剩余文件
+                    </button>
+                  )}
+                  <button
+                    onClick={() => setShowMigrationModal(false)}
+                    className="w-full py-2 bg-gray-100 text-gray-700 rounded-xl text-sm hover:bg-gray-200 transition-colors"
+                  >
+                    关闭
+                  </button>
+                </div>
+              );
+            })()}
           </div>
         </Modal>
 
@@ -1,5 +1,5 @@
 import { apiClient } from './apiClient';
-import type { StorageSettings, StorageSettingsUpdate, StorageTestResult } from '../../types';
+import type { StorageSettings, StorageSettingsUpdate, StorageTestResult, StorageMigrationJob, StorageMigrationPreview } from '../../types';
 
 export const settingsApi = {
   /**
@@ -59,41 +59,51 @@ export const settingsApi = {
   },
 
   /**
-   * 测试指定 S3 配置的连接
+   * 测试指定 S3 配置的连接；benchmark 为 true 时同时测试上传/下载延迟和吞吐量
    */
-  async testStorageConnectionById(id: number): Promise<StorageTestResult> {
-    return apiClient.post<StorageTestResult>(`/api/v1/bbtalk/settings/storage/${id}/test/`);
+  async testStorageConnectionById(id: number, benchmark = false): Promise<StorageTestResult> {
+    return apiClient.post<StorageTestResult>(
+      `/api/v1/bbtalk/settings/storage/${id}/test/`,
+      benchmark ? { benchmark: true } : undefined,
+    );
   },
 
   /**
    * 预览存储迁移：查看需要迁移的附件数量
    */
-  async migrationPreview(targetConfigId: number | null): Promise<{
-    total: number;
-    need_migrate: number;
-    already_on_target: number;
-  }> {
+  async migrationPreview(targetConfigId: number | null): Promise<StorageMigrationPreview> {
     return apiClient.post('/api/v1/bbtalk/storage/migration/preview/', {
       target_config_id: targetConfigId,
     });
   },
 
   /**
-   * 执行存储迁移
+   * 执行存储迁移：创建后台任务，返回任务 ID
    */
-  async migrationExecute(targetConfigId: number | null): Promise<{
-    success: boolean;
-    stats: {
-      total: number;
-      migrated: number;
-      skipped: number;
-      failed: number;
-      errors: string[];
-    };
-    error?: string;
-  }> {
+  async migrationExecute(targetConfigId: number | null): Promise<{ job_id: number }> {
     return apiClient.post('/api/v1/bbtalk/storage/migration/execute/', {
       target_config_id: targetConfigId,
     });
   },
+
+  /**
+   * 查询存储迁移任务进度
+   */
+  async migrationJob(jobId: number): Promise<StorageMigrationJob> {
+    return apiClient.get(`/api/v1/bbtalk/storage/migration/jobs/${jobId}/`);
+  },
+
+  /**
+   * 取消存储迁移任务
+   */
+  async migrationCancel(jobId: number): Promise<StorageMigrationJob> {
+    return apiClient.post(`/api/v1/bbtalk/storage/migration/jobs/${jobId}/cancel/`);
+  },
+
+  /**
+   * 恢复中断的存储迁移任务
+   */
+  async migrationResume(jobId: number): Promise<StorageMigrationJob> {
+    return apiClient.post(`/api/v1/bbtalk/storage/migration/jobs/${jobId}/resume/`);
+  },
 };
@@ -73,13 +73,37 @@ export interface StorageSettings {
   s3_region_name: string;
   s3_endpoint_url: string;
   s3_custom_domain: string;
+  s3_public_prefix?: string;
+  s3_proxy_downloads?: boolean;
+  s3_connect_timeout?: number | null;
+  s3_read_timeout?: number | null;
+  s3_max_attempts?: number | null;
   is_active: boolean;
   has_secret_key: boolean;
   is_s3_configured: boolean;
+  usage?: StorageUsage;
+  benchmark?: StorageBenchmark | Record<string, never>;
+  health?: StorageHealth;
   create_time: string;
   update_time: string;
 }
 
+export interface StorageUsage {
+  storage_config_id: string | null;
+  file_count: number;
+  bytes_used: number;
+  quota_bytes: number | null;
+}
+
+export interface StorageHealth {
+  state: 'closed' | 'open';
+  failures: number;
+  last_error: string;
+  last_failure_at: number | null;
+  last_success_at: number | null;
+  retry_at: number | null;
+}
+
 export interface StorageSettingsUpdate {
   name?: string;
   storage_type?: 'local' | 's3';
@@ -89,10 +113,66 @@ export interface StorageSettingsUpdate {
   s3_region_name?: string;
   s3_endpoint_url?: string;
   s3_custom_domain?: string;
+  s3_public_prefix?: string;
+  s3_proxy_downloads?: boolean;
+  s3_connect_timeout?: number | null;
+  s3_read_timeout?: number | null;
+  s3_max_attempts?: number | null;
   is_active?: boolean;
 }
 
+export interface StorageBenchmarkProfile {
+  size: number;
+  count: number;
+  put_ms: { p50: number; p90: number; p99: number; max: number };
+  get_ms: { p50: number; p90: number; p99: number; max: number };
+  put_bytes_per_second: number;
+  get_bytes_per_second: number;
+}
+
+export interface StorageBenchmark {
+  measured_at: string;
+  small: StorageBenchmarkProfile;
+  large: StorageBenchmarkProfile;
+}
+
 export interface StorageTestResult {
   success: boolean;
   message: string;
+  benchmark?: StorageBenchmark;
+}
+
+export interface StorageMigrationPreview {
+  total: number;
+  need_migrate: number;
+  already_on_target: number;
+  need_migrate_bytes: number;
+  sources: {
+    storage_config_id: string | null;
+    name: string;
+    count: number;
+    bytes: number;
+    estimated_seconds: number | null;
+  }[];
+  estimated_seconds: number | null;
+}
+
+export interface StorageMigrationJob {
+  id: number;
+  target_config_id: string;
+  status: 'pending' | 'running' | 'completed' | 'failed' | 'cancelled';
+  total: number;
+  migrated: number;
+  failed: number;
+  bytes_total: number;
+  bytes_done: number;
+  errors: string[];
+  error: string;
+  cancel_requested: boolean;
+  created_at: string;
+  finished_at: string | null;
+  done: number;
+  rate_bytes_per_second: number;
+  eta_seconds: number | null;
+  stale: boolean;
 }
@@ -48,7 +48,43 @@ function transformAttachment(data: any): Attachment {
   };
 }
 
+async function sha256Hex(blob: Blob): Promise<string> {
+  const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+  return Array.from(new Uint8Array(digest))
+    .map((b) => b.toString(16).padStart(2, '0'))
+    .join('');
+}
+
 export const attachmentApi = {
+  /**
+   * 哈希预检：服务器已有相同内容时直接登记附件，不再传输文件
+   * 返回 null 表示需要正常上传（包括预检失败、运行环境没有 crypto.subtle）
+   */
+  async preflight(file: File): Promise<Attachment | null> {
+    if (!file.size || typeof crypto === 'undefined' || !crypto.subtle) return null;
+    try {
+      const token = await getAccessToken();
+      const response = await fetch(`${getApiBaseUrl()}/api/v1/attachments/files/preflight/`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          ...(token ? { Authorization: `Bearer ${token}` } : {}),
+        },
+        body: JSON.stringify({
+          content_hash: await sha256Hex(file),
+          size: file.size,
+          original_name: file.name || 'upload',
+          is_public: true,
+        }),
+      });
+      if (!response.ok) return null;
+      const data = await response.json();
+      return data.exists ? transformAttachment(data.attachment) : null;
+    } catch {
+      return null;
+    }
+  },
+
   async upload(uri: string, fileName: string, mimeType: string): Promise<Attachment> {
     // Web 平台：RN 风格的 { uri, name, type } 对象不被浏览器 FormData 识别，
     // 会被 toString() 成 "[object Object]"。需要先 fetch 成 Blob 再用 File 包装。
@@ -88,6 +124,9 @@ export const attachmentApi = {
 
   /** Web-only: upload a File/Blob object directly */
   async uploadFile(file: File): Promise<Attachment> {
+    const existing = await this.preflight(file);
+    if (existing) return existing;
+
     const token = await getAccessToken();
     const formData = new FormData();
     formData.append('file', file, file.name || 'upload');